@@ -10,28 +10,34 @@ import common
 import server
 import shops
 import players
+import storage
+import debounce
+import startup
 
 from custom_types import Transaction, Actor, TransTypes
 from common import emoji_cancel, emoji_open
 
 import discord
 import asyncio
-from configobj import ConfigObj
 import re
 
 actors_conf_dir = 'actors'
 finance_channel_mapping_index = '___finance_channels'
 
 def get_actors_confobj():
-	actors = ConfigObj(actors_conf_dir + '/__actors.conf')
+	actors = storage.get_conf(actors_conf_dir + '/__actors.conf')
 	if not finance_channel_mapping_index in actors:
 		actors[finance_channel_mapping_index] = {}
 		actors.write()
 	return actors
 
+# Also re-initialises shops and players, which are actors too
 async def init(guild, clear_all=False):
 	await shops.init(guild, clear_all=clear_all)
 	await players.init(guild, clear_all=clear_all)
+	await init_actors(guild, clear_all=clear_all)
+
+async def init_actors(guild, clear_all=False):
 	get_actors_confobj() # ensures it's properly initialised
 	if clear_all:
 		for actor_id in get_all_actor_ids():
@@ -44,6 +50,9 @@ async def init(guild, clear_all=False):
 			# TODO: re-map all personal channels?
 	await delete_all_actor_roles(guild, spare_used=(not clear_all))
 
+# At startup, shops and players have their own steps
+startup.register('actors', lambda: init_actors(server.get_guild()), dependencies=['players'])
+
 async def clear_actor(guild, actor_id : str):
 	if actor_exists(actor_id):
 		# TODO: clear out/archive chat participants from all chats? Not required unless we expect to create and destroy actors during game
@@ -65,22 +74,23 @@ async def clear_actor(guild, actor_id : str):
 
 
 async def delete_all_actor_roles(guild, spare_used : bool):
-	task_list = (asyncio.create_task(delete_if_actor_role(r, spare_used)) for r in guild.roles)
-	await asyncio.gather(*task_list)
+	role_names_in_use = get_actor_role_names() if spare_used else set()
+	await server.delete_roles(
+		[r for r in guild.roles
+		if is_actor_role(r.name) and not (spare_used and is_role_in_use(r, role_names_in_use))]
+		)
 
-async def delete_if_actor_role(role, spare_used : bool):
-	if await is_actor_role(role.name):
-		in_use = actor_index_in_use(role.name) or len(role.members) > 0
-		if not in_use or not spare_used:
-			await role.delete()
-
-async def is_actor_role(name :str):
+def is_actor_role(name :str):
 	return common.is_player_role(name) or common.is_shop_role(name)
 
+# role_names_in_use should come from get_actor_role_names()
+def is_role_in_use(role, role_names_in_use):
+	return role.name in role_names_in_use or len(role.members) > 0
+
 def get_actor_role(guild, actor_id : str):
 	actor = read_actor(actor_id)
 	if actor is not None:
-		return discord.utils.find(lambda role: role.name == actor.role_name, guild.roles)
+		return server.get_role(actor.role_name)
 
 
 
@@ -99,11 +109,8 @@ def actor_exists(actor_id : str):
 	actors = get_actors_confobj()
 	return actor_id in actors
 
-def actor_index_in_use(actor_index : str):
-	for actor in get_all_actors():
-		if actor.role_name == actor_index:
-			return True
-	return False
+def get_actor_role_names():
+	return set(actor.role_name for actor in get_all_actors())
 
 def store_actor(actor : Actor):
 	actors = get_actors_confobj()
@@ -112,8 +119,8 @@ def store_actor(actor : Actor):
 	actors.write()
 
 def read_actor(actor_id : str):
-	if actor_id in get_all_actor_ids():
-		actors = get_actors_confobj()
+	actors = get_actors_confobj()
+	if actor_id in actors and actor_id != finance_channel_mapping_index:
 		return Actor.from_string(actors[actor_id])
 
 def get_owner_of_finance_channel(channel_id : str):
@@ -128,7 +135,7 @@ recent_transactions_suffix = '_recent_trans.conf'
 
 def get_trans_mem(actor_id : str):
 	trans_mem_file_name = f'{actor_id}{recent_transactions_suffix}'
-	return ConfigObj(f'{actors_conf_dir}/{trans_mem_file_name}')
+	return storage.get_conf(f'{actors_conf_dir}/{trans_mem_file_name}')
 
 def get_all_recent_trans(actor_id : str):
 	if actor_exists(actor_id):
@@ -175,15 +182,16 @@ async def create_new_actor(guild, actor_index : str, actor_id : str, existing_ro
 	if existing_role_name is None:
 		# Create role for this actor:
 		role = await guild.create_role(name=actor_index)
+		server.add_role(role)
 	else:
-		role = discord.utils.find(lambda role: role.name == existing_role_name, guild.roles)
+		role = server.get_role(existing_role_name)
 
 	return await create_new_actor_with_role(guild, role, actor_id)
 
 # TODO: change GM handles to a special handle type that cannot handle money
 #       and remove the GM's financial channel completely
 async def create_gm_actor(guild, role_name : str, actor_id : str):
-	role = discord.utils.find(lambda role: role.name == role_name, guild.roles)
+	role = server.get_role(role_name)
 	return await create_new_actor_with_role(guild, role, actor_id, is_gm=True)
 
 async def create_new_actor_with_role(guild, role, actor_id : str, is_gm : bool=False):
@@ -265,35 +273,66 @@ def get_chat_hub_channel(actor_id : str):
 		return channels.get_discord_channel(actor.chat_channel_id)
 
 
-async def get_financial_statement(channel, actor : Actor):
+# Finance channels:
+# Record lines are buffered per actor and sent together as one message at most once per
+# finance_write_window seconds. The statement is a single message that is edited in place
+# when the buffer is sent.
+# Shop orders are the exception: each needs its own message that can be reacted to for refunds.
+
+finance_write_window = 1.0
+# Discord messages are limited to 2000 characters
+max_message_length = 2000
+statement_header = '========================\n'
+
+# actor_id -> list of record lines not yet sent
+finance_records_buffers = {}
+
+async def update_financial_statement(channel, actor : Actor):
+	report = finances.get_all_handles_balance_report(actor.actor_id)
+	content = statement_header + report
 	if actor.finance_stmt_msg_id > 0:
 		try:
-			return await channel.fetch_message(actor.finance_stmt_msg_id)
+			await channel.get_partial_message(actor.finance_stmt_msg_id).edit(content=content)
+			return
 		except discord.errors.NotFound:
 			pass
-
-async def update_financial_statement(channel, actor : Actor):
-	message = await get_financial_statement(channel, actor)
-	if message is not None:
-		await message.delete()
-
-	report = finances.get_all_handles_balance_report(actor.actor_id)
-	content = '========================\n' + report
-
 	new_message = await channel.send(content)
 	actor.finance_stmt_msg_id = new_message.id
 	store_actor(actor)
 
-async def refresh_financial_statement(actor_id : str):
+def join_records(records):
+	message = ''
+	for record in records:
+		if message != '' and len(message) + len(record) + 1 > max_message_length:
+			yield message
+			message = ''
+		message = record if message == '' else message + '\n' + record
+	if message != '':
+		yield message
+
+async def write_finance_channel(actor_id : str):
+	records = finance_records_buffers.pop(actor_id, [])
 	actor = read_actor(actor_id)
 	if actor is None:
-		raise RuntimeError(f'Trying to write financial record but could not find which actor it belongs to.')
+		print(f'Error: trying to write financial records for {actor_id} but the actor no longer exists.')
+		return
 	channel = channels.get_discord_channel(actor.finance_channel_id)
+	for message in join_records(records):
+		await channel.send(message)
 	await update_financial_statement(channel, actor)
 
+finance_writer = debounce.Debouncer('finance channel', finance_write_window, write_finance_channel)
+
+async def refresh_financial_statement(actor_id : str):
+	actor = read_actor(actor_id)
+	if actor is None:
+		raise RuntimeError(f'Trying to write financial record but could not find which actor it belongs to.')
+	finance_writer.schedule(actor_id)
+
 async def write_financial_record(transaction : Transaction, payer_record : str=None, recip_record : str=None):
+	individual = transaction.cause == TransTypes.ShopOrder
 	def send_record_task(actor_id : str, record : str):
-		return asyncio.create_task(send_financial_record_for_actor(actor_id, record, transaction.last_in_sequence))
+		return asyncio.create_task(send_financial_record_for_actor(actor_id, record, individual))
 
 	task_list = (
 		send_record_task(a, r)
@@ -316,15 +355,21 @@ async def write_financial_record(transaction : Transaction, payer_record : str=N
 			store_transaction(transaction.recip_actor, transaction.recip_msg_id, transaction)
 
 
-async def send_financial_record_for_actor(actor_id : str, record : str, last_in_sequence):
+# Returns the message only if the record was sent in a message of its own
+async def send_financial_record_for_actor(actor_id : str, record : str, individual : bool):
 	if record is not None:
 		actor = read_actor(actor_id)
 		if actor is None:
 			raise RuntimeError(f'Trying to write financial record but could not find which actor it belongs to.')
+		if not individual:
+			finance_records_buffers.setdefault(actor_id, []).append(record)
+			finance_writer.schedule(actor_id)
+			return None
+		# Anything buffered came before this record
+		await finance_writer.flush(actor_id)
 		channel = channels.get_discord_channel(actor.finance_channel_id)
 		message = await channel.send(record)
-		if last_in_sequence:
-			await update_financial_statement(channel, actor)
+		finance_writer.schedule(actor_id)
 		return message
 
 async def lock_tentative_transaction(actor_id : str, msg_id : str):
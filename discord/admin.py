@@ -4,6 +4,8 @@ import groups
 import channels
 import server
 import handles
+import locks
+import sequencer
 
 from discord.ext import commands
 import discord
@@ -18,7 +20,7 @@ import asyncio
 
 class AdminCog(commands.Cog, name='admin'):
 	"""Admin-only commands, hidden by default. To view documentation, use \"help <command>\". The commands are:
-	init_all_players, fake_join, fake_join_name, fake_join_nick, clear_all_players, clear_all_actors, clear_actor, ping"""
+	init_all_players, fake_join, fake_join_name, fake_join_nick, clear_all_players, clear_all_actors, clear_actor, lock_stats, queue_stats, ping"""
 	def __init__(self, bot):
 		self.bot = bot
 		self._last_member = None
@@ -54,15 +56,14 @@ class AdminCog(commands.Cog, name='admin'):
 		elif handle is None:
 			await ctx.send(f'Failed: you must give the player\'s main handle.')
 		else:
-			sem_id = await handles.get_semaphore(user_id)
-			if sem_id is None:
+			try:
+				async with handles.lock_handles():
+					report = await players.create_player(member_to_fake_join, handle)
+					if report is None:
+						report = "Done."
+					await ctx.send(report)
+			except locks.LockTimeout:
 				await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
-			else:
-				report = await players.create_player(member_to_fake_join, handle)
-				if report is None:
-					report = "Done."
-				await ctx.send(report)
-				handles.return_semaphore(sem_id)
 
 	@commands.command(
 		name='fake_join_name',
@@ -73,22 +74,20 @@ class AdminCog(commands.Cog, name='admin'):
 		allowed = await channels.pre_process_command(ctx)
 		if not allowed:
 			return
-		members = await ctx.guild.fetch_members(limit=100).flatten()
-		member_to_fake_join = discord.utils.find(lambda m: m.name == name, members)
+		member_to_fake_join = discord.utils.find(lambda m: m.name == name, ctx.guild.members)
 		if member_to_fake_join is None:
 			await ctx.send(f'Failed: member with name {name} not found.')
 		elif handle is None:
 			await ctx.send(f'Failed: you must give the player\'s main handle.')
 		else:
-			sem_id = await handles.get_semaphore(str(member_to_fake_join.id))
-			if sem_id is None:
+			try:
+				async with handles.lock_handles():
+					report = await players.create_player(member_to_fake_join, handle)
+					if report is None:
+						report = "Done."
+					await ctx.send(report)
+			except locks.LockTimeout:
 				await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
-			else:
-				report = await players.create_player(member_to_fake_join, handle)
-				if report is None:
-					report = "Done."
-				await ctx.send(report)
-				handles.return_semaphore(sem_id)
 
 	@commands.command(
 		name='fake_join_nick',
@@ -105,19 +104,17 @@ class AdminCog(commands.Cog, name='admin'):
 		elif handle is None:
 			await ctx.send(f'Failed: you must give the player\'s main handle.')
 		else:
-			sem_id = await handles.get_semaphore(str(member_to_fake_join.id))
-			if sem_id is None:
+			try:
+				async with handles.lock_handles():
+					report = await players.create_player(member_to_fake_join, handle)
+					if report is None:
+						report = "Done."
+					await ctx.send(report)
+			except locks.LockTimeout:
 				await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
-			else:
-				report = await players.create_player(member_to_fake_join, handle)
-				if report is None:
-					report = "Done."
-				await ctx.send(report)
-				handles.return_semaphore(sem_id)
 
 	# This command ONLY works in the landing page channel.
 	# Note: no other commands work in the landing page channel!
-	# TODO: semaphore for joining
 	@commands.command(
 		name='join',
 		help='Claim a handle and join the game. Only for players who have not yet joined.',
@@ -132,19 +129,18 @@ class AdminCog(commands.Cog, name='admin'):
 		elif handle is None or handle == 'handle' or handle == '<handle>':
 			await self.send_response_in_landing_page(ctx, '```You must say which handle is yours! Example: \".join shadow_weaver\"```')
 		else:
-			sem_id = await handles.get_semaphore(str(member.id))
-			if sem_id is None:
+			try:
+				async with handles.lock_handles():
+					# TODO give player some sort of warning about using lower-case only
+					handle_id = handle.lower()
+					report = await players.create_player(member, handle_id)
+					if report is not None:
+						await self.send_response_in_landing_page(ctx, f'```Failed: invalid starting handle \"{handle_id}\" (or handle is already taken).```')
+					else:
+						message = ctx.message
+						await server.swallow(message, alert=False);
+			except locks.LockTimeout:
 				await self.send_response_in_landing_page(ctx, '```Failed: system is too busy. Wait a few minutes and try again.```')
-			else:
-				# TODO give player some sort of warning about using lower-case only
-				handle_id = handle.lower()
-				report = await players.create_player(member, handle_id)
-				if report is not None:
-					await self.send_response_in_landing_page(ctx, f'```Failed: invalid starting handle \"{handle_id}\" (or handle is already taken).```')
-				else:
-					message = ctx.message
-					await server.swallow(message, alert=False);
-				handles.return_semaphore(sem_id)
 
 	async def send_response_in_landing_page(self, ctx, response : str):
 		if response is not None:
@@ -199,6 +195,32 @@ class AdminCog(commands.Cog, name='admin'):
 			print(f'Cleared actor {actor_id}. Could not send report because channel is missing – '
 				+'the command was probably given in a player-only command line that was deleted.')
 	
+	@commands.command(
+		name='lock_stats',
+		help='Admin-only. Show contention and wait times for the locks on handles, reactions and orders.',
+		hidden=True)
+	@commands.has_role('gm')
+	async def lock_stats_command(self, ctx):
+		allowed = await channels.pre_process_command(ctx)
+		if not allowed:
+			return
+		report = locks.get_report()
+		# Discord messages are limited to 2000 characters
+		await ctx.send(report[:2000])
+
+	@commands.command(
+		name='queue_stats',
+		help='Admin-only. Show how many messages are waiting to be reposted, per channel and chat.',
+		hidden=True)
+	@commands.has_role('gm')
+	async def queue_stats_command(self, ctx):
+		allowed = await channels.pre_process_command(ctx)
+		if not allowed:
+			return
+		report = sequencer.get_report()
+		# Discord messages are limited to 2000 characters
+		await ctx.send(report[:2000])
+
 	@commands.command(
 		name='ping',
 		help='Admin-only. Send a ping to a player\'s cmd_line channel.',
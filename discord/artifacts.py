@@ -16,6 +16,7 @@ import channels
 import server
 import finances
 import actors
+import startup
 
 #TODO: reinitialise?
 
@@ -73,6 +74,8 @@ def init(clear_all : bool=False):
 			artifact = Artifact.from_string(artifacts_main_conf[art_name])
 			artifact.store()
 
+startup.register('artifacts', init)
+
 class FileArea(object):
 	def __init__(
 		self,
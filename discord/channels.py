@@ -1,14 +1,19 @@
-from configobj import ConfigObj
 import datetime
 import discord
 
-from custom_types import PostTimestamp, ChannelIdentifier
+from custom_types import ChannelIdentifier
 from common import all_categories, personal_category_base, shops_category_name, chats_category_base, off_category_name, public_open_category_name, shadowlands_category_name, groups_category_name, announcements_category_name, gm_announcements_name, setup_category_name, testing_category_name
 
 import actors
 import server
 import asyncio
 import players
+import storage
+import debounce
+import startup
+
+from dotenv import load_dotenv
+import os
 
 ### Module channels.py
 # This module tracks and handles state related to channels
@@ -22,9 +27,13 @@ post_counter_index = '___post_counter'
 
 slowmode_delay : int = 2
 
+# Channels are initialised a few at a time at startup; set CHANNEL_INIT_CONCURRENCY in .env to change.
+load_dotenv()
+max_concurrent_channel_inits : int = int(os.getenv('CHANNEL_INIT_CONCURRENCY', '5'))
+
 # Channel state: this is the state of the channel, independent of the handles used in it.
 
-channel_states = ConfigObj('channel_states.conf')
+channel_states = storage.get_conf('channel_states.conf')
 
 
 ### Utilities:
@@ -131,43 +140,57 @@ async def init():
     for elem in channel_states:
         del channel_states[elem]
     channel_states.write()
+    post_states.clear()
+    post_states_to_store.clear()
     channel_list = await server.get_all_channels()
 
-    for c in channel_list:
-        print("Setting roles for %s" % c.name)
-        await init_discord_channel(c)
+    semaphore = asyncio.Semaphore(max_concurrent_channel_inits)
+    progress = {'done': 0, 'updated': 0}
+    async def init_with_progress(c):
+        async with semaphore:
+            updated = await init_discord_channel(c)
+        progress['done'] += 1
+        if updated:
+            progress['updated'] += 1
+        if progress['done'] % 25 == 0 or progress['done'] == len(channel_list):
+            print(f'Initialised {progress["done"]}/{len(channel_list)} channels ({progress["updated"]} needed new permissions)')
+    await asyncio.gather(*[init_with_progress(c) for c in channel_list])
 
     task_list_categories = (asyncio.create_task(verify_category_exists(cat)) for cat in all_categories)
     await asyncio.gather(*task_list_categories)
 
+startup.register('channels', init, dependencies=['actors'])
+
 
 async def init_discord_channel(discord_channel):
     if discord_channel.type in [discord.ChannelType.category, discord.ChannelType.voice]:
         # No need to do anything for the categories themselves or the voice channels
-        return
+        return False
 
+    # Returns whether the permissions of the channel had to be changed
     if discord_channel.category != None:
         if discord_channel.category.name.startswith(personal_category_base):
-            await init_private_channel(discord_channel)
+            return await init_private_channel(discord_channel)
         elif discord_channel.category.name == public_open_category_name:
-            await init_public_open_channel(discord_channel)
+            return await init_public_open_channel(discord_channel)
         elif discord_channel.category.name == shops_category_name:
-            await init_common_read_only_channel(discord_channel)
+            return await init_common_read_only_channel(discord_channel)
         elif discord_channel.category.name == groups_category_name:
-            await init_group_channel(discord_channel)
+            return await init_group_channel(discord_channel)
         elif discord_channel.category.name == announcements_category_name:
             if discord_channel.name == gm_announcements_name:
-                await init_private_channel(discord_channel, gm_extra_access=True)
+                return await init_private_channel(discord_channel, gm_extra_access=True)
             else:
-                await init_common_read_only_channel(discord_channel)
+                return await init_common_read_only_channel(discord_channel)
         elif discord_channel.category.name == setup_category_name:
-            await init_setup_channel(discord_channel)
+            return await init_setup_channel(discord_channel)
         elif discord_channel.category.name == testing_category_name:
-            await init_private_channel(discord_channel, gm_extra_access=True)
+            return await init_private_channel(discord_channel, gm_extra_access=True)
 
 
     else:
         print(f'Will not create channel state for channel {discord_channel.name} which has no category')
+    return False
 
 
 async def verify_category_exists(category_name : str):
@@ -177,49 +200,59 @@ async def verify_category_exists(category_name : str):
         await guild.create_category(category_name)
 
 async def init_channel_state(discord_channel):
-    await discord_channel.edit(slowmode_delay=slowmode_delay)
+    if discord_channel.slowmode_delay != slowmode_delay:
+        await discord_channel.edit(slowmode_delay=slowmode_delay)
     channel_name = discord_channel.name
     channel_states[channel_name] = {}
     channel_states.write()
+    post_states.pop(channel_name, None)
     ident = ChannelIdentifier(discord_channel_id=discord_channel.id)
     set_channel_id(discord_channel.name, ident)    
 
+# Only the overwrites that differ from the current ones are changed, all in one edit.
+# Overwrites for other roles and members (e.g. a player's access to their own channels) are kept.
+# Returns whether anything had to be changed.
+async def sync_overwrites(discord_channel, desired_overwrites):
+    current_overwrites = discord_channel.overwrites
+    if all(current_overwrites.get(target) == overwrite for (target, overwrite) in desired_overwrites.items()):
+        return False
+    merged = {**current_overwrites, **desired_overwrites}
+    await discord_channel.edit(overwrites=merged)
+    return True
+
 async def set_base_permissions(discord_channel, private : bool, read_only : bool, gm_extra_access : bool=False):
-    add_roles_tasks = (
-        [asyncio.create_task(discord_channel.set_permissions(role, overwrite=overwrites))
-        for (role, overwrites)
-        in server.generate_base_overwrites(private, read_only, gm_extra_access).items()])
-    await asyncio.gather(*add_roles_tasks)
+    return await sync_overwrites(discord_channel, server.generate_base_overwrites(private, read_only, gm_extra_access))
 
 async def init_common_read_only_channel(discord_channel, gm_only : bool=False):
-    await set_base_permissions(discord_channel, private=gm_only, read_only=True, gm_extra_access=gm_only)
+    updated = await set_base_permissions(discord_channel, private=gm_only, read_only=True, gm_extra_access=gm_only)
     await init_channel_state(discord_channel)
     init_pseudonymous_channel(discord_channel.name)
+    return updated
 
 async def init_public_open_channel(discord_channel):
-    await set_base_permissions(discord_channel, private=False, read_only=False)
+    updated = await set_base_permissions(discord_channel, private=False, read_only=False)
     await init_channel_state(discord_channel)
     init_pseudonymous_channel(discord_channel.name)
+    return updated
 
 async def init_private_channel(discord_channel, gm_extra_access : bool=False):
     read_only = is_read_only_private_channel(discord_channel)
-    await set_base_permissions(discord_channel, private=True, read_only=read_only, gm_extra_access=gm_extra_access)
+    updated = await set_base_permissions(discord_channel, private=True, read_only=read_only, gm_extra_access=gm_extra_access)
     await init_channel_state(discord_channel)
+    return updated
 
 async def init_group_channel(discord_channel):
-    await set_base_permissions(discord_channel, private=True, read_only=False, gm_extra_access=True)
+    updated = await set_base_permissions(discord_channel, private=True, read_only=False, gm_extra_access=True)
     await init_channel_state(discord_channel)
     init_pseudonymous_channel(discord_channel.name)
+    return updated
 
 async def init_setup_channel(discord_channel):
-    add_roles_tasks = (
-        [asyncio.create_task(discord_channel.set_permissions(role, overwrite=overwrites))
-        for (role, overwrites)
-        in server.generate_setup_channel_overwrites().items()])
-    await asyncio.gather(*add_roles_tasks)
+    updated = await sync_overwrites(discord_channel, server.generate_setup_channel_overwrites())
     await init_channel_state(discord_channel)
     await discord_channel.purge()
     await discord_channel.send(generate_setup_channel_welcome_msg())
+    return updated
 
 
 async def make_read_only(channel_id : str):
@@ -252,62 +285,84 @@ def get_public_anon_channel(guild):
 
 ### Utilities related to pseudonymous channels, i.e. ones where all messages are reposted using handle
 
-def init_pseudonymous_channel(channel_name : str):
-    set_last_poster(channel_name, '')
-    timestamp : PostTimestamp = PostTimestamp.from_datetime(datetime.datetime.today())
-    set_last_full_post(channel_name, timestamp)
-    reset_post_counter(channel_name)
-
-def set_last_poster(channel_name : str, poster_id : str):
-    channel_states[channel_name][last_poster_index] = poster_id;
+# The state used for deciding which posts get a header is kept in memory, one PostState per channel.
+# It is stored in channel_states lazily, at most once per post_states_write_window seconds;
+# losing the latest changes only means that the next post may get a header it did not need.
+
+post_states_write_window = 30
+max_posts_without_header = 10
+
+class PostState(object):
+    __slots__ = ('last_poster', 'last_full_post', 'post_counter')
+
+    def __init__(self, last_poster : str='', last_full_post : int=0, post_counter : int=0):
+        self.last_poster = last_poster
+        # Minutes since the epoch
+        self.last_full_post = last_full_post
+        self.post_counter = post_counter
+
+    @staticmethod
+    def from_section(section):
+        state = PostState(last_poster=section.get(last_poster_index, ''))
+        try:
+            state.last_full_post = int(section.get(last_full_post_index, 0))
+            state.post_counter = int(section.get(post_counter_index, 0))
+        except ValueError:
+            # Stored in an older format; the next post will simply get a header
+            pass
+        return state
+
+    def store_in_section(self, section):
+        section[last_poster_index] = self.last_poster
+        section[last_full_post_index] = str(self.last_full_post)
+        section[post_counter_index] = str(self.post_counter)
+
+# channel_name -> PostState
+post_states = {}
+post_states_to_store = set()
+
+def get_post_state(channel_name : str):
+    if not channel_name in post_states:
+        section = channel_states[channel_name] if channel_name in channel_states else {}
+        post_states[channel_name] = PostState.from_section(section)
+    return post_states[channel_name]
+
+async def store_post_states(_):
+    for channel_name in post_states_to_store:
+        if channel_name in channel_states and channel_name in post_states:
+            post_states[channel_name].store_in_section(channel_states[channel_name])
+    post_states_to_store.clear()
     channel_states.write()
 
-def get_last_poster(channel_name : str):
-    if not last_poster_index in channel_states[channel_name]:
-        return ''
-    else:
-        return channel_states[channel_name][last_poster_index];
-
-def get_last_post_time(channel_name : str):
-    return PostTimestamp.from_string(channel_states[channel_name][last_full_post_index])
+post_states_writer = debounce.Debouncer('channel states', post_states_write_window, store_post_states)
 
-def set_last_full_post(channel_name : str, timestamp : PostTimestamp):
-    channel_states[channel_name][last_full_post_index] = timestamp.to_string()
-    channel_states.write()
+def post_state_changed(channel_name : str):
+    post_states_to_store.add(channel_name)
+    post_states_writer.schedule('channel_states')
 
-def time_has_passed_since_last_full_post(channel_name : str, timestamp):
-    post_time = PostTimestamp(timestamp.hour, timestamp.minute)
-    old_time = get_last_post_time(channel_name)
-    if post_time != old_time:
-        return True
-    else:
-        return False
+def init_pseudonymous_channel(channel_name : str):
+    post_states[channel_name] = PostState()
+    post_state_changed(channel_name)
 
-def increment_post_counter(channel_name : str):
-    count = int(channel_states[channel_name][post_counter_index])
-    count += 1
-    channel_states[channel_name][post_counter_index] = str(count)
-    channel_states.write()
-    return count >= 10
-
-def reset_post_counter(channel_name : str):
-    channel_states[channel_name][post_counter_index] = str(0)
-    channel_states.write()
+# Discord timestamps are naive datetimes in UTC
+def get_epoch_minute(timestamp : datetime.datetime):
+    return int((timestamp - datetime.datetime(1970, 1, 1)).total_seconds()) // 60
 
 # Returns True if the new post should be a full post (with sender and timestamp header)
 # Returns False if the new post should only include the content itself
-def record_new_post(channel_name : str, poster_id : str, timestamp : PostTimestamp):
-    last_poster = get_last_poster(channel_name)
-    time_has_passed = time_has_passed_since_last_full_post(channel_name, timestamp)
-    counter_has_passed_limit = increment_post_counter(channel_name)
-
-    if last_poster != poster_id or time_has_passed or counter_has_passed_limit:
-        set_last_poster(channel_name, poster_id)
-        set_last_full_post(channel_name, timestamp)
-        reset_post_counter(channel_name)
-        return True
-    else:
-        return False
+def record_new_post(channel_name : str, poster_id : str, timestamp : datetime.datetime):
+    state = get_post_state(channel_name)
+    post_minute = get_epoch_minute(timestamp)
+    state.post_counter += 1
+    full_post = (state.last_poster != poster_id
+        or state.last_full_post != post_minute
+        or state.post_counter >= max_posts_without_header)
+    if full_post:
+        state.last_poster = poster_id
+        state.last_full_post = post_minute
+        state.post_counter = 0
+    post_state_changed(channel_name)
+    return full_post
 
 
 ### Private channels:
@@ -418,7 +473,6 @@ async def get_all_groups_channels(channel_suffix : str=None):
     return [c for c in channel_list if is_group_channel(c, channel_suffix)]
 
 
-
 ### Chat channels:
 # These are weird: the "channel" is not the discord channel, but rather a name that can be used to fetch one or more channels
 # from the chats.py module
@@ -426,6 +480,7 @@ async def get_all_groups_channels(channel_suffix : str=None):
 def init_chat_channel(channel_name : str):
     channel_states[channel_name] = {}
     channel_states.write()
+    post_states.pop(channel_name, None)
     init_pseudonymous_channel(channel_name)
     ident = ChannelIdentifier(chat_channel_name=channel_name)
     set_channel_id(channel_name, ident)
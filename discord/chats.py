@@ -1,7 +1,6 @@
 import discord
 import asyncio
 import simplejson
-from configobj import ConfigObj
 from enum import Enum
 from discord.ext import commands
 
@@ -13,8 +12,11 @@ import server
 import posting
 import gm
 import game
+import storage
+import sequencer
+import startup
 from common import emoji_cancel, emoji_open, emoji_green, emoji_red, emoji_green_book, emoji_red_book, emoji_unread
-from custom_types import Handle, HandleTypes, PostTimestamp
+from custom_types import Handle, HandleTypes
 
 
 
@@ -160,12 +162,12 @@ class ChatsCog(commands.Cog, name='chats'):
 
 
 chats_dir = 'chats'
-chats = ConfigObj(f'{chats_dir}/chats.conf')
+chats = storage.get_conf(f'{chats_dir}/chats.conf')
 
 def setup(bot):
 	global chats
 	bot.add_cog(ChatsCog(bot))
-	chats = ConfigObj(f'{chats_dir}/chats.conf')
+	chats = storage.get_conf(f'{chats_dir}/chats.conf')
 
 channel_limit_per_actor = 5
 
@@ -176,6 +178,9 @@ chat_hub_msg_data_index = '___chat_hub_msg_data'
 chat_content_index = '___chat_content'
 chats_with_logs_index = '___chat_log_length'
 chat_participants_index = '___chat_participants'
+chat_log_segments_index = '___log_segments'
+# handle_id -> section with the names of all chats the handle takes part in
+handle_chats_index = '___handle_chats'
 
 session_status_active = '___active'
 session_status_inactive = '___inactive'
@@ -195,7 +200,8 @@ class ChatParticipant(object):
 		actor_id : str,
 		handle : str, # TODO: rename handle_id
 		chat_hub_msg_id : str,
-		channel_id : str=None):
+		channel_id : str=None,
+		dormant : bool=False):
 		self.chat_name = chat_name
 		self.session_status = session_status
 		# Regardless of whether the channel currently exists or not
@@ -206,11 +212,14 @@ class ChatParticipant(object):
 		self.chat_hub_msg_id = chat_hub_msg_id
 		# Set to None when the channel is temporarily closed
 		self.channel_id = channel_id
+		# Set when the session was closed by a restart, but the chat hub message has not been updated yet
+		self.dormant = dormant
 
 	@staticmethod
 	def from_string(string : str):
 		obj = ChatParticipant(None, None, None, None, None, None)
-		obj.__dict__ = simplejson.loads(string)
+		# Participants stored before 'dormant' existed keep its default
+		obj.__dict__.update(simplejson.loads(string))
 		return obj
 
 	def to_string(self):
@@ -255,6 +264,90 @@ class ChatLogEntry(object):
 	def to_string(self):
 		return simplejson.dumps(self.__dict__)
 
+# The chat history is kept in append-only segment logs, chats/<chat_name>.<segment>, separate from
+# the participants in chats/<chat_name>.conf. Each segment holds up to log_segment_size records.
+# Removing an entry appends a tombstone record instead of changing the log.
+# The index holds one position per entry: the offset of a stored record in its segment,
+# the record itself for entries written since the log was loaded, or None for removed entries.
+log_segment_size = 500
+log_tombstone_prefix = '{"removed": '
+
+class ChatLog(object):
+	def __init__(self, chat_name : str, num_segments : int):
+		self.chat_name = chat_name
+		self.num_segments = num_segments
+		self.positions = []
+		self.records_in_last_segment = 0
+
+	def get_segment_log_name(self, segment : int):
+		return f'{chats_dir}/{self.chat_name}.{segment}'
+
+	def load(self):
+		for segment in range(self.num_segments):
+			self.records_in_last_segment = 0
+			for (offset, record) in storage.read_records(self.get_segment_log_name(segment)):
+				self.records_in_last_segment += 1
+				if record.startswith(log_tombstone_prefix):
+					removed = simplejson.loads(record)['removed']
+					if removed == len(self.positions):
+						# A gap in the history moved over from before the segment logs (see append_gap)
+						self.positions.append(None)
+					else:
+						self.positions[removed] = None
+				else:
+					self.positions.append((segment, offset))
+
+	def length(self):
+		return len(self.positions)
+
+	def append_record(self, record : str):
+		if self.records_in_last_segment >= log_segment_size:
+			self.num_segments += 1
+			self.records_in_last_segment = 0
+			store_log_segments(self.chat_name, self.num_segments)
+		storage.append_record(self.get_segment_log_name(self.num_segments - 1), record)
+		self.records_in_last_segment += 1
+
+	def append(self, entry : ChatLogEntry):
+		record = entry.to_string()
+		self.append_record(record)
+		self.positions.append(record)
+
+	# Takes up the next index without an entry, so that later entries keep the index they already had
+	def append_gap(self):
+		self.append_record(f'{log_tombstone_prefix}{len(self.positions)}}}')
+		self.positions.append(None)
+
+	def remove(self, index : int):
+		if self.positions[index] is not None:
+			self.append_record(f'{log_tombstone_prefix}{index}}}')
+			self.positions[index] = None
+
+	# Yields (index, entry) for every entry that has not been removed, reading each segment at most once
+	def get_entries(self):
+		stored_records = {}
+		read_segments = set()
+		for index, position in enumerate(self.positions):
+			if position is None:
+				continue
+			if isinstance(position, str):
+				record = position
+			else:
+				segment = position[0]
+				if not segment in read_segments:
+					for (offset, stored) in storage.read_records(self.get_segment_log_name(segment)):
+						stored_records[(segment, offset)] = stored
+					read_segments.add(segment)
+				record = stored_records[position]
+			yield (index, ChatLogEntry.from_string(record))
+
+	def clear(self):
+		for segment in range(self.num_segments):
+			storage.clear_log(self.get_segment_log_name(segment))
+		self.num_segments = 1
+		self.positions = []
+		self.records_in_last_segment = 0
+
 # This represent everything in discord that can currently be used to interface with the chat:
 # - Channel for messages
 # - The chat hub message with open/close commands
@@ -283,17 +376,35 @@ class Activation(str, Enum):
 
 def init_chats_confobj():
 	global chats
-	chats = ConfigObj(f'{chats_dir}/chats.conf')
-	if not chat_channel_data_index in chats:
-		chats[chat_channel_data_index] = {}
-	if not chat_hub_msg_data_index in chats:
-		chats[chat_hub_msg_data_index] = {}
-	if not chats_with_logs_index in chats:
-		chats[chats_with_logs_index] = {}
-	chats.write()
+	chats = storage.get_conf(f'{chats_dir}/chats.conf')
+	missing_sections = [s for s in [chat_channel_data_index, chat_hub_msg_data_index, chats_with_logs_index] if not s in chats]
+	for section in missing_sections:
+		chats[section] = {}
+	if not handle_chats_index in chats:
+		build_handle_chats_index()
+		missing_sections.append(handle_chats_index)
+	if missing_sections:
+		chats.write()
+
+# Only needed once, for chats created before the index existed
+def build_handle_chats_index():
+	chats[handle_chats_index] = {}
+	for chat_name in chats[chats_with_logs_index]:
+		chat_state = get_chat_state(chat_name)
+		if chat_participants_index in chat_state:
+			for handle_id in chat_state[chat_participants_index]:
+				add_to_handle_chats_index(handle_id, chat_name)
+
+def add_to_handle_chats_index(handle_id : str, chat_name : str):
+	if not handle_id in chats[handle_chats_index]:
+		chats[handle_chats_index][handle_id] = {}
+	if not chat_name in chats[handle_chats_index][handle_id]:
+		chats[handle_chats_index][handle_id][chat_name] = ''
+		return True
+	return False
 
 def get_channel_budget():
-	return ConfigObj(f'{chats_dir}/channel_budget.conf')
+	return storage.get_conf(f'{chats_dir}/channel_budget.conf')
 
 
 def dump():
@@ -309,8 +420,8 @@ async def init(clear_all : bool=False):
 		chat_state = get_chat_state(chat_name)
 		if clear_all:
 			del chat_state[chat_participants_index]
-			del chat_state[chat_content_index]
 			chat_state.write()
+			clear_chat_log(chat_name)
 		else:
 			# Re-init the chats (posting-wise) like any open channel
 			channels.init_chat_channel(chat_name)
@@ -318,14 +429,15 @@ async def init(clear_all : bool=False):
 			if not chat_participants_index in chat_state:
 				init_chat_state(chat_state)
 			for participant in get_participants(chat_state):
-				# Close all chat sessions. If the discord and config files are still in sync,
-				# this will update all chat hub messages so that chats can be easily re-opened
-				await close_chat_session(chat_state, participant)
+				# Close all chat sessions, in the state only. The chat hub messages are updated
+				# the first time each session is used again, so restarts do not get slower with every chat
+				make_session_dormant(participant)
 	# Remove all channel mappings
 	chats[chat_channel_data_index] = {}
 	if clear_all:
 		chats[chat_hub_msg_data_index] = {}
 		chats[chats_with_logs_index] = {}
+		chats[handle_chats_index] = {}
 		channel_list = await channels.get_all_chat_hub_channels()
 		await asyncio.gather(
 			*[asyncio.create_task(c.purge())
@@ -342,6 +454,8 @@ async def init(clear_all : bool=False):
 
 	chats.write()
 
+startup.register('chats', lambda: init(), dependencies=['channels', 'actors'])
+
 
 def create_2party_chat_name(handle1 : Handle, handle2 : Handle):
 	handles_ordered = sorted([handle1.handle_id, handle2.handle_id])
@@ -349,7 +463,7 @@ def create_2party_chat_name(handle1 : Handle, handle2 : Handle):
 
 def read_chat_connection_from_channel(channel_id : str):
 	init_chats_confobj()
-	chats = ConfigObj(f'{chats_dir}/chats.conf')
+	chats = storage.get_conf(f'{chats_dir}/chats.conf')
 
 	if channel_id in chats[chat_channel_data_index]:
 		string = chats[chat_channel_data_index][channel_id]
@@ -398,14 +512,13 @@ def chat_exists(chat_name : str):
 
 def get_chat_state(chat_name : str):
 	chat_file_name = f'{chat_name}.conf'
-	return ConfigObj(f'{chats_dir}/{chat_file_name}')
+	return storage.get_conf(f'{chats_dir}/{chat_file_name}')
 
 def get_chats_for_handle(handle : Handle):
 	init_chats_confobj()
-	for msg_id in chats[chat_hub_msg_data_index]:
-		chat_connection : ChatConnectionMapping = read_chat_connection_from_hub_msg(msg_id)
-		if chat_connection.handle == handle.handle_id:
-			yield (chat_connection.chat_name, get_chat_state(chat_connection.chat_name))
+	chat_names = list(chats[handle_chats_index].get(handle.handle_id, {}))
+	for chat_name in chat_names:
+		yield (chat_name, get_chat_state(chat_name))
 
 def get_participants(chat_state):
 	for participant_id in chat_state[chat_participants_index]:
@@ -423,49 +536,61 @@ def store_participant(chat_name : str, participant : ChatParticipant):
 	chat_state = get_chat_state(chat_name)
 	chat_state[chat_participants_index][participant.handle] = participant.to_string()
 	chat_state.write()
-
-
-def get_log_length(chat_name : str):
 	init_chats_confobj()
-	return int(chats[chats_with_logs_index][chat_name])
-
-def increment_log_length(chat_name : str):
-	init_chats_confobj()
-	prev_length = int(chats[chats_with_logs_index][chat_name])
-	chats[chats_with_logs_index][chat_name] = str(prev_length + 1)
-	chats.write()
+	if add_to_handle_chats_index(participant.handle, chat_name):
+		chats.write()
 
-# TODO: move the chat log to a separate file, so that writing an entry
-# and opening/closing a sesson don't need to interfere
 
-def read_chat_log_entry(chat_state, index : int):
-	string = chat_state[chat_content_index][str(index)]
-	return ChatLogEntry.from_string(string)
+# Chat logs that have been loaded, by chat name
+chat_logs = {}
 
-def get_chat_log_iterable(chat_state, chat_name : str):
-	log_length = get_log_length(chat_name)
-	for index in range(log_length):
-		index_str = str(index)
-		if index_str in chat_state[chat_content_index]:
-			yield (index, read_chat_log_entry(chat_state, index))
+def get_chat_log(chat_name : str):
+	if not chat_name in chat_logs:
+		chat_state = get_chat_state(chat_name)
+		num_segments = 1
+		if chat_log_segments_index in chat_state:
+			num_segments = int(chat_state[chat_log_segments_index])
+		chat_log = ChatLog(chat_name, num_segments)
+		chat_log.load()
+		if chat_content_index in chat_state:
+			# Chat history from before the segment logs: move it into the log.
+			# Removed entries left gaps in the old indices; they become gaps in the log, so every index stays the same
+			legacy_content = chat_state[chat_content_index]
+			init_chats_confobj()
+			legacy_length = max([int(chats[chats_with_logs_index].get(chat_name, 0))] + [int(i) + 1 for i in legacy_content])
+			for index in range(legacy_length):
+				if str(index) in legacy_content:
+					chat_log.append(ChatLogEntry.from_string(legacy_content[str(index)]))
+				else:
+					chat_log.append_gap()
+			del chat_state[chat_content_index]
+			chat_state.write()
+		chat_logs[chat_name] = chat_log
+	return chat_logs[chat_name]
 
-def store_chat_log_entry(chat_name : str, index : int, entry : ChatLogEntry):
+def store_log_segments(chat_name : str, num_segments : int):
 	chat_state = get_chat_state(chat_name)
-	chat_state[chat_content_index][str(index)] = entry.to_string()
+	chat_state[chat_log_segments_index] = str(num_segments)
 	chat_state.write()
 
-def remove_entry_from_chat_log(chat_name : str, index : int):
-	# Re-read the log (minimize time between read and write)
+def clear_chat_log(chat_name : str):
+	get_chat_log(chat_name).clear()
 	chat_state = get_chat_state(chat_name)
-	index_str = str(index)
-	if index_str in chat_state[chat_content_index]:
-		del chat_state[chat_content_index][index_str]
+	if chat_log_segments_index in chat_state:
+		del chat_state[chat_log_segments_index]
 		chat_state.write()
 
+def get_log_length(chat_name : str):
+	return get_chat_log(chat_name).length()
+
+def get_chat_log_iterable(chat_state, chat_name : str):
+	return get_chat_log(chat_name).get_entries()
+
+def remove_entry_from_chat_log(chat_name : str, index : int):
+	get_chat_log(chat_name).remove(index)
+
 def write_new_chat_log_entry(chat_name : str, entry : ChatLogEntry):
-	next_index = get_log_length(chat_name)
-	store_chat_log_entry(chat_name, next_index, entry)
-	increment_log_length(chat_name)
+	get_chat_log(chat_name).append(entry)
 
 def get_participant_handle_ids(channel):
 	chat_channel_data : ChatConnectionMapping = read_chat_connection_from_channel(str(channel.id))
@@ -479,6 +604,7 @@ def get_participant_handle_ids(channel):
 def init_chat_log(chat_name : str):
 	init_chats_confobj()
 	if not chat_name in chats[chats_with_logs_index]:
+		# This section is the registry of all chats; the log length itself comes from the chat log
 		chats[chats_with_logs_index][chat_name] = 0
 		chats.write()
 		chat_state = get_chat_state(chat_name)
@@ -490,16 +616,10 @@ def init_chat_log(chat_name : str):
 def init_chat_state(chat_state):
 	if not chat_participants_index in chat_state:
 		chat_state[chat_participants_index] = {}
-		chat_state[chat_content_index] = {}
 		chat_state.write()
 	else:
 		print(f'Overwriting existing chat log file - the record did not indicate that chat {chat_state.filename} would exist.')
 
-def get_chat_log_length(chat_name):
-	init_chats_confobj()
-	return int(chats[chats_with_logs_index][chat_name])
-
-
 ### The channel budget
 
 def try_to_add_active_chat(actor_id : str):
@@ -529,6 +649,27 @@ def decrease_num_active_chats(actor_id : str):
 		chat_channel_budget.write()
 
 
+### Dormant sessions
+# At startup, all open sessions are closed since their discord channels are deleted. Instead of
+# updating the chat hub message of every session right away, the sessions are marked as dormant.
+# A dormant session is rehydrated the first time it is used: when the participant reacts to its
+# chat hub message, or when a message arrives in the chat. Rehydrating updates the chat hub
+# message, and re-creates the channel if the session is opened.
+
+def make_session_dormant(participant : ChatParticipant):
+	if participant.session_status == session_status_active:
+		participant.session_status = session_status_inactive
+		entry = ChatLogEntry(None, closed_handle_id=participant.handle)
+		write_new_chat_log_entry(participant.chat_name, entry)
+	elif participant.session_status == session_status_open_archive:
+		participant.session_status = session_status_closed_archive
+	else:
+		return
+	participant.channel_id = None
+	participant.dormant = True
+	store_participant(participant.chat_name, participant)
+
+
 ### Creating a new chat
 
 async def create_chat_from_command(user_id : str, partner_handle_id : str):
@@ -710,8 +851,9 @@ async def get_chat_ui_for_inactive_session(guild, chat_state, participant : Chat
 			store_chat_connection_for_channel(participant.channel_id, chat_connection)
 			status_change = True
 
-	chat_hub_message = await update_chat_hub_message(guild, channel, participant, has_changed=status_change)
+	chat_hub_message = await update_chat_hub_message(guild, channel, participant, has_changed=status_change or participant.dormant)
 	participant.chat_hub_msg_id = str(chat_hub_message.id)
+	participant.dormant = False
 
 	# chat -> actor, channel ID, msg ID mapping
 	# 'participant' may have been updated: 
@@ -879,6 +1021,9 @@ async def process_reaction_in_chat_hub(message, emoji : str):
 		if not success:
 			warning = f'Cannot open {chat_connection.chat_name} -- you have too many open chats! Close one before opening another.'
 			await message.channel.send(content = warning, delete_after=6)
+	elif participant.dormant:
+		# The session was already closed by a restart; just bring the chat hub message up to date
+		await get_chat_ui(server.get_guild(), chat_state, participant)
 	return None
 
 
@@ -1038,7 +1183,7 @@ async def update_other_participant_after_archiving(
 
 ### Messages in chat
 
-async def post_to_participant(guild, chat_state, message, participant : ChatParticipant, poster_id : str, full_post : bool):
+async def post_to_participant(guild, chat_state, message, participant : ChatParticipant, poster_id : str, full_post : bool, attachments):
 	if participant.session_status != session_status_active:
 		# A new channel may be created => we should always include the full header on the first message
 		full_post = True
@@ -1050,8 +1195,8 @@ async def post_to_participant(guild, chat_state, message, participant : ChatPart
 			print(f'Failed to reach participant of chat. Dump: {participant.to_string()}')
 		else:
 			# Send the message to the open channel
-			poster_id = poster_id if full_post else None
-			await posting.repost_message_to_channel(chat_ui.channel, message, poster_id)
+			sender = poster_id if full_post else None
+			await posting.repost_message_to_channel(chat_ui.channel, message, sender, author=poster_id, attachments=attachments)
 	elif chat_ui.session_status == session_status_inactive:
 		# The channel was not opened when requested -- recipient must be at their chat session limit
 		participant.session_status = session_status_unread
@@ -1069,10 +1214,19 @@ async def post_to_participant(guild, chat_state, message, participant : ChatPart
 		raise RuntimeError(f'Unexpected case! Dump: {participant.to_string()}, {chat_ui.session_status}')
 
 
-def create_reposting_tasks(guild, chat_name : str, message, poster_id : str, full_post : bool):
+def create_reposting_tasks(guild, chat_name : str, message, poster_id : str, full_post : bool, attachments):
 	chat_state = get_chat_state(chat_name)
 	for participant in get_participants(chat_state):
-		yield asyncio.create_task(post_to_participant(guild, chat_state, message, participant, poster_id, full_post))
+		yield asyncio.create_task(post_to_participant(guild, chat_state, message, participant, poster_id, full_post, attachments))
+
+async def repost_to_participants(guild, chat_name : str, message, poster_id : str, full_post : bool):
+	# Each attachment is downloaded once and shared by the reposts to all participants
+	async with posting.AttachmentBuffer(message.attachments) as attachments:
+		await asyncio.gather(*create_reposting_tasks(guild, chat_name, message, poster_id, full_post, attachments))
+
+# Messages in each chat are reposted (and logged) one at a time, in the order they arrived,
+# while different chats are processed concurrently
+chat_sequencer = sequencer.Sequencer('chat reposts')
 
 async def process_message(message):
 	task1 = asyncio.create_task(message.delete())
@@ -1083,21 +1237,20 @@ async def process_message(message):
 		return
 	poster_id = chat_channel_data.handle
 	chat_name = chat_channel_data.chat_name
+	task2 = chat_sequencer.submit(chat_name, repost_chat_message(message, chat_name, poster_id))
 
-	# With timestamps from discord, we must apply the DST diff compared to the python env timestamps
-	post_time = PostTimestamp.from_datetime(message.created_at, dst_diff=2)
-	full_post = channels.record_new_post(chat_channel_data.chat_name, poster_id, post_time)
-	guild = server.get_guild()
-	tasks = create_reposting_tasks(guild, chat_name, message, poster_id, full_post)
+	await asyncio.gather(task1, task2)
 
-	await asyncio.gather(task1, *tasks)
+async def repost_chat_message(message, chat_name : str, poster_id : str):
+	full_post = channels.record_new_post(chat_name, poster_id, message.created_at)
+	guild = server.get_guild()
+	await repost_to_participants(guild, chat_name, message, poster_id, full_post)
 
 	# Write to the persistent log:
 	# TODO: also add header if it is the first message after someone disconnected
 	poster_id = poster_id if full_post else None
 	post = posting.create_post(message, poster_id, attachments_supported=False)
 	entry = ChatLogEntry(post, full_post)
-	chat_state = get_chat_state(chat_name)
 	write_new_chat_log_entry(chat_name, entry)
 
 async def repost_string_buffer(channel, string_buffer : str):
@@ -78,7 +78,6 @@ class Transaction(object):
 		report : str=None,
 		timestamp : PostTimestamp=None, # TODO: add timestamp for regular payments 
 		success : bool=False,
-		last_in_sequence : bool=True,
 		payer_msg_id : str=None,
 		recip_msg_id : str=None,
 		data : str=None,
@@ -93,7 +92,6 @@ class Transaction(object):
 		self.report = report
 		self.timestamp = timestamp
 		self.success = success
-		self.last_in_sequence = last_in_sequence
 		self.data = data
 		self.emoji = emoji
 		self.payer_msg_id = payer_msg_id
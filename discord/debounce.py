@@ -0,0 +1,64 @@
+import asyncio
+
+### Module debounce.py
+# Coalescing of repeated updates of the same thing, e.g. the financial statement of an actor.
+# Scheduling a key starts a timer; further schedules of the same key within the window
+# are merged into the same run. The callback (an async function taking the key) thus runs
+# at most once per window and key, and never twice at the same time for the same key.
+
+# All debouncers, so that they can be flushed before shutting down
+all_debouncers = []
+
+class Debouncer(object):
+	def __init__(self, name : str, window : float, callback):
+		self.name = name
+		self.window = window
+		self.callback = callback
+		# key -> task waiting for the window to pass
+		self.pending = {}
+		self.running = {}
+		all_debouncers.append(self)
+
+	def schedule(self, key):
+		if not key in self.pending:
+			self.pending[key] = asyncio.create_task(self.run_later(key))
+
+	def is_pending(self, key):
+		return key in self.pending
+
+	async def run_later(self, key):
+		await asyncio.sleep(self.window)
+		del self.pending[key]
+		await self.run(key)
+
+	# Runs the callback now instead of waiting for the window to pass.
+	# A run that has already started is always waited for, so everything scheduled before is done on return.
+	async def flush(self, key):
+		task = self.pending.pop(key, None)
+		if task is not None:
+			task.cancel()
+			await self.run(key)
+		elif key in self.running:
+			async with self.running[key]:
+				pass
+
+	async def run(self, key):
+		if not key in self.running:
+			self.running[key] = asyncio.Lock()
+		async with self.running[key]:
+			try:
+				await self.callback(key)
+			except Exception as e:
+				print(f'Error: {self.name} update for {key} failed: {e}')
+
+	async def flush_all(self):
+		await asyncio.gather(*[self.flush(key) for key in set(self.pending).union(self.running)])
+
+# Runs everything that is waiting in any debouncer. A run may schedule updates in another debouncer
+# (e.g. an order change updates the order board), so this is repeated until nothing is left.
+async def flush_all(max_rounds : int=5):
+	for _ in range(max_rounds):
+		if not any(len(debouncer.pending) > 0 for debouncer in all_debouncers):
+			return
+		for debouncer in all_debouncers:
+			await debouncer.flush_all()
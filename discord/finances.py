@@ -3,11 +3,12 @@ import handles
 import actors
 import players
 import server
+import ledger
+import startup
 from custom_types import Transaction, TransTypes, Handle, HandleTypes, PostTimestamp
 from common import coin, transaction_collector, transaction_collected
 
 from discord.ext import commands
-from configobj import ConfigObj
 from copy import deepcopy
 import asyncio
 import simplejson
@@ -190,11 +191,6 @@ class InternalTransRecord(object):
 
 # TODO: BITCOIN BITCOIN BITCOIN!!!
 
-finances_conf_dir = 'finances'
-balance_index = '___balance'
-transactions_index = '___transactions'
-highest_transaction_index = '___highest'
-
 system_fake_handle = '[system]'
 
 def init_finances():
@@ -202,27 +198,15 @@ def init_finances():
         if can_have_finances(handle.handle_type):
             init_finances_for_handle(handle, overwrite=False)
 
+startup.register('finances', init_finances, dependencies=['handles', 'actors', 'ledger'])
+
 def init_finances_for_handle(handle : Handle, overwrite : bool=True):
-    file_name = f'{finances_conf_dir}/{handle.handle_id}.conf'
-    finances_conf = ConfigObj(file_name)
-    if not finances_conf or overwrite:
-        for entry in finances_conf:
-            del finances_conf[entry]
-    if balance_index not in finances_conf:
-        finances_conf[balance_index] = '0'
-    if transactions_index not in finances_conf:
-        finances_conf[transactions_index] = {}
-    if highest_transaction_index not in finances_conf[transactions_index]:
-        finances_conf[transactions_index][highest_transaction_index] = '0'
-    finances_conf.write()
+    if overwrite or not ledger.has_account(handle.handle_id):
+        ledger.open_account(handle.handle_id)
 
 async def deinit_finances_for_handle(handle : Handle, record : bool):
-    file_name = f'{finances_conf_dir}/{handle.handle_id}.conf'
-    finances_conf = ConfigObj(file_name)
-    if finances_conf:
-        for entry in finances_conf:
-            del finances_conf[entry]
-        finances_conf.write()
+    if ledger.has_account(handle.handle_id):
+        ledger.close_account(handle.handle_id)
     if record:
         await actors.refresh_financial_statement(handle.actor_id)
 
@@ -230,28 +214,17 @@ def get_current_balance(handle : Handle):
     return get_current_balance_handle_id(handle.handle_id)
 
 def get_current_balance_handle_id(handle_id : str):
-    file_name = f'{finances_conf_dir}/{handle_id}.conf'
-    finances_conf = ConfigObj(file_name)
-    return int(finances_conf[balance_index])
+    return ledger.get_balance(handle_id)
 
 def set_current_balance(handle : Handle, balance : int):
     set_current_balance_handle_id(handle.handle_id, balance)
 
 def set_current_balance_handle_id(handle_id : str, balance : int):
-    file_name = f'{finances_conf_dir}/{handle_id}.conf'
-    finances_conf = ConfigObj(file_name)
-    finances_conf[balance_index] = str(balance)
-    finances_conf.write()
+    ledger.set_balance(handle_id, balance)
 
 
 def add_internal_record(handle_id : str, record : InternalTransRecord):
-    file_name = f'{finances_conf_dir}/{handle_id}.conf'
-    finances_conf = ConfigObj(file_name)
-    prev_highest = int(finances_conf[transactions_index][highest_transaction_index])
-    new_index = str(prev_highest + 1)
-    finances_conf[transactions_index][highest_transaction_index] = new_index
-    finances_conf[transactions_index][new_index] = record.to_string()
-    finances_conf.write()
+    ledger.add_record(handle_id, record.to_string())
 
 async def overwrite_balance(handle : Handle, balance : int):
     old_balance = get_current_balance(handle)
@@ -314,12 +287,12 @@ def get_all_handles_balance_report(actor_id : str):
     return report
 
 def transfer_funds_if_available(transaction : Transaction):
+    if not ledger.has_account(transaction.recip):
+        transaction.success = False
+        return
     avail_at_payer = get_current_balance_handle_id(transaction.payer)
     if avail_at_payer >= transaction.amount:
-        amount_at_recip = get_current_balance_handle_id(transaction.recip)
-        set_current_balance_handle_id(transaction.recip, amount_at_recip + transaction.amount)
-        set_current_balance_handle_id(transaction.payer, avail_at_payer - transaction.amount)
-        transaction.success = True
+        transaction.success = ledger.transfer(transaction.payer, transaction.recip, transaction.amount)
     else:
         transaction.success = False
     #return transaction
@@ -370,7 +343,6 @@ async def collect_all_funds(actor_id : str):
             else:
                 transaction.amount = collected
                 transaction.payer = handle.handle_id
-                transaction.last_in_sequence = False
                 await record_transaction(transaction)
     set_current_balance(current_handle, total)
     transaction.payer_actor = None
@@ -378,7 +350,6 @@ async def collect_all_funds(actor_id : str):
     transaction.amount = total - balance_on_current
     transaction.payer = transaction_collected
     transaction.recip = current_handle.handle_id
-    transaction.last_in_sequence = True
     await record_transaction(transaction)
     return 'Done.'
 
@@ -454,6 +425,11 @@ async def try_to_pay(transaction : Transaction, from_reaction : bool=False):
         transaction.recip_actor = recip_actor
         transaction.amount = -transaction.amount
 
+    for handle_id in [transaction.payer, transaction.recip]:
+        if not ledger.has_account(handle_id):
+            if not from_reaction:
+                transaction.report = f'Error: cannot transfer funds between {transaction.payer} and {transaction.recip}; {handle_id} has no account.'
+            return transaction
 
     transfer_funds_if_available(transaction)
     if not transaction.success:
@@ -10,6 +10,7 @@ import player_setup
 import server
 import handles
 import chats
+import startup
 from common import gm_announcements_name
 
 #Game-wide state. Only put general info here; anything specific should go in players / shops / groups / scenarios etc.
@@ -72,6 +73,8 @@ def init():
 		reserved_handles.add(handle)
 	# TODO: purge landig page, send welcome message
 
+startup.register('game', init)
+
 def is_out_of_game_chat(channel):
 	for handle in chats.get_participant_handle_ids(channel):
 		if is_out_of_game_handle(handle):
@@ -7,6 +7,8 @@ import artifacts
 import channels
 import server
 import handles
+import locks
+import startup
 
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -110,13 +112,12 @@ class GmCog(commands.Cog, name=gm_role_name):
 		allowed = await channels.pre_process_command(ctx)
 		if not allowed:
 			return
-		sem_id = await handles.get_semaphore('init_gm')
-		if sem_id is None:
+		try:
+			async with handles.lock_handles():
+				await init(clear_all=True)
+				await ctx.send('Done.')
+		except locks.LockTimeout:
 			await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
-		else:
-			await init(clear_all=True)
-			await ctx.send('Done.')
-			handles.return_semaphore(sem_id)
 
 
 def setup(bot):
@@ -129,6 +130,8 @@ async def init(clear_all : bool=False):
 	if not exists or clear_all:
 		await create_gm_actor()
 
+startup.register('gm', lambda: init(), dependencies=['chats', 'groups', 'finances', 'shops'])
+
 async def create_gm_actor():
 	actor : actors.Actor = await actors.create_gm_actor(
 		server.get_guild(),
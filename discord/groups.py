@@ -7,8 +7,6 @@
 # and "finance and chat capabilities", which only players and shops have
 # (this would avoid the double-implementation of access roles that currently exists between groups and actors)
 
-import discord
-import asyncio
 import simplejson
 
 from configobj import ConfigObj
@@ -23,6 +21,7 @@ import actors
 import server
 import players
 import handles
+import startup
 
 from common import emoji_alert, emoji_accept, group_role_start, highest_ever_index
 from custom_types import ActionResult, Handle, HandleTypes
@@ -84,8 +83,7 @@ class Group(object):
 		await server.remove_role_from_member(member, role)
 
 	def get_role(self):
-		guild = server.get_guild()
-		return discord.utils.find(lambda role: role.name == self.group_index, guild.roles)
+		return server.get_role(self.group_index)
 
 	@staticmethod
 	def exists(group_name : str):
@@ -127,6 +125,8 @@ async def init(guild, clear_all=False):
 		groups.write()
 	
 
+startup.register('groups', lambda: init(server.get_guild()), dependencies=['channels'])
+
 async def clear_group(guild, group_id : str, spare_used : bool):
 	if Group.exists(group_id):
 		group = Group.read(group_id)
@@ -143,16 +143,10 @@ async def clear_group(guild, group_id : str, spare_used : bool):
 		return f'Could not find group {group_id}'
 
 async def delete_all_group_roles(guild, spare_used : bool):
-	task_list = (asyncio.create_task(delete_if_group_role(r, spare_used)) for r in guild.roles)
-	await asyncio.gather(*task_list)
-
-async def delete_if_group_role(role, spare_used : bool):
-	if await is_group_role(role.name):
-		if not spare_used or len(role.members) == 0:
-			await role.delete()
-
-async def is_group_role(name :str):
-	return common.is_group_role(name)
+	await server.delete_roles(
+		[r for r in guild.roles
+		if common.is_group_role(r.name) and (not spare_used or len(r.members) == 0)]
+		)
 
 def get_group_role(group_id : str):
 	group = Group.read(group_id)
@@ -213,6 +207,7 @@ async def create_new_group(guild, group_name : str, initial_members : List[str]
 
 	# Create role for this group:
 	role = await guild.create_role(name=group_index)
+	server.add_role(role)
 
 	# Create channel for the group:
 	channel_id = None
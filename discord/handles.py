@@ -6,22 +6,23 @@ import server
 #import player_setup
 import channels
 import game
+import storage
+import locks
+import startup
 from common import forbidden_content, forbidden_content_print, coin
 from custom_types import Handle, HandleTypes, ActionResult
 
 from discord.ext import commands
-from configobj import ConfigObj
 from typing import List
 from enum import Enum
-import random
+from copy import copy
 import re
-import asyncio
 
 ### Module handles.py
 # This module tracks and handles state related to handles, e.g. in-game names/accounts that
 # players can create.
 
-# TODO: use the same semaphore for handles and .join
+# TODO: use the same lock for handles and .join
 
 class HandlesCog(commands.Cog, name='handles'):
     '''Commands related to handles. 
@@ -57,7 +58,7 @@ class HandlesCog(commands.Cog, name='handles'):
         if not allowed:
             return
         # Note: this command may edit handles but may also be read-only.
-        # The below function will claim handles semaphore if editing is required.
+        # The below function will claim the handles lock if editing is required.
         response = await process_handle_command(ctx, new_handle, burner=burner)
         await self.send_command_response(ctx, response)
 
@@ -84,11 +85,11 @@ class HandlesCog(commands.Cog, name='handles'):
         allowed = await channels.pre_process_command(ctx, allow_chat_hub=False)
         if not allowed:
             return
-        sem_id = await get_semaphore(f'burning_{burner_name}')
-        if sem_id is None:
-            return 'Failed: system is too busy. Wait a few minutes and try again.'
-        response = await process_burn_command(ctx, burner_name)
-        return_semaphore(sem_id)
+        try:
+            async with lock_handles():
+                response = await process_burn_command(ctx, burner_name)
+        except locks.LockTimeout:
+            response = 'Failed: system is too busy. Wait a few minutes and try again.'
         await self.send_command_response(ctx, response)
 
     async def send_command_response(self, ctx, response : str):
@@ -109,12 +110,13 @@ class HandlesCog(commands.Cog, name='handles'):
         allowed = await channels.pre_process_command(ctx)
         if not allowed:
             return
-        sem_id = await get_semaphore('clear_all_handles')
-        if sem_id is None:
-            return 'Failed: system is too busy. Wait a few minutes and try again.'
-        await clear_all_handles()
-        await actors.init(ctx.guild, clear_all=False)
-        return_semaphore(sem_id)
+        try:
+            async with lock_handles():
+                await clear_all_handles()
+                await actors.init(ctx.guild, clear_all=False)
+        except locks.LockTimeout:
+            await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
+            return
         await ctx.send('Done.')
 
     @commands.command(
@@ -128,44 +130,24 @@ class HandlesCog(commands.Cog, name='handles'):
         allowed = await channels.pre_process_command(ctx)
         if not allowed:
             return
-        sem_id = await get_semaphore(f'removing_{handle_id}')
-        if sem_id is None:
-            return 'Failed: system is too busy. Wait a few minutes and try again.'
-        report = await process_remove_handle_command(ctx, handle_id)
-        return_semaphore(sem_id)
+        try:
+            async with lock_handles():
+                report = await process_remove_handle_command(ctx, handle_id)
+        except locks.LockTimeout:
+            report = 'Failed: system is too busy. Wait a few minutes and try again.'
         await self.send_command_response(ctx, report)
 
 def setup(bot):
     bot.add_cog(HandlesCog(bot))
 
 
-handles_semaphore = None
-
-async def get_semaphore(user_id : str):
-    global handles_semaphore
-    sem_id = user_id + '_' + str(random.randrange(10000))
-    number_iterations = 0
-    while True:
-        if handles_semaphore is None:
-            handles_semaphore = sem_id
-            await asyncio.sleep(0.5)
-            if handles_semaphore == sem_id:
-                break
-        await asyncio.sleep(0.5)
-        number_iterations += 1
-        if number_iterations > 120:
-            print(f'Error: semaphore probably stuck! Resetting semaphore for {sem_id}.')
-            handles_semaphore = None
-            return None
-    return sem_id
-
-def return_semaphore(sem_id : str):
-    global handles_semaphore
-    if handles_semaphore == sem_id:
-        handles_semaphore = None
-    else:
-        print(f'Semaphore error for \"handle edit\": tried to return semaphore for {sem_id} but it was already free!')
+# All edits of handles are done one at a time, like they always were.
+# Use as "async with handles.lock_handles():"; raises locks.LockTimeout if the system is too busy.
+handles_lock = locks.KeyedLocks('handles')
+handles_lock_key = 'handles'
 
+def lock_handles():
+    return handles_lock.hold(handles_lock_key)
 
 
 # 'handles' is the config object holding each user's current handles.
@@ -181,8 +163,23 @@ last_regular_index = '___last_regular'
 handles_index = '___all_handles'
 
 
+# In-memory index of all handles of all actors (including burnt ones): handle_id -> Handle
+# Built from the actor conf files on first use, and kept in sync by every function that changes a handle.
+handle_index = None
+
+def get_handle_index():
+    global handle_index
+    if handle_index is None:
+        handle_index = {}
+        handles = get_handles_confobj()
+        for actor_id in handles[actors_index]:
+            actor_handles_conf = storage.get_conf(f'{handles_conf_dir}/{actor_id}.conf')
+            for handle_id in actor_handles_conf[handles_index]:
+                handle_index[handle_id] = Handle.from_string(actor_handles_conf[handles_index][handle_id])
+    return handle_index
+
 def get_handles_confobj():
-    handles = ConfigObj(handles_conf_dir + '/__handles.conf')
+    handles = storage.get_conf(handles_conf_dir + '/__handles.conf')
     if not handles_to_actors in handles:
         handles[handles_to_actors] = {}
         handles.write()
@@ -224,6 +221,8 @@ async def init(clear_all : bool=False):
     if clear_all:
         await clear_all_handles()
 
+startup.register('handles', lambda: init(), dependencies=['server', 'storage'])
+
 async def clear_all_handles():
     handles = get_handles_confobj()
     for actor_id in handles[actors_index]:
@@ -231,6 +230,7 @@ async def clear_all_handles():
     handles[actors_index] = {}
     handles[handles_to_actors] = {}
     handles.write()
+    get_handle_index().clear()
 
 async def clear_all_handles_for_actor(actor_id : str):
     handles = get_handles_confobj()
@@ -247,8 +247,9 @@ async def clear_handle(handle : Handle):
     if handle.handle_id in handles[handles_to_actors]:
         del handles[handles_to_actors][handle.handle_id]
         handles.write()
+        get_handle_index().pop(handle.handle_id, None)
         file_name = f'{handles_conf_dir}/{handle.actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
         if handles_index in actor_handles_conf:
             if handle.handle_id in actor_handles_conf[handles_index]:
                 del actor_handles_conf[handles_index][handle.handle_id]
@@ -263,7 +264,10 @@ async def init_handles_for_actor(actor_id : str, first_handle : str=None, overwr
         handles[actors_index][actor_id] = {}
         handles.write()
         file_name = f'{handles_conf_dir}/{actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
+        if handles_index in actor_handles_conf:
+            for handle_id in actor_handles_conf[handles_index]:
+                get_handle_index().pop(handle_id, None)
         for entry in actor_handles_conf:
             del actor_handles_conf[entry]
         actor_handles_conf[handles_index] = {}
@@ -278,9 +282,10 @@ def store_handle(handle : Handle):
     handles.write()
 
     file_name = f'{handles_conf_dir}/{handle.actor_id}.conf'
-    actor_handles_conf = ConfigObj(file_name)
+    actor_handles_conf = storage.get_conf(file_name)
     actor_handles_conf[handles_index][handle.handle_id] = handle.to_string()
     actor_handles_conf.write()
+    get_handle_index()[handle.handle_id] = copy(handle)
 
 
 async def create_handle(actor_id : str, handle_id : str, handle_type : HandleTypes, force_reserved : bool=False):
@@ -300,16 +305,15 @@ async def create_handle(actor_id : str, handle_id : str, handle_type : HandleTyp
     return handle
 
 
-def read_handle(actor_handles, handle_id : str):
-    handles = get_handles_confobj()
+def read_handle(handle_id : str):
     # Unprotected -- only use for handles that you know exist
-    return Handle.from_string(actor_handles[handles_index][handle_id])
+    return copy(get_handle_index()[handle_id])
 
 def get_active_handle_id(actor_id : str):
     handles = get_handles_confobj()
     if actor_id in handles[actors_index]:
         file_name = f'{handles_conf_dir}/{actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
         if active_index in actor_handles_conf:
             return actor_handles_conf[active_index]
             
@@ -317,18 +321,18 @@ def get_active_handle(actor_id : str):
     handles = get_handles_confobj()
     if actor_id in handles[actors_index]:
         file_name = f'{handles_conf_dir}/{actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
         if active_index in actor_handles_conf:
             active_id = actor_handles_conf[active_index]
             if active_id in actor_handles_conf[handles_index]:
-                handle = read_handle(actor_handles_conf, active_id)
+                handle = read_handle(active_id)
                 return handle
 
 def get_last_regular_id(actor_id : str):
     handles = get_handles_confobj()
     if actor_id in handles[actors_index]:
         file_name = f'{handles_conf_dir}/{actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
         if last_regular_index in actor_handles_conf:
             return actor_handles_conf[last_regular_index]
 
@@ -336,11 +340,11 @@ def get_last_regular(actor_id : str):
     handles = get_handles_confobj()
     if actor_id in handles[actors_index]:
         file_name = f'{handles_conf_dir}/{actor_id}.conf'
-        actor_handles_conf = ConfigObj(file_name)
+        actor_handles_conf = storage.get_conf(file_name)
         if last_regular_index in actor_handles_conf:
             last_regular_id = actor_handles_conf[last_regular_index]
             if last_regular_id in actor_handles_conf[handles_index]:
-                return read_handle(actor_handles_conf, last_regular_id)
+                return read_handle(last_regular_id)
 
 
 def get_all_handles():
@@ -352,16 +356,14 @@ def get_all_handles():
 
 def get_handle(handle_name : str):
     handle_id = handle_name.lower()
-    handles = get_handles_confobj()
-    for actor_id in handles[actors_index]:
-        for handle in get_handles_for_actor(actor_id, include_burnt=True):
-            if handle.handle_id == handle_id:
-                return handle
-    return Handle(handle_id, handle_type=HandleTypes.Unused)
+    handle = get_handle_index().get(handle_id)
+    if handle is None:
+        return Handle(handle_id, handle_type=HandleTypes.Unused)
+    return copy(handle)
 
 def switch_to_handle(handle : Handle):
     file_name = f'{handles_conf_dir}/{handle.actor_id}.conf'
-    actor_handles_conf = ConfigObj(file_name)
+    actor_handles_conf = storage.get_conf(file_name)
     actor_handles_conf[active_index] = handle.handle_id
     if handle.handle_type == HandleTypes.Regular:
         actor_handles_conf[last_regular_index] = handle.handle_id
@@ -377,9 +379,9 @@ def get_handles_for_actor(actor_id : str, include_burnt : bool=False, include_np
 
 def get_handles_for_actor_of_types(actor_id : str, types_list : List[HandleTypes]):
     file_name = f'{handles_conf_dir}/{actor_id}.conf'
-    actor_handles_conf = ConfigObj(file_name)
+    actor_handles_conf = storage.get_conf(file_name)
     for handle_id in actor_handles_conf[handles_index]:
-        handle = read_handle(actor_handles_conf, handle_id)
+        handle = read_handle(handle_id)
         if handle.handle_type in types_list:
             yield handle
 
@@ -524,31 +526,35 @@ async def process_handle_command(ctx, new_handle_id : str=None, burner : bool=Fa
             response += ' To create a new burner, use \".burner <new_name>\".'
     else:
         # Entry point for possibly editing handles:
-        sem_id = await get_semaphore(f'switching_to_{new_handle_id}')
-        if sem_id is None:
+        try:
+            async with lock_handles():
+                response = await process_handle_switch(actor_id, new_handle_id, burner, npc)
+        except locks.LockTimeout:
             return 'Failed: system is too busy. Wait a few minutes and try again.'
 
-        existing_handle : Handle = get_handle(new_handle_id)
-        handle_type = HandleTypes.Regular
-        if burner:
-            handle_type = HandleTypes.Burner
-        elif npc:
-            handle_type = HandleTypes.NPC
-
-        if existing_handle.handle_type != HandleTypes.Unused:
-            if existing_handle.actor_id == actor_id:
-                response = switch_to_own_existing_handle(actor_id, existing_handle, handle_type)
-            elif existing_handle.handle_id != new_handle_id:
-                response = f'Error: cannot create handle {new_handle_id} because its internal ID ({existing_handle.handle_id}) clashes with an existing handle.'
-            else:
-                response = f'Error: the handle {new_handle_id} not available.'
-        else:
-            result = await create_handle_and_switch(actor_id, new_handle_id, handle_type)
-            response = result.report
-        if existing_handle.handle_id != new_handle_id:
-            response += f'\nNote that handles are lowercase only: {new_handle_id} -> **{existing_handle.handle_id}**.'
-        return_semaphore(sem_id)
+    return response
+
+
+async def process_handle_switch(actor_id : str, new_handle_id : str, burner : bool, npc : bool):
+    existing_handle : Handle = get_handle(new_handle_id)
+    handle_type = HandleTypes.Regular
+    if burner:
+        handle_type = HandleTypes.Burner
+    elif npc:
+        handle_type = HandleTypes.NPC
 
+    if existing_handle.handle_type != HandleTypes.Unused:
+        if existing_handle.actor_id == actor_id:
+            response = switch_to_own_existing_handle(actor_id, existing_handle, handle_type)
+        elif existing_handle.handle_id != new_handle_id:
+            response = f'Error: cannot create handle {new_handle_id} because its internal ID ({existing_handle.handle_id}) clashes with an existing handle.'
+        else:
+            response = f'Error: the handle {new_handle_id} not available.'
+    else:
+        result = await create_handle_and_switch(actor_id, new_handle_id, handle_type)
+        response = result.report
+    if existing_handle.handle_id != new_handle_id:
+        response += f'\nNote that handles are lowercase only: {new_handle_id} -> **{existing_handle.handle_id}**.'
     return response
 
 
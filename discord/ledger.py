@@ -0,0 +1,142 @@
+import simplejson
+
+import storage
+import startup
+
+### Module ledger.py
+# This module keeps the append-only ledger of all changes to the finances of handles.
+# Every change (opening or closing an account, setting a balance, a transfer, a transaction record)
+# is one line of JSON appended to the ledger, so a payment costs a single append.
+# The current balances are only kept in memory. At startup they are rebuilt from the latest
+# snapshot, followed by replaying the ledger records written after it.
+# A new snapshot is stored every snapshot_interval records.
+
+ledger_log = 'finances/__ledger'
+snapshot_file = 'finances/__ledger_snapshot.conf'
+snapshot_interval = 1000
+
+snapshot_balances_index = '___balances'
+snapshot_record_counts_index = '___record_counts'
+snapshot_position_index = '___position'
+
+# Before the ledger, each handle had its own finances/<handle>.conf
+legacy_balance_index = '___balance'
+legacy_transactions_index = '___transactions'
+legacy_highest_transaction_index = '___highest'
+
+# handle_id -> current balance, for every handle that has finances
+balances = {}
+# handle_id -> number of transaction records stored for the handle
+record_counts = {}
+# Number of records in the ledger
+position = 0
+records_since_snapshot = 0
+
+
+def init():
+	global position
+	global records_since_snapshot
+	balances.clear()
+	record_counts.clear()
+	snapshot = storage.get_conf(snapshot_file)
+	snapshot_position = 0
+	if snapshot_position_index in snapshot:
+		snapshot_position = int(snapshot[snapshot_position_index])
+		for handle_id, balance in snapshot[snapshot_balances_index].items():
+			balances[handle_id] = int(balance)
+		for handle_id, count in snapshot[snapshot_record_counts_index].items():
+			record_counts[handle_id] = int(count)
+
+	position = 0
+	for (_, record) in storage.read_records(ledger_log):
+		if position >= snapshot_position:
+			apply(simplejson.loads(record))
+		position += 1
+	records_since_snapshot = position - snapshot_position
+
+	if position == 0:
+		import_legacy_finances()
+
+startup.register('ledger', init, dependencies=['storage'])
+
+def import_legacy_finances():
+	for file_name in storage.backend.list_trees('finances'):
+		if storage.get_conf_key(file_name) == storage.get_conf_key(snapshot_file):
+			continue
+		finances_conf = storage.get_conf(file_name)
+		if legacy_balance_index in finances_conf:
+			handle_id = storage.get_conf_key(file_name)[len('finances/'):-len('.conf')]
+			append({'op': 'open', 'handle': handle_id})
+			append({'op': 'set', 'handle': handle_id, 'balance': int(finances_conf[legacy_balance_index])})
+			if legacy_transactions_index in finances_conf:
+				for index, record in finances_conf[legacy_transactions_index].items():
+					if index != legacy_highest_transaction_index:
+						append({'op': 'record', 'handle': handle_id, 'record': record})
+
+def apply(record):
+	op = record['op']
+	if op == 'open':
+		balances[record['handle']] = 0
+		record_counts[record['handle']] = 0
+	elif op == 'close':
+		balances.pop(record['handle'], None)
+		record_counts.pop(record['handle'], None)
+	elif op == 'set':
+		balances[record['handle']] = record['balance']
+	elif op == 'transfer':
+		if not (has_account(record['payer']) and has_account(record['recip'])):
+			# Cannot be appended any more (see transfer), but may be found in an older ledger
+			print(f'Error: ledger transfer from {record["payer"]} to {record["recip"]} involves a closed account, skipping it.')
+			return
+		balances[record['payer']] -= record['amount']
+		balances[record['recip']] += record['amount']
+	elif op == 'record':
+		record_counts[record['handle']] = record_counts.get(record['handle'], 0) + 1
+	else:
+		print(f'Error: unknown ledger operation {op}, skipping it.')
+
+def append(record):
+	global position
+	global records_since_snapshot
+	apply(record)
+	storage.append_record(ledger_log, simplejson.dumps(record))
+	position += 1
+	records_since_snapshot += 1
+	if records_since_snapshot >= snapshot_interval:
+		store_snapshot()
+
+def store_snapshot():
+	global records_since_snapshot
+	snapshot = storage.get_conf(snapshot_file)
+	snapshot[snapshot_balances_index] = {h : str(b) for h, b in balances.items()}
+	snapshot[snapshot_record_counts_index] = {h : str(c) for h, c in record_counts.items()}
+	snapshot[snapshot_position_index] = str(position)
+	snapshot.write()
+	records_since_snapshot = 0
+
+
+def has_account(handle_id : str):
+	return handle_id in balances
+
+def open_account(handle_id : str):
+	append({'op': 'open', 'handle': handle_id})
+
+def close_account(handle_id : str):
+	append({'op': 'close', 'handle': handle_id})
+
+def get_balance(handle_id : str):
+	return balances[handle_id]
+
+def set_balance(handle_id : str, balance : int):
+	append({'op': 'set', 'handle': handle_id, 'balance': balance})
+
+# Both sides of the transfer are a single record, so they can never be stored separately.
+# Returns False (and changes nothing) if either handle has no account.
+def transfer(payer_id : str, recip_id : str, amount : int):
+	if not (has_account(payer_id) and has_account(recip_id)):
+		return False
+	append({'op': 'transfer', 'payer': payer_id, 'recip': recip_id, 'amount': amount})
+	return True
+
+def add_record(handle_id : str, record : str):
+	append({'op': 'record', 'handle': handle_id, 'record': record})
@@ -0,0 +1,123 @@
+from contextlib import asynccontextmanager
+import asyncio
+import time
+
+### Module locks.py
+# Keyed locks for making sure that only one task at a time works on the same thing,
+# e.g. the handles of all players, the reactions of one user, or the order of one customer.
+# Each key gets its own asyncio.Lock while anyone holds or waits for it; waiters are served in
+# FIFO order (asyncio.Lock never lets a newcomer jump the queue), and an uncontended lock is granted
+# right away.
+# Giving up after a timeout raises LockTimeout, so callers can tell the user that the system is busy.
+# Wait times and contention are tracked per key (for the most recently used keys); see get_report().
+
+default_timeout : float = 60
+max_tracked_keys : int = 200
+
+# All lock managers, for reporting
+all_keyed_locks = []
+
+class LockTimeout(Exception):
+	pass
+
+class LockStats(object):
+	def __init__(self):
+		self.acquired = 0
+		self.contended = 0
+		self.timeouts = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+
+	def to_string(self):
+		average_wait = self.total_wait / self.acquired if self.acquired > 0 else 0
+		return (f'acquired {self.acquired}, contended {self.contended}, timeouts {self.timeouts}, '
+			+ f'wait avg {average_wait:.3f} s / max {self.max_wait:.3f} s')
+
+class KeyedLocks(object):
+	def __init__(self, name : str, timeout : float=default_timeout):
+		self.name = name
+		self.timeout = timeout
+		self.locks = {}
+		# Number of tasks holding or waiting for each lock; the lock is dropped when nobody needs it
+		self.users = {}
+		self.stats = {}
+		all_keyed_locks.append(self)
+
+	# Returns True if the lock was acquired, False if it timed out
+	async def acquire(self, key, timeout : float=None):
+		if timeout is None:
+			timeout = self.timeout
+		if not key in self.locks:
+			self.locks[key] = asyncio.Lock()
+			self.users[key] = 0
+		lock = self.locks[key]
+		stats = self.get_stats(key)
+		self.users[key] += 1
+		if lock.locked():
+			stats.contended += 1
+		start = time.monotonic()
+		# Not asyncio.wait_for: before Python 3.12 it can time out after the lock was already acquired,
+		# leaving it held by nobody
+		acquiring = asyncio.ensure_future(lock.acquire())
+		acquired = False
+		try:
+			await asyncio.wait([acquiring], timeout=timeout)
+			acquired = acquiring.done()
+		finally:
+			if not acquired:
+				acquiring.cancel()
+				if acquiring.done() and not acquiring.cancelled():
+					# Acquired just as we were cancelled
+					lock.release()
+				self.remove_user(key)
+		if not acquired:
+			stats.timeouts += 1
+			print(f'Error: timed out waiting for {self.name} lock {key}.')
+			return False
+		wait = time.monotonic() - start
+		stats.acquired += 1
+		stats.total_wait += wait
+		stats.max_wait = max(stats.max_wait, wait)
+		return True
+
+	# Only the most recently used keys are tracked, so that one-off keys (e.g. orders) do not pile up
+	def get_stats(self, key):
+		stats = self.stats.pop(key, None)
+		if stats is None:
+			stats = LockStats()
+		self.stats[key] = stats
+		if len(self.stats) > max_tracked_keys:
+			del self.stats[next(iter(self.stats))]
+		return stats
+
+	def release(self, key):
+		self.locks[key].release()
+		self.remove_user(key)
+
+	def remove_user(self, key):
+		self.users[key] -= 1
+		if self.users[key] == 0:
+			del self.users[key]
+			del self.locks[key]
+
+	@asynccontextmanager
+	async def hold(self, key, timeout : float=None):
+		acquired = await self.acquire(key, timeout)
+		if not acquired:
+			raise LockTimeout(f'Timed out waiting for {self.name} lock {key}')
+		try:
+			yield
+		finally:
+			self.release(key)
+
+	def get_queue_length(self, key):
+		return self.users.get(key, 0)
+
+	def get_report(self):
+		report = f'**{self.name}** ({len(self.locks)} in use):\n'
+		for key, stats in self.stats.items():
+			report += f'> {key}: {stats.to_string()}\n'
+		return report
+
+def get_report():
+	return '\n'.join(keyed_locks.get_report() for keyed_locks in all_keyed_locks)
@@ -0,0 +1,44 @@
+from configobj import ConfigObj
+import os
+import sys
+
+import storage
+import sqlite_storage
+
+### Script migrate_to_sqlite.py
+# One-shot import of the existing conf files into an SQLite game state database.
+# Run it from the discord directory while the bot is stopped:
+#     python migrate_to_sqlite.py [database file]
+# Then set STORAGE_BACKEND=sqlite (and STORAGE_DB, if not using the default file) in .env.
+# The conf files are left untouched, so switching back to STORAGE_BACKEND=files is always possible.
+
+# Directories holding game state conf files and append-only logs
+state_dirs = storage.preloaded_dirs + ['finances']
+# Conf files outside those directories that also hold game state
+extra_files = ['channel_states.conf']
+
+def migrate(db_file : str):
+	file_backend = storage.FileBackend()
+	db_backend = sqlite_storage.SqliteBackend(db_file)
+	if any(db_backend.list_trees(conf_dir) for conf_dir in state_dirs):
+		print(f'Error: {db_file} already holds game state; remove it first to migrate again.')
+		return
+	file_names = []
+	log_names = []
+	for conf_dir in state_dirs:
+		file_names += file_backend.list_trees(conf_dir)
+		if os.path.isdir(conf_dir):
+			log_names += [f'{conf_dir}/{f[:-len(".log")]}' for f in os.listdir(conf_dir) if f.endswith('.log')]
+	file_names += [f for f in extra_files if os.path.exists(f)]
+
+	snapshots = {}
+	for file_name in file_names:
+		snapshots[storage.get_conf_key(file_name)] = db_backend.snapshot(ConfigObj(file_name))
+	records = {}
+	for log_name in log_names:
+		records[log_name] = [record for (_, record) in file_backend.read_records(log_name)]
+	db_backend.store_batch(snapshots, records)
+	print(f'Imported {len(snapshots)} conf files and {len(records)} logs into {db_file}.')
+
+if __name__ == '__main__':
+	migrate(sys.argv[1] if len(sys.argv) > 1 else os.getenv('STORAGE_DB', storage.default_db_file))
@@ -0,0 +1,131 @@
+import asyncio
+import atexit
+import queue
+import threading
+
+### Module persistence.py
+# This module moves disk writes of conf trees off the asyncio event loop.
+# A conf tree that is written is only marked as dirty; once the write window has passed,
+# every dirty tree is snapshotted (once, no matter how many times it was written during the window)
+# and the resulting batch is handed to a dedicated writer thread, along with any records appended
+# to append-only logs during the window.
+# The writer thread merges all batches that are waiting, so each tree is stored at most once per pass,
+# and passes the merged batch to the storage backend in one go (see storage.py).
+# The file backend replaces each file atomically (temp file + rename); the SQLite backend
+# stores the whole batch in a single transaction.
+# If the backend fails to store a batch, the writer thread keeps it and tries again after
+# retry_delay, merged with (and ahead of) anything queued since, so nothing is dropped on the way.
+# Call flush() before shutting down to make sure everything has been stored.
+
+# Seconds to wait after the first write before snapshotting dirty trees
+write_window : float = 0.2
+# Seconds to wait before trying again to store a batch that failed
+retry_delay : float = 5
+
+backend = None
+
+dirty_trees = {}
+# log name -> records appended since the last flush, in order (None marks that the log was cleared)
+pending_records = {}
+flush_handle = None
+
+write_queue = queue.Queue()
+writer_thread = None
+writer_lock = threading.Lock()
+
+# Only used by the writer thread: what it has not managed to store yet
+unsaved_trees = {}
+unsaved_records = {}
+
+
+def set_backend(new_backend):
+	global backend
+	backend = new_backend
+
+def schedule_write(tree):
+	dirty_trees[tree.conf_key] = tree
+	schedule_flush()
+
+def schedule_append(log_name : str, record : str):
+	pending_records.setdefault(log_name, []).append(record)
+	schedule_flush()
+
+def schedule_flush():
+	global flush_handle
+	try:
+		loop = asyncio.get_running_loop()
+	except RuntimeError:
+		# Not running inside the bot (e.g. a script); just write it out right away
+		flush()
+		return
+	if flush_handle is None:
+		flush_handle = loop.call_later(write_window, flush_dirty)
+
+def flush_dirty():
+	global flush_handle
+	flush_handle = None
+	trees = {}
+	for key, tree in dirty_trees.items():
+		content = tree.snapshot()
+		if content != tree.stored_content:
+			tree.stored_content = content
+			trees[key] = content
+	dirty_trees.clear()
+	records = dict(pending_records)
+	pending_records.clear()
+	if trees or records:
+		start_writer()
+		write_queue.put((trees, records))
+
+# Shutdown hook: stores everything that is dirty and waits until the writer thread is done
+def flush():
+	global flush_handle
+	if flush_handle is not None:
+		flush_handle.cancel()
+		flush_handle = None
+	flush_dirty()
+	write_queue.join()
+	if unsaved_trees or unsaved_records:
+		print(f'Error: {len(unsaved_trees)} conf trees and {len(unsaved_records)} logs could not be stored.')
+
+atexit.register(flush)
+
+
+def start_writer():
+	global writer_thread
+	with writer_lock:
+		if writer_thread is None:
+			writer_thread = threading.Thread(target=run_writer, name='persistence', daemon=True)
+			writer_thread.start()
+
+def run_writer():
+	global unsaved_trees, unsaved_records
+	while True:
+		try:
+			batches = [write_queue.get(timeout=retry_delay if (unsaved_trees or unsaved_records) else None)]
+		except queue.Empty:
+			# Nothing new, but the last batch still has to be retried
+			batches = []
+		while True:
+			try:
+				batches.append(write_queue.get_nowait())
+			except queue.Empty:
+				break
+		# Later batches hold newer content, so they overwrite earlier ones for the same tree,
+		# while records for the same log are kept in the order they were appended
+		trees = unsaved_trees
+		records = unsaved_records
+		for (batch_trees, batch_records) in batches:
+			trees.update(batch_trees)
+			for log_name, log_records in batch_records.items():
+				records.setdefault(log_name, []).extend(log_records)
+		try:
+			backend.store_batch(trees, records)
+			unsaved_trees = {}
+			unsaved_records = {}
+		except Exception as e:
+			print(f'Error: failed to store {len(trees)} conf trees and {len(records)} logs, retrying in {retry_delay} s: {e}')
+			unsaved_trees = trees
+			unsaved_records = records
+		for _ in batches:
+			write_queue.task_done()
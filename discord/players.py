@@ -5,6 +5,8 @@ import server
 import actors
 import shops
 import player_setup
+import storage
+import startup
 from groups import Group
 
 from common import coin, highest_ever_index, player_personal_role_start, admin_role_name, gm_role_name
@@ -14,7 +16,6 @@ from custom_types import PlayerData, Handle, ActionResult
 import discord
 import asyncio
 import math
-from configobj import ConfigObj
 from typing import List
 
 
@@ -22,18 +23,42 @@ players_conf_dir = 'players'
 user_id_mappings_index = '___user_id_to_player_id'
 
 def get_players_confobj():
-	players = ConfigObj(players_conf_dir + '/__players.conf')
+	players = storage.get_conf(players_conf_dir + '/__players.conf')
 	if not user_id_mappings_index in players:
 		players[user_id_mappings_index] = {}
 		players.write()
 	return players
 
+# user_id -> player_id and player_id -> user_id, kept in memory since they are needed for every message.
+# Built from the players conf on first use, then kept up to date by create_player and clear_player.
+user_to_player = None
+player_to_user = None
+
+def get_user_id_maps():
+	global user_to_player
+	global player_to_user
+	if user_to_player is None:
+		players = get_players_confobj()
+		user_to_player = {}
+		for user_id, player_id in players[user_id_mappings_index].items():
+			if user_id != highest_ever_index:
+				user_to_player[user_id] = player_id
+		player_to_user = {p : u for u, p in user_to_player.items()}
+	return (user_to_player, player_to_user)
+
+def reset_user_id_maps():
+	global user_to_player
+	global player_to_user
+	user_to_player = None
+	player_to_user = None
+
 
 # TODO: loop through all users, find their player_ids and re-map personal channels if not available
 async def init(guild, clear_all=False):
 	players = get_players_confobj()
 	if not user_id_mappings_index in players or clear_all:
 		players[user_id_mappings_index] = {}
+		reset_user_id_maps()
 	if not highest_ever_index in players[user_id_mappings_index] or clear_all:
 		players[user_id_mappings_index][highest_ever_index] = str(player_personal_role_start)
 	if clear_all:
@@ -44,17 +69,23 @@ async def init(guild, clear_all=False):
 
 	players.write()
 
+startup.register('players', lambda: init(server.get_guild()), dependencies=['shops'])
 
-async def delete_all_player_roles(guild, spare_used : bool):
-	task_list = (asyncio.create_task(delete_if_player_role(r, spare_used)) for r in guild.roles)
-	await asyncio.gather(*task_list)
 
-async def delete_if_player_role(role, spare_used : bool):
-	if common.is_player_role(role.name):
-		if not spare_used or len(role.members) == 0:
-			await role.delete()
+async def delete_all_player_roles(guild, spare_used : bool):
+	await server.delete_roles(
+		[r for r in guild.roles
+		if common.is_player_role(r.name) and (not spare_used or len(r.members) == 0)]
+		)
 
 async def clear_player(guild, player_id : str):
+	(user_ids, player_ids) = get_user_id_maps()
+	user_id = player_ids.pop(player_id, None)
+	if user_id is not None:
+		del user_ids[user_id]
+		players = get_players_confobj()
+		players[user_id_mappings_index].pop(user_id, None)
+		players.write()
 	await actors.clear_actor(guild, player_id)
 	await channels.delete_all_personal_channels(player_id)
 	player : PlayerData = read_player_data(player_id)
@@ -78,10 +109,10 @@ def get_all_players():
 			yield player
 
 def player_exists(player_id : str):
-	return player_id in get_all_players()
+	return player_id in get_players_confobj() and not player_id in [highest_ever_index, user_id_mappings_index]
 
 def is_player(player_id : str):
-	return player_id in get_all_players()
+	return player_exists(player_id)
 
 def store_player_data(player_data : PlayerData):
 	players = get_players_confobj()
@@ -95,13 +126,15 @@ def read_player_data(player_id : str):
 
 
 def get_player_id(user_id : str, expect_to_find=True):
-	players = get_players_confobj()
-	if not user_id in players[user_id_mappings_index]:
-		if expect_to_find:
-			raise RuntimeError(f'User {user_id} has not been initialized as a player. Fix that first.')
-		else:
-			return None
-	return players[user_id_mappings_index][user_id]
+	(user_ids, _) = get_user_id_maps()
+	player_id = user_ids.get(str(user_id))
+	if player_id is None and expect_to_find:
+		raise RuntimeError(f'User {user_id} has not been initialized as a player. Fix that first.')
+	return player_id
+
+def get_user_id(player_id : str):
+	(_, player_ids) = get_user_id_maps()
+	return player_ids.get(player_id)
 
 def get_player_category_index(player_id: str):
 	return math.floor(int(player_id[-2:]) / 9)
@@ -133,6 +166,9 @@ async def create_player(member, handle_id : str=None):
 	players = get_players_confobj()
 	players[user_id_mappings_index][user_id] = new_player_id
 	players.write()
+	(user_ids, player_ids) = get_user_id_maps()
+	user_ids[user_id] = new_player_id
+	player_ids[new_player_id] = user_id
 
 	# Create personal command line channels for player
 	cmd_line_channel = await channels.create_personal_channel(
@@ -153,6 +189,7 @@ async def create_player(member, handle_id : str=None):
 	await member.edit(roles=new_roles)
 	try:
 		await member.edit(nick = new_player_id)
+		server.set_member_nick(member, new_player_id)
 	except discord.Forbidden:
 		print(f'Probably tried to edit server owner, which doesn\'t work. Please make sure user {member.name} has nickname {new_player_id}.')
 
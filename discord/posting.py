@@ -3,8 +3,18 @@ import handles
 from common import forbidden_content, hard_space
 from custom_types import PostTimestamp
 import players
+import storage
+import sequencer
+import startup
 
+from collections import OrderedDict
+from dotenv import load_dotenv
+import simplejson
+import discord
+import tempfile
 import re
+import io
+import os
 import asyncio
 
 ### Module posting.py
@@ -15,6 +25,57 @@ import asyncio
 # by deleting all messages and reposting them with custom
 # handles.
 
+# Reposted messages:
+# The id of every message posted by the bot on behalf of a handle is kept together with the
+# handle's id, so that reactions (e.g. payments) can find their recipient without reading the
+# message history. Only the most recently used message_authors_limit messages are kept.
+# The index is stored as an append-only log, which is compacted when it grows too long.
+
+message_authors_log = 'message_authors'
+message_authors_limit = 5000
+
+# message_id -> handle_id, least recently used first
+message_authors = OrderedDict()
+message_authors_log_length = 0
+
+def init():
+    global message_authors_log_length
+    message_authors.clear()
+    message_authors_log_length = 0
+    for (_, record) in storage.read_records(message_authors_log):
+        [message_id, handle_id] = simplejson.loads(record)
+        add_message_author(message_id, handle_id)
+        message_authors_log_length += 1
+
+startup.register('posting', init, dependencies=['storage'])
+
+def add_message_author(message_id : str, handle_id : str):
+    message_authors[message_id] = handle_id
+    message_authors.move_to_end(message_id)
+    if len(message_authors) > message_authors_limit:
+        message_authors.popitem(last=False)
+
+def record_message_author(message_id : str, handle_id : str):
+    global message_authors_log_length
+    add_message_author(message_id, handle_id)
+    storage.append_record(message_authors_log, simplejson.dumps([message_id, handle_id]))
+    message_authors_log_length += 1
+    if message_authors_log_length > 2 * message_authors_limit:
+        compact_message_authors_log()
+
+def compact_message_authors_log():
+    global message_authors_log_length
+    storage.clear_log(message_authors_log)
+    for message_id, handle_id in message_authors.items():
+        storage.append_record(message_authors_log, simplejson.dumps([message_id, handle_id]))
+    message_authors_log_length = len(message_authors)
+
+def get_message_author(message_id : str):
+    handle_id = message_authors.get(message_id)
+    if handle_id is not None:
+        message_authors.move_to_end(message_id)
+    return handle_id
+
 
 double_hard_space = hard_space + hard_space
 
@@ -58,23 +119,140 @@ def create_post(message, sender : str, recip : str=None, attachments_supported :
             content += f'\n*[unavailable file: {attachment.filename}]*'
     return content
 
+# Attachments:
+# When a message is reposted to several channels (e.g. to every participant of a chat), each
+# attachment is downloaded once and every repost gets its own discord.File reading from the
+# shared copy. Small attachments are kept in memory, larger ones in a temporary file.
+# Use as "async with AttachmentBuffer(message.attachments) as attachments:"; the copies
+# are removed when the block is left.
+
+attachment_memory_limit = 8 * 1024 * 1024
+
+class AttachmentBuffer(object):
+    def __init__(self, attachments):
+        self.attachments = attachments
+        # For each attachment: its content (bytes) or the name of the temporary file holding it
+        self.contents = []
+
+    async def __aenter__(self):
+        try:
+            for attachment in self.attachments:
+                if attachment.size <= attachment_memory_limit:
+                    self.contents.append(await attachment.read())
+                else:
+                    with tempfile.NamedTemporaryFile(delete=False) as f:
+                        self.contents.append(f.name)
+                        await attachment.save(f)
+        except BaseException:
+            # __aexit__ is not called if entering fails, so the files written so far are removed here
+            self.remove_temp_files()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.remove_temp_files()
+
+    def remove_temp_files(self):
+        for content in self.contents:
+            if isinstance(content, str):
+                os.remove(content)
+        self.contents = []
+
+    def get_files(self):
+        files = []
+        for attachment, content in zip(self.attachments, self.contents):
+            fp = io.BytesIO(content) if isinstance(content, bytes) else content
+            files.append(discord.File(fp, filename=attachment.filename, spoiler=attachment.is_spoiler()))
+        return files
+
+# Webhooks:
+# With REPOST_WITH_WEBHOOKS=true in .env, posts in pseudonymous channels are reposted through a
+# webhook of the channel, with the handle as the webhook's display name, instead of as bot
+# messages with a header. Discord shows the name and time itself, so no header is needed,
+# and webhooks have rate limits of their own.
+# If a webhook cannot be used (e.g. missing Manage Webhooks permission, or a handle that
+# Discord does not accept as a name), the post is reposted the usual way.
+
+load_dotenv()
+repost_with_webhooks = os.getenv('REPOST_WITH_WEBHOOKS', 'false').lower() == 'true'
+webhook_name = 'repost'
+
+# channel_id -> webhook owned by the bot
+webhooks = {}
+
+async def get_webhook(channel):
+    if not channel.id in webhooks:
+        try:
+            own_webhooks = [w for w in await channel.webhooks() if w.name == webhook_name and w.token is not None]
+            if len(own_webhooks) > 0:
+                webhooks[channel.id] = own_webhooks[0]
+            else:
+                webhooks[channel.id] = await channel.create_webhook(name=webhook_name)
+        except discord.errors.HTTPException as e:
+            print(f'Error: could not get a webhook for {channel.name}: {e}')
+            return None
+    return webhooks[channel.id]
+
+# Returns the new message, or None if the post could not be sent through the webhook
+async def repost_message_with_webhook(channel, message, sender : str, files):
+    webhook = await get_webhook(channel)
+    if webhook is None:
+        return None
+    post = sanitize_bold(message.content)
+    try:
+        return await webhook.send(post, username=sender, files=files, wait=True)
+    except discord.errors.NotFound:
+        # The webhook has been removed; a new one is created next time
+        del webhooks[channel.id]
+    except discord.errors.HTTPException as e:
+        print(f'Error: could not repost as {sender} with webhook in {channel.name}: {e}')
+    return None
+
 # TODO: pass in "full_post : bool" instead of checking sender == None
-async def repost_message_to_channel(channel, message, sender : str, recip : str=None):
-    post = create_post(message, sender, recip)
-    files = [await a.to_file() for a in message.attachments]
-    await channel.send(post, files=files)
+# author is the handle that should receive payments for the post, even if sender is None
+async def repost_message_to_channel(
+    channel,
+    message,
+    sender : str,
+    recip : str=None,
+    author : str=None,
+    attachments : AttachmentBuffer=None,
+    webhook : bool=False
+    ):
+    if attachments is None:
+        # Downloaded once, even if the webhook fails and the post has to be sent again
+        async with AttachmentBuffer(message.attachments) as buffer:
+            await repost_message_to_channel(channel, message, sender, recip, author, buffer, webhook)
+        return
+    new_message = None
+    if webhook:
+        new_message = await repost_message_with_webhook(channel, message, sender, attachments.get_files())
+    if new_message is None:
+        post = create_post(message, sender, recip)
+        new_message = await channel.send(post, files=attachments.get_files())
+    if author is not None:
+        record_message_author(str(new_message.id), author)
+
+async def repost_message(message, sender : str, author : str=None):
+    await repost_message_to_channel(message.channel, message, sender, author=author)
 
-async def repost_message(message, sender : str):
-    await repost_message_to_channel(message.channel, message, sender)
+# Messages in each channel are reposted one at a time, in the order they arrived,
+# while different channels are processed concurrently
+open_channel_sequencer = sequencer.Sequencer('open channel reposts')
 
 async def process_open_message(message, anonymous=False):
     task1 = asyncio.create_task(message.delete())
     current_channel = str(message.channel.name)
-    player_id = players.get_player_id(str(message.author.id))
+    task2 = open_channel_sequencer.submit(current_channel, repost_open_message(message, current_channel, anonymous))
+    await asyncio.gather(task1, task2)
+
+async def repost_open_message(message, current_channel : str, anonymous : bool):
+    player_id = players.get_player_id(str(message.author.id), expect_to_find=False)
     if player_id is None:
         # If someone is for some reason not a player (probably an admin or GM not properly initiated):
         # Let the message through, but as "Anonymous"
         anonymous = True
+    author = None
     if anonymous:
         current_poster_id = player_id
         current_poster_display_name = 'Anonymous'
@@ -86,11 +264,14 @@ async def process_open_message(message, anonymous=False):
         else:
             current_poster_id = player_id
             current_poster_display_name = player_id
-    post_time = PostTimestamp.from_datetime(message.created_at, dst_diff=2)
-    full_post = channels.record_new_post(current_channel, current_poster_id, post_time)
+        author = current_poster_id
+        if repost_with_webhooks:
+            # The webhook shows the handle on every post, so there are no headers to keep track of
+            await repost_message_to_channel(message.channel, message, current_poster_display_name, author=author, webhook=True)
+            return
+    full_post = channels.record_new_post(current_channel, current_poster_id, message.created_at)
     if full_post:
-        task2 = asyncio.create_task(repost_message(message, current_poster_display_name))
+        await repost_message(message, current_poster_display_name, author)
     else:
-        task2 = asyncio.create_task(repost_message(message, None))
-    await asyncio.gather(task1, task2)
+        await repost_message(message, None, author)
 
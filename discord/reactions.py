@@ -1,6 +1,4 @@
 import datetime
-import random
-import asyncio
 import discord
 
 import posting
@@ -12,6 +10,8 @@ import custom_types
 import chats
 import shops
 import game
+import locks
+import server
 
 from custom_types import ActionResult
 from common import coin
@@ -26,11 +26,10 @@ from common import coin
 reactions_worth_money = {'💴' : 1, '💸' : 1, '💰' : 1, '🍺' : 1, '💯' : 100, '🪙' : 1}
 chat_reactions = ['📧', '💬', '🗨️', '❔', '❓', '❕', '❗']
 
-def init():
-	clear_reaction_semaphores()
-
 async def remove_reaction(message, emoji, user_id : int):
-	member = await message.channel.guild.fetch_member(user_id)
+	member = server.get_member(user_id)
+	if member is None:
+		member = await message.channel.guild.fetch_member(user_id)
 	if member == None:
 		print(f'Error: tried to remove reaction but member not found, user_id is {user_id}')
 	else:
@@ -60,6 +59,13 @@ async def find_reaction_recipient_and_message(message_id : int, channel):
 	result = ReactionRecipientSearchResult()
 	partial_message = channel.get_partial_message(message_id)
 
+	author = posting.get_message_author(str(message_id))
+	if author is not None:
+		result.message = partial_message
+		result.recipient = author
+		return result
+
+	# Not a recent repost; fall back to reading the header of the post from the history
 	epsilon = datetime.timedelta(milliseconds=500)
 	timestamp = partial_message.created_at + epsilon
 	message_history = await channel.history(limit=20, before=timestamp).flatten()
@@ -69,7 +75,11 @@ async def find_reaction_recipient_and_message(message_id : int, channel):
 		if result.message == None:
 			# We fetched a few messages that actually came after the original one (within 500 ms)
 			continue
-		match = posting.read_handle_from_post(message.content)
+		if message.webhook_id is not None:
+			# Reposted through a webhook, with the handle as the name
+			match = message.author.name.lower()
+		else:
+			match = posting.read_handle_from_post(message.content)
 		if match != None:
 			#print(f'Recorded reaction on post by {match}')
 			result.recipient = match
@@ -130,44 +140,8 @@ async def process_reaction_in_order_flow(message_id : int, user_id : int, channe
 		await channel.send(content=result.report, delete_after=5)
 
 
-reactions_semaphores = {}
-
-async def get_reaction_semaphore(user_id : str):
-	global reactions_semaphores
-	sem_value = str(random.randrange(10000))
-	number_iterations = 0
-	while True:
-		if user_id not in reactions_semaphores:
-			reactions_semaphores[user_id] = sem_value
-			await asyncio.sleep(0.5)
-			if reactions_semaphores[user_id] == sem_value:
-				break
-		await asyncio.sleep(0.5)
-		number_iterations += 1
-		if number_iterations > 120:
-			print(f'Error: semaphore probably stuck! Resetting semaphore for {user_id}.')
-			if user_id in reactions_semaphores:
-				del reactions_semaphores[user_id]
-			return None
-	return sem_value
-
-
-def return_reaction_semaphore(user_id : str, sem_value :str):
-	global reactions_semaphores
-	if user_id in reactions_semaphores:
-		if reactions_semaphores[user_id] == sem_value:
-			del reactions_semaphores[user_id]
-		else:
-			print(f'Semaphore error: Tried to return semaphore for {user_id} but it was taken by another process.')
-	else:
-		print(f'Semaphore error: tried to return semaphore for {user_id} but it was already free!')
-
-def clear_reaction_semaphores():
-	global reactions_semaphores
-	for sem_id in reactions_semaphores:
-		del reactions_semaphores[sem_id]
-
-
+# Only one reaction per user is processed at a time
+reaction_locks = locks.KeyedLocks('reactions')
 
 async def process_reaction_add(message_id : int, user_id : int, channel, emoji):
 	if not game.can_process_reactions() and not channels.is_chat_hub(channel.name):
@@ -176,37 +150,35 @@ async def process_reaction_add(message_id : int, user_id : int, channel, emoji):
 		await remove_reaction(message, emoji, user_id)
 		return
 
-	# Semaphore handling to ensure we only process one action per player at a time:
-	semaphore = await get_reaction_semaphore(user_id)
+	# Locking to ensure we only process one action per player at a time:
 	print(f'User reacted with {emoji}')
 	should_remove_reaction = True
-	if semaphore is not None:
-		try:
-			if channels.is_anonymous_channel(channel):
-				# Reactions are allowed in anonymous channels, but trigger no effects
-				should_remove_reaction = False
-			elif channels.is_cmd_line(channel.name):
-				# Reactions in cmd_line are silently swallowed
+	try:
+		async with reaction_locks.hold(user_id):
+			try:
+				if channels.is_anonymous_channel(channel):
+					# Reactions are allowed in anonymous channels, but trigger no effects
+					should_remove_reaction = False
+				elif channels.is_cmd_line(channel.name):
+					# Reactions in cmd_line are silently swallowed
+					pass
+				elif channels.is_chat_hub(channel.name):
+					await process_reaction_in_chat_hub(message_id, user_id, channel, emoji)
+					should_remove_reaction = False # Not needed after this
+				elif channels.is_shop_channel(channel):
+					await process_reaction_in_storefront(message_id, user_id, channel, emoji)
+				elif channels.is_finance(channel.name):
+					await process_reaction_in_finance_channel(message_id, user_id, channel, emoji)
+				elif channels.is_order_flow(channel.name):
+					await process_reaction_in_order_flow(message_id, user_id, channel, emoji)
+				else:
+					await process_reaction_on_other_handle(message_id, user_id, channel, emoji)
+					should_remove_reaction = False # Reaction should stay unless removed by above function
+			except discord.errors.NotFound:
+				# If the message has already been removed, processing will fail and we just move on
 				pass
-			elif channels.is_chat_hub(channel.name):
-				await process_reaction_in_chat_hub(message_id, user_id, channel, emoji)
-				should_remove_reaction = False # Not needed after this
-			elif channels.is_shop_channel(channel):
-				await process_reaction_in_storefront(message_id, user_id, channel, emoji)
-			elif channels.is_finance(channel.name):
-				await process_reaction_in_finance_channel(message_id, user_id, channel, emoji)
-			elif channels.is_order_flow(channel.name):
-				await process_reaction_in_order_flow(message_id, user_id, channel, emoji)
-			else:
-				await process_reaction_on_other_handle(message_id, user_id, channel, emoji)
-				should_remove_reaction = False # Reaction should stay unless removed by above function
-		except discord.errors.NotFound:
-			# If the message has already been removed, processing will fail and we just move on
-			pass
-		return_reaction_semaphore(user_id, semaphore)
-	else:
-		pass
-		print(f'Error: failed to get reaction semaphore. Will ignore this reaction and move on.')
+	except locks.LockTimeout:
+		print(f'Error: failed to get reaction lock. Will ignore this reaction and move on.')
 
 	if should_remove_reaction:
 		try:
@@ -0,0 +1,73 @@
+from collections import deque
+import asyncio
+
+### Module sequencer.py
+# Strict ordering of jobs that belong to the same key (e.g. reposting messages in one channel),
+# while jobs for different keys run concurrently.
+# Jobs for a key are run one at a time in the order they were submitted. Submitting is not
+# async, so the order is decided at the moment of submission, not when the caller gets
+# around to awaiting anything.
+# The number of jobs queued per key is tracked; see get_report().
+
+# All sequencers, for reporting
+all_sequencers = []
+
+class Sequencer(object):
+	def __init__(self, name : str):
+		self.name = name
+		# key -> jobs (coroutine, future) waiting to be run; the first one is running
+		self.queues = {}
+		self.max_queue_lengths = {}
+		# The event loop only keeps weak references to tasks
+		self.runners = set()
+		all_sequencers.append(self)
+
+	# Returns a future for the result of the job
+	def submit(self, key, job):
+		future = asyncio.get_running_loop().create_future()
+		if key in self.queues:
+			self.queues[key].append((job, future))
+		else:
+			self.queues[key] = deque([(job, future)])
+			runner = asyncio.create_task(self.run(key))
+			self.runners.add(runner)
+			runner.add_done_callback(self.runners.discard)
+		self.max_queue_lengths[key] = max(self.max_queue_lengths.get(key, 0), len(self.queues[key]))
+		return future
+
+	async def run(self, key):
+		queue = self.queues[key]
+		try:
+			while len(queue) > 0:
+				(job, future) = queue[0]
+				try:
+					result = await job
+				except Exception as e:
+					if not future.done():
+						future.set_exception(e)
+				else:
+					if not future.done():
+						future.set_result(result)
+				queue.popleft()
+		finally:
+			# If the runner itself was cancelled, the jobs still queued will never run
+			for (job, future) in queue:
+				job.close()
+				if not future.done():
+					future.cancel()
+			del self.queues[key]
+
+	def get_queue_length(self, key):
+		return len(self.queues.get(key, []))
+
+	def get_total_queue_length(self):
+		return sum(len(queue) for queue in self.queues.values())
+
+	def get_report(self):
+		report = f'**{self.name}** ({self.get_total_queue_length()} queued):\n'
+		for key, max_queue_length in self.max_queue_lengths.items():
+			report += f'> {key}: {self.get_queue_length(key)} queued (max {max_queue_length})\n'
+		return report
+
+def get_report():
+	return '\n'.join(sequencer.get_report() for sequencer in all_sequencers)
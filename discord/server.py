@@ -11,6 +11,16 @@ gm_role = None
 guild = None
 new_player_role = None
 
+# Members of the guild, by nick and by user id (as str).
+# Seeded from the gateway member cache and kept up to date by the member events (see system_bot.py).
+members_by_nick = {}
+members_by_id = {}
+
+# Roles of the guild by name (the first one, if several have the same name).
+# Built at init and kept up to date by the guild role events (see system_bot.py).
+roles_by_name = {}
+max_concurrent_role_deletes = 5
+
 # TODO: restrict reactions to only the channels where they actually do anything.
 # This is a third category I think:
 # private with emoji: yes, chats
@@ -42,19 +52,55 @@ async def init(bot, current_guild):
 	global gm_role
 	global new_player_role
 	guild = current_guild
+	init_role_index()
 	system_role = await init_role(system_role_name)
 	admin_role = await init_role(admin_role_name)
 	gm_role = await init_role(gm_role_name)
 	all_players_role = await init_role(all_players_role_name)
 	new_player_role = await init_role(new_player_role_name)
+	init_member_index()
 
 async def init_role(role_name: str):
-	role = discord.utils.find(lambda role: role.name == role_name, guild.roles)
+	role = get_role(role_name)
 	if role is None:
 		print(f'Creating role with name {role_name}')
 		role = await guild.create_role(name=role_name)
+		add_role(role)
 	return role
 
+def init_role_index():
+	roles_by_name.clear()
+	for role in guild.roles:
+		add_role(role)
+
+def add_role(role):
+	if not role.name in roles_by_name:
+		roles_by_name[role.name] = role
+
+def remove_role(role):
+	if role.name in roles_by_name and roles_by_name[role.name].id == role.id:
+		del roles_by_name[role.name]
+		# Another role may have the same name
+		other_role = discord.utils.find(lambda r: r.name == role.name and r.id != role.id, guild.roles)
+		if other_role is not None:
+			roles_by_name[role.name] = other_role
+
+def update_role(before, after):
+	remove_role(before)
+	add_role(after)
+
+def get_role(role_name : str):
+	return roles_by_name.get(role_name)
+
+# Deleting many roles at once is limited to a few at a time, to stay clear of Discord's rate limits
+async def delete_roles(roles):
+	semaphore = asyncio.Semaphore(max_concurrent_role_deletes)
+	async def delete_role(role):
+		async with semaphore:
+			await role.delete()
+		remove_role(role)
+	await asyncio.gather(*[delete_role(r) for r in roles])
+
 def get_guild():
 	return guild
 
@@ -122,10 +168,39 @@ def generate_setup_channel_overwrites():
 		new_player_role : super_access
 		})
 
+def init_member_index():
+	members_by_nick.clear()
+	members_by_id.clear()
+	for member in guild.members:
+		add_member(member)
+
+def add_member(member):
+	members_by_id[str(member.id)] = member
+	if member.nick is not None:
+		members_by_nick[member.nick] = member
+
+def remove_member(member):
+	members_by_id.pop(str(member.id), None)
+	if member.nick is not None and members_by_nick.get(member.nick) is not None:
+		if members_by_nick[member.nick].id == member.id:
+			del members_by_nick[member.nick]
+
+def update_member(before, after):
+	remove_member(before)
+	add_member(after)
+
+# For when we have changed the nick ourselves, before the update event has arrived
+def set_member_nick(member, nick : str):
+	remove_member(member)
+	members_by_id[str(member.id)] = member
+	members_by_nick[nick] = member
+
 async def get_member_from_nick(nick : str):
 	if nick is not None:
-		members = await guild.fetch_members(limit=100).flatten()
-		return discord.utils.find(lambda m: m.nick == nick, members)
+		return members_by_nick.get(nick)
+
+def get_member(user_id : str):
+	return members_by_id.get(str(user_id))
 
 async def get_all_channels():
 	return await guild.fetch_channels()
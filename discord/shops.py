@@ -4,10 +4,11 @@ import discord
 import asyncio
 import simplejson
 import datetime
-import random
+import heapq
+import hashlib
+import time
 import os
 
-from configobj import ConfigObj
 from typing import List, Tuple
 from copy import deepcopy
 from enum import Enum
@@ -22,6 +23,10 @@ import players
 import actors
 import finances
 import server
+import storage
+import locks
+import debounce
+import startup
 
 from common import coin, emoji_unavail, shop_role_start, highest_ever_index, emoji_alert, emoji_accept, number_emojis
 from custom_types import Transaction, TransTypes, ActionResult, Handle, HandleTypes, PostTimestamp
@@ -146,14 +151,13 @@ class EmployeeCog(commands.Cog, name='employee'):
 		allowed = await channels.pre_process_command(ctx)
 		if not allowed:
 			return
-		sem_id = await handles.get_semaphore(f'creating_shop_{shop_name}')
-		if sem_id is None:
+		try:
+			async with handles.lock_handles():
+				result : ActionResult = await create_shop(ctx.guild, shop_name, player_id, is_owner=True)
+				if result.report is not None:
+					await ctx.send(result.report)
+		except locks.LockTimeout:
 			await ctx.send('Failed: system is too busy. Wait a few minutes and try again.')
-		else:
-			result : ActionResult = await create_shop(ctx.guild, shop_name, player_id, is_owner=True)
-			if result.report is not None:
-				await ctx.send(result.report)
-			handles.return_semaphore(sem_id)		
 
 
 	@commands.command(
@@ -331,6 +335,40 @@ class EmployeeCog(commands.Cog, name='employee'):
 		await reinitialize(str(ctx.message.author.id), shop_name)
 		await self.publish_menu_command(ctx, shop_name=shop_name)
 
+	@commands.command(
+		name='order_board',
+		brief='Shop owner only: show orders on a single board message.',
+		help=(
+			'Shop owner only: \".order_board on\" shows all active and locked orders on a single pinned message in the order channel, '
+			+ 'instead of one message per order. Orders are then marked as delivered with \".deliver <order number>\". '
+			+ '\".order_board off\" goes back to one message per order.\n'
+			+ 'Note: as long as you don\'t work at more than one shop, you can skip the \"shop_name\" argument.'
+			)
+		)
+	async def order_board_command(self, ctx, value : str=None, shop_name : str=None):
+		allowed = await channels.pre_process_command(ctx)
+		if not allowed:
+			return
+		report = await set_order_board_from_command(str(ctx.message.author.id), value, shop_name)
+		if report is not None:
+			await ctx.send(report)
+
+	@commands.command(
+		name='deliver',
+		brief='Mark an order as delivered.',
+		help=(
+			'Mark an order as delivered, e.g. \".deliver 12\". Mostly useful when the shop shows its orders on a board (see \".order_board\").\n'
+			+ 'Note: as long as you don\'t work at more than one shop, you can skip the \"shop_name\" argument.'
+			)
+		)
+	async def deliver_command(self, ctx, order_id : str=None, shop_name : str=None):
+		allowed = await channels.pre_process_command(ctx)
+		if not allowed:
+			return
+		report = await deliver_order_from_command(str(ctx.message.author.id), order_id, shop_name)
+		if report is not None:
+			await ctx.send(report)
+
 	@commands.command(
 		name='set_tips',
 		brief='Set which handle should get your tips.',
@@ -434,12 +472,16 @@ class Shop(object):
 		self.highest_order = 0
 		self.employees = [] if employees is None else employees
 		self.order_collection_limit = 2
+		# In board mode, orders are shown on a single pinned message instead of one message each
+		self.board_mode = False
+		self.board_msg_id = None
 
 	@staticmethod
 	def from_string(string : str):
 		obj = Shop(None, None, None, None)
 		loaded_dict = simplejson.loads(string)
-		obj.__dict__ = loaded_dict
+		# Shops stored before board mode existed keep its defaults
+		obj.__dict__.update(loaded_dict)
 		for i, employee_str in enumerate(loaded_dict['employees']):
 			obj.employees[i] = Employee.from_string(employee_str)
 		return obj
@@ -553,7 +595,8 @@ class Order(object):
 		order_flow_msg_id : str=None,
 		time_created : PostTimestamp=None,
 		undo_hooks : List[Tuple[str, str]]=None,
-		items_ordered={}):
+		items_ordered={},
+		created : float=None):
 		self.order_id = order_id
 		self.delivery_id = delivery_id
 		self.price_total = price_total
@@ -564,12 +607,15 @@ class Order(object):
 		self.time_updated : PostTimestamp = time_created
 		self.undo_hooks = [] if undo_hooks is None else undo_hooks
 		self.updated : bool = False
+		# Seconds since the epoch; time_created only has the time of day
+		self.created = created
 
 	@staticmethod
 	def from_string(string : str):
 		obj = Order(None, None, None)
 		loaded_dict = simplejson.loads(string)
-		obj.__dict__ = loaded_dict
+		# Orders stored before 'created' existed keep its default
+		obj.__dict__.update(loaded_dict)
 		obj.time_created : PostTimestamp = PostTimestamp.from_string(loaded_dict['time_created'])
 		obj.time_updated : PostTimestamp = PostTimestamp.from_string(loaded_dict['time_updated'])
 		return obj
@@ -674,7 +720,7 @@ storefront_channel_map_index = '__storefront_channel_mapping'
 orders_channel_map_index = '__order_flow_channel_mapping'
 
 def get_shops_configobj():
-	shops = ConfigObj(f'{shops_conf_dir}/__shops.conf')
+	shops = storage.get_conf(f'{shops_conf_dir}/__shops.conf')
 	edited = False
 	if shop_data_index not in shops:
 		shops[shop_data_index] = {}
@@ -702,6 +748,7 @@ async def init(guild, clear_all=False):
 			await actors.clear_actor(guild, shop_id)
 			await clear_shop_contents(shop_id)
 			del shops[shop_data_index][shop_id]
+			shop_caches.pop(shop_id, None)
 		for channel in shops[storefront_channel_map_index]:
 			del shops[storefront_channel_map_index][channel]
 		for channel in shops[orders_channel_map_index]:
@@ -715,15 +762,14 @@ async def init(guild, clear_all=False):
 
 	await delete_all_shop_roles(guild, spare_used=not clear_all)
 
-async def delete_all_shop_roles(guild, spare_used : bool):
-	task_list = (asyncio.create_task(delete_if_shop_role(r, spare_used)) for r in guild.roles)
-	await asyncio.gather(*task_list)
+startup.register('shops', lambda: init(server.get_guild()), dependencies=['handles'])
 
-async def delete_if_shop_role(role, spare_used : bool):
-	if common.is_shop_role(role.name):
-		in_use = actors.actor_index_in_use(role.name) or len(role.members) > 0
-		if not in_use or not spare_used:
-			await role.delete()
+async def delete_all_shop_roles(guild, spare_used : bool):
+	role_names_in_use = actors.get_actor_role_names() if spare_used else set()
+	await server.delete_roles(
+		[r for r in guild.roles
+		if common.is_shop_role(r.name) and not (spare_used and actors.is_role_in_use(r, role_names_in_use))]
+		)
 
 async def reinitialize(user_id : str, shop_name : str):
 	result : FindShopResult = await find_shop_for_command(user_id, shop_name, must_be_owner=True)
@@ -742,7 +788,6 @@ async def reinitialize(user_id : str, shop_name : str):
 	await clear_order_data(shop.shop_id)
 	shop.highest_order = 1
 	store_shop(shop)
-	clear_order_semaphores_for_shop(shop.shop_id)
 	return 'Done.'
 
 
@@ -756,11 +801,94 @@ def get_next_shop_index():
 	shops.write()
 	return shop_index
 
+# Decoded shop data, kept in memory per shop so that handling an order does not decode the
+# same stored JSON again for every reaction. Each part is loaded from the conf trees the first
+# time it is needed; the getters and setters below keep it in sync with the conf trees after that.
+# The objects returned from the cache are shared: anything that changes one must store it again.
+class ShopCache(object):
+	def __init__(self, shop_id : str):
+		self.shop_id = shop_id
+		self.shop = None
+		self.products = None
+		self.storefront_actions = None
+		self.delivery_ids = None
+		self.active_orders = None
+		self.locked_orders = None
+		self.order_mappings = None
+
+	def get_shop(self):
+		if self.shop is None:
+			shops = get_shops_configobj()
+			self.shop = Shop.from_string(shops[shop_data_index][self.shop_id])
+		return self.shop
+
+	def get_products(self):
+		if self.products is None:
+			catalogue = get_catalogue(self.shop_id)
+			self.products = {
+				product_id: Product.from_string(string)
+				for (product_id, string) in catalogue.get(product_entries_index, {}).items()}
+		return self.products
+
+	def get_storefront_actions(self):
+		if self.storefront_actions is None:
+			storefront = get_storefront(self.shop_id)
+			self.storefront_actions = {
+				msg_id: StorefrontAction.from_string(string)
+				for (msg_id, string) in storefront.get(msg_mapping_index, {}).items()}
+		return self.storefront_actions
+
+	def get_delivery_ids(self):
+		if self.delivery_ids is None:
+			delivery_data = get_delivery_data(self.shop_id)
+			self.delivery_ids = dict(delivery_data.get(delivery_ids_index, {}))
+		return self.delivery_ids
+
+	def get_active_orders(self):
+		if self.active_orders is None:
+			order_data = get_order_data(self.shop_id)
+			self.active_orders = {
+				delivery_id: Order.from_string(string)
+				for (delivery_id, string) in order_data.get(active_orders_index, {}).items()}
+		return self.active_orders
+
+	def get_locked_orders(self):
+		if self.locked_orders is None:
+			order_data = get_order_data(self.shop_id)
+			self.locked_orders = {
+				order_id: Order.from_string(string)
+				for (order_id, string) in order_data.get(locked_orders_index, {}).items()}
+		return self.locked_orders
+
+	def get_order_mappings(self):
+		if self.order_mappings is None:
+			order_data = get_order_data(self.shop_id)
+			self.order_mappings = {
+				msg_id: MsgOrderMapping.from_string(string)
+				for (msg_id, string) in order_data.get(msg_to_order_mapping_index, {}).items()}
+		return self.order_mappings
+
+	def clear_orders(self):
+		self.active_orders = None
+		self.locked_orders = None
+		self.order_mappings = None
+
+# shop_id -> ShopCache
+shop_caches = {}
+
+def get_shop_cache(shop_name : str):
+	if shop_exists(shop_name):
+		shop_id = shop_name.lower()
+		if not shop_id in shop_caches:
+			shop_caches[shop_id] = ShopCache(shop_id)
+		return shop_caches[shop_id]
+
 def shop_exists(shop_name : str):
 	if shop_name is None:
 		return False
 	else:
-		return shop_name.lower() in get_all_shop_ids()
+		shop_id = shop_name.lower()
+		return shop_id != highest_ever_index and shop_id in get_shops_configobj()[shop_data_index]
 
 def get_all_shop_ids():
 	shops = get_shops_configobj()
@@ -772,12 +900,12 @@ def store_shop(shop : Shop):
 	shops = get_shops_configobj()
 	shops[shop_data_index][shop.shop_id] = shop.to_string()
 	shops.write()
+	get_shop_cache(shop.shop_id).shop = deepcopy(shop)
 
 def read_shop(shop_name : str):
-	shop_id = shop_name.lower()
-	shops = get_shops_configobj()
-	if shop_id in shops[shop_data_index]:
-		return Shop.from_string(shops[shop_data_index][shop_id])
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return deepcopy(cache.get_shop())
 
 def record_new_order(shop_name : str):
 	shop : Shop = read_shop(shop_name)
@@ -815,82 +943,132 @@ product_entries_index = '___products'
 def get_catalogue(shop_name : str):
 	shop_id = shop_name.lower()
 	catalogue_file_name = f'{shop_id}{catalogue_suffix}'
-	return ConfigObj(f'{shops_conf_dir}/{catalogue_file_name}')
+	return storage.get_conf(f'{shops_conf_dir}/{catalogue_file_name}')
 
 def get_all_products(shop_name : str):
-	catalogue = get_catalogue(shop_name)
-	for product_id in catalogue[product_entries_index]:
-		yield read_product_from_cat(catalogue, product_id)
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		for product in list(cache.get_products().values()):
+			yield deepcopy(product)
 
 def product_exists(shop_name : str, product_name : str):
 	return read_product(shop_name, product_name) is not None
 
 
 def store_product(shop_name : str, product : Product):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		catalogue = get_catalogue(shop_name)
 		catalogue[product_entries_index][product.product_id] = product.to_string()
 		catalogue.write()
+		cache.get_products()[product.product_id] = deepcopy(product)
 
 def delete_product(shop_name : str, product_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		catalogue = get_catalogue(shop_name)
 		if product_id in catalogue[product_entries_index]:
 			del catalogue[product_entries_index][product_id]
 			catalogue.write()
+		cache.get_products().pop(product_id, None)
 
 def read_product(shop_name : str, product_name : str):
-	if shop_exists(shop_name):
-		catalogue = get_catalogue(shop_name)
-		return read_product_from_cat(catalogue, product_name)
-
-def read_product_from_cat(catalogue, product_name : str):
-	product_id = product_name.lower()
-	if product_id in catalogue[product_entries_index]:
-		return Product.from_string(catalogue[product_entries_index][product_id])
+	cache = get_shop_cache(shop_name)
+	if cache is not None and product_name is not None:
+		return deepcopy(cache.get_products().get(product_name.lower()))
 
 def clear_catalogue(shop_name : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		catalogue = get_catalogue(shop_name)
 		catalogue[product_entries_index] = {}
 		catalogue[msg_mapping_index] = {}
 		catalogue.write()
+		cache.products = None
 
 
 storefront_suffix = '_storefront.conf'
 msg_mapping_index = '___storefront_msg_mappings'
 delivery_choice_msg_index = '___del_choice_msg'
 tipping_msg_index = '___tipping_msg'
+# msg_id -> hash of what was last published in the message, see get_content_hash()
+msg_hash_index = '___storefront_msg_hashes'
 
 def get_storefront(shop_name : str):
 	shop_id = shop_name.lower()
 	storefront_file_name = f'{shop_id}{storefront_suffix}'
-	return ConfigObj(f'{shops_conf_dir}/{storefront_file_name}')
+	return storage.get_conf(f'{shops_conf_dir}/{storefront_file_name}')
 
 def store_storefront_msg_mapping(shop_name : str, msg_id : str, action : StorefrontAction):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		storefront[msg_mapping_index][msg_id] = action.to_string()
 		storefront.write()
+		cache.get_storefront_actions()[msg_id] = deepcopy(action)
 
 def delete_storefront_msg_mapping(shop_name : str, msg_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		if msg_id in storefront[msg_mapping_index]:
 			del storefront[msg_mapping_index][msg_id]
 			storefront.write()
+		if msg_id in storefront.get(msg_hash_index, {}):
+			del storefront[msg_hash_index][msg_id]
+			storefront.write()
+		cache.get_storefront_actions().pop(msg_id, None)
 
 def read_storefront_msg_mapping(shop_name : str, msg_id : str):
-	if shop_exists(shop_name):
-		storefront = get_storefront(shop_name)
-		if msg_id in storefront[msg_mapping_index]:
-			return StorefrontAction.from_string(storefront[msg_mapping_index][msg_id])
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return deepcopy(cache.get_storefront_actions().get(msg_id))
 
 def delete_storefront_msg_mappings_for_shop(shop_name : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		for msg_id in storefront[msg_mapping_index]:
 			del storefront[msg_mapping_index][msg_id]
+		storefront[msg_hash_index] = {}
+		storefront.write()
+		cache.storefront_actions = None
+
+def get_storefront_msg_hash(shop_name : str, msg_id : str):
+	if shop_exists(shop_name):
+		storefront = get_storefront(shop_name)
+		if msg_id in storefront.get(msg_hash_index, {}):
+			return storefront[msg_hash_index][msg_id]
+
+def store_storefront_msg_hash(shop_name : str, msg_id : str, content_hash : str):
+	if shop_exists(shop_name):
+		storefront = get_storefront(shop_name)
+		if not msg_hash_index in storefront:
+			storefront[msg_hash_index] = {}
+		storefront[msg_hash_index][msg_id] = content_hash
+		storefront.write()
+
+def get_storefront_msg_hash_ids(shop_name : str):
+	if shop_exists(shop_name):
+		storefront = get_storefront(shop_name)
+		return list(storefront.get(msg_hash_index, {}))
+	return []
+
+# Messages that were removed by hand no longer count as published, so they are sent again
+def forget_missing_storefront_msg_hashes(shop_name : str, present_msg_ids):
+	if shop_exists(shop_name):
+		storefront = get_storefront(shop_name)
+		hashes = storefront.get(msg_hash_index, {})
+		missing = [msg_id for msg_id in hashes if not msg_id in present_msg_ids]
+		if len(missing) > 0:
+			for msg_id in missing:
+				del hashes[msg_id]
+			storefront.write()
+
+def clear_storefront_msg_hashes(shop_name : str):
+	if shop_exists(shop_name):
+		storefront = get_storefront(shop_name)
+		storefront[msg_hash_index] = {}
 		storefront.write()
 
 def get_delivery_choice_message(shop_name : str):
@@ -900,12 +1078,14 @@ def get_delivery_choice_message(shop_name : str):
 			return storefront[delivery_choice_msg_index]
 
 def store_delivery_choice_message(shop_name : str, msg_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		storefront[delivery_choice_msg_index] = msg_id
 		action = StorefrontAction(StorefrontActionTypes.SetDeliveryOption)
 		storefront[msg_mapping_index][msg_id] = action.to_string()
 		storefront.write()
+		cache.get_storefront_actions()[msg_id] = action
 
 def get_tipping_message(shop_name : str):
 	if shop_exists(shop_name):
@@ -914,22 +1094,27 @@ def get_tipping_message(shop_name : str):
 			return storefront[tipping_msg_index]
 
 def store_tipping_message(shop_name : str, msg_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		storefront[tipping_msg_index] = msg_id
 		action = StorefrontAction(StorefrontActionTypes.Tip)
 		storefront[msg_mapping_index][msg_id] = action.to_string()
 		storefront.write()
+		cache.get_storefront_actions()[msg_id] = action
 
 def clear_storefront(shop_name : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		storefront = get_storefront(shop_name)
 		storefront[msg_mapping_index] = {}
+		storefront[msg_hash_index] = {}
 		if delivery_choice_msg_index in storefront:
 			del storefront[delivery_choice_msg_index]
 		if tipping_msg_index in storefront:
 			del storefront[tipping_msg_index]
 		storefront.write()
+		cache.storefront_actions = None
 
 
 
@@ -941,38 +1126,40 @@ delivery_ids_index = '___delivery_ids'
 def get_delivery_data(shop_name : str):
 	shop_id = shop_name.lower()
 	delivery_data_file_name = f'{shop_id}{delivery_data_suffix}'
-	return ConfigObj(f'{shops_conf_dir}/{delivery_data_file_name}')
+	return storage.get_conf(f'{shops_conf_dir}/{delivery_data_file_name}')
 
 def player_has_delivery_id(shop_name : str, player_id : str):
 	return get_delivery_id(shop_name, player_id) is not None
 
 def store_delivery_id(shop_name : str, player_id : str, delivery_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		delivery_data = get_delivery_data(shop_name)
 		delivery_data[delivery_ids_index][player_id] = delivery_id
 		delivery_data.write()
+		cache.get_delivery_ids()[player_id] = delivery_id
 
 def delete_delivery_id(shop_name : str, player_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		delivery_data = get_delivery_data(shop_name)
 		if player_id in delivery_data[delivery_ids_index]:
 			del delivery_data[delivery_ids_index][player_id]
 			delivery_data.write()
+		cache.get_delivery_ids().pop(player_id, None)
 
 def get_delivery_id(shop_name : str, player_id : str):
-	if shop_exists(shop_name):
-		delivery_data = get_delivery_data(shop_name)
-		return read_delivery_id_from_del_data(delivery_data, player_id)
-
-def read_delivery_id_from_del_data(delivery_data, player_id : str):
-	if player_id in delivery_data[delivery_ids_index]:
-		return delivery_data[delivery_ids_index][player_id]
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return cache.get_delivery_ids().get(player_id)
 
 def clear_delivery_data(shop_name : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		delivery_data = get_delivery_data(shop_name)
 		delivery_data[delivery_ids_index] = {}
 		delivery_data.write()
+		cache.delivery_ids = None
 
 def delete_delivery_ids_for_actor(actor_id : str):
 	for shop_id in get_all_shop_ids():
@@ -1001,106 +1188,112 @@ msg_to_order_mapping_index = '___msg_to_order_mapping'
 def get_order_data(shop_name : str):
 	shop_id = shop_name.lower()
 	order_data_file_name = f'{shop_id}{order_data_suffix}'
-	return ConfigObj(f'{shops_conf_dir}/{order_data_file_name}')
+	return storage.get_conf(f'{shops_conf_dir}/{order_data_file_name}')
 
 def store_active_order(shop_name : str, order : Order):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		order_data = get_order_data(shop_name)
-		msg_id = str(order.order_flow_msg_id)
-		msg_mapping = MsgOrderMapping(order.delivery_id, OrderStatus.Active)
-		order_data[msg_to_order_mapping_index][msg_id] = msg_mapping.to_string()
+		if order.order_flow_msg_id is not None:
+			msg_id = str(order.order_flow_msg_id)
+			msg_mapping = MsgOrderMapping(order.delivery_id, OrderStatus.Active)
+			order_data[msg_to_order_mapping_index][msg_id] = msg_mapping.to_string()
+			cache.get_order_mappings()[msg_id] = msg_mapping
 		order_data[active_orders_index][order.delivery_id] = order.to_string()
 		order_data.write()
+		cache.get_active_orders()[order.delivery_id] = deepcopy(order)
+		schedule_order_board_update(shop_name)
 
 def delete_active_order(shop_name : str, delivery_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		order_data = get_order_data(shop_name)
 		if delivery_id in order_data[active_orders_index]:
 			del order_data[active_orders_index][delivery_id]
 			order_data.write()
+		cache.get_active_orders().pop(delivery_id, None)
 
 # Treat all output from this as read-only! If you need to edit the order, use fetch_order instead!
 def get_active_order(shop_name : str, delivery_id : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		return read_active_order_from_order_data(order_data, delivery_id)
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return deepcopy(cache.get_active_orders().get(delivery_id))
 
 def fetch_all_active_orders(shop_name : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		for delivery_id in order_data[active_orders_index]:
-			yield fetch_active_order_from_order_data(order_data, delivery_id)
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		for delivery_id in list(cache.get_active_orders()):
+			yield fetch_active_order(shop_name, delivery_id)
 
 def fetch_active_order(shop_name : str, delivery_id : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		return fetch_active_order_from_order_data(order_data, delivery_id)
-
-def read_active_order_from_order_data(order_data, delivery_id : str):
-	if delivery_id in order_data[active_orders_index]:
-		return Order.from_string(order_data[active_orders_index][delivery_id])
-
-def fetch_active_order_from_order_data(order_data, delivery_id : str):
-	if delivery_id in order_data[active_orders_index]:
-		order = Order.from_string(order_data[active_orders_index][delivery_id])
-		del order_data[active_orders_index][delivery_id]
-		msg_id = str(order.order_flow_msg_id)
-		if msg_id in order_data[msg_to_order_mapping_index]:
-			del order_data[msg_to_order_mapping_index][msg_id]
-		order_data.write()
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		order = cache.get_active_orders().pop(delivery_id, None)
+		if order is not None:
+			order_data = get_order_data(shop_name)
+			del order_data[active_orders_index][delivery_id]
+			remove_order_mapping(cache, order_data, order)
+			order_data.write()
+			schedule_order_board_update(shop_name)
 		return order
 
 
 # The locked orders are stored indexed on order number
 def store_locked_order(shop_name : str, order : Order):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		order_data = get_order_data(shop_name)
-		msg_id = str(order.order_flow_msg_id)
-		msg_mapping = MsgOrderMapping(order.order_id, OrderStatus.Locked)
-		order_data[msg_to_order_mapping_index][msg_id] = msg_mapping.to_string()
+		if order.order_flow_msg_id is not None:
+			msg_id = str(order.order_flow_msg_id)
+			msg_mapping = MsgOrderMapping(order.order_id, OrderStatus.Locked)
+			order_data[msg_to_order_mapping_index][msg_id] = msg_mapping.to_string()
+			cache.get_order_mappings()[msg_id] = msg_mapping
 		order_data[locked_orders_index][order.order_id] = order.to_string()
 		order_data.write()
+		cache.get_locked_orders()[order.order_id] = deepcopy(order)
+		schedule_order_board_update(shop_name)
 
 def delete_locked_order(shop_name : str, order_id : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		order_data = get_order_data(shop_name)
 		if order_id in order_data[locked_orders_index]:
 			del order_data[locked_orders_index][order_id]
 			order_data.write()
+		cache.get_locked_orders().pop(order_id, None)
 
 def get_locked_order(shop_name : str, order_id : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		return read_locked_order_from_order_data(order_data, order_id)
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return deepcopy(cache.get_locked_orders().get(order_id))
 
 def fetch_locked_order(shop_name : str, order_id : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		return fetch_locked_order_from_order_data(order_data, order_id)
-
-def read_locked_order_from_order_data(order_data, order_id : str):
-	if order_id in order_data[locked_orders_index]:
-		return Order.from_string(order_data[locked_orders_index][order_id])
-
-def fetch_locked_order_from_order_data(order_data, order_id : str):
-	if order_id in order_data[locked_orders_index]:
-		order = Order.from_string(order_data[locked_orders_index][order_id])
-		del order_data[locked_orders_index][order_id]
-		msg_id = str(order.order_flow_msg_id)
-		if msg_id in order_data[msg_to_order_mapping_index]:
-			del order_data[msg_to_order_mapping_index][msg_id]
-		order_data.write()
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		order = cache.get_locked_orders().pop(order_id, None)
+		if order is not None:
+			order_data = get_order_data(shop_name)
+			del order_data[locked_orders_index][order_id]
+			remove_order_mapping(cache, order_data, order)
+			order_data.write()
+			schedule_order_board_update(shop_name)
 		return order
 
+def remove_order_mapping(cache : ShopCache, order_data, order : Order):
+	msg_id = str(order.order_flow_msg_id)
+	if msg_id in order_data[msg_to_order_mapping_index]:
+		del order_data[msg_to_order_mapping_index][msg_id]
+	cache.get_order_mappings().pop(msg_id, None)
+
 def get_order_mapping_from_msg(shop_name : str, msg_id : str):
-	if shop_exists(shop_name):
-		order_data = get_order_data(shop_name)
-		if msg_id in order_data[msg_to_order_mapping_index]:
-			return MsgOrderMapping.from_string(order_data[msg_to_order_mapping_index][msg_id])
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
+		return deepcopy(cache.get_order_mappings().get(msg_id))
 
 
 async def clear_order_data(shop_name : str):
-	if shop_exists(shop_name):
+	cache = get_shop_cache(shop_name)
+	if cache is not None:
 		order_data = get_order_data(shop_name)
 		if active_orders_index not in order_data:
 			order_data[active_orders_index] = {}
@@ -1116,6 +1309,8 @@ async def clear_order_data(shop_name : str):
 		order_data[locked_orders_index] = {}
 		order_data[msg_to_order_mapping_index] = {}
 		order_data.write()
+		cache.clear_orders()
+		schedule_order_board_update(shop_name)
 
 
 
@@ -1491,15 +1686,64 @@ async def update_storefront(user_id : str, shop_name : str):
 	shop : Shop = result.shop
 
 	channel = channels.get_discord_channel(shop.storefront_channel_id)
+	await forget_deleted_storefront_messages(shop, channel)
+
+	# Each message is only touched if its content hash differs from what was last published in it
+	updated = 0
+	skipped = 0
+	sent_new_messages = await update_storefront_delivery_choice_message(shop, channel)
+	if sent_new_messages is None:
+		skipped += 1
+	else:
+		updated += 1
+
+	products = list(get_all_products(shop.shop_id))
+	changed = [p for p in products if catalogue_item_changed(shop, p)]
+	skipped += len([p for p in products if p.available]) - len([p for p in changed if p.available])
+	updated += len(changed)
+
+	# Existing messages are edited (or deleted) a few at a time
+	semaphore = asyncio.Semaphore(max_concurrent_storefront_edits)
+	async def edit_with_limit(product):
+		async with semaphore:
+			return await edit_catalogue_item_message(shop, channel, product)
+	to_edit = [p for p in changed if p.storefront_msg_id is not None]
+	edited = await asyncio.gather(*[edit_with_limit(p) for p in to_edit])
+	missing = set(p.product_id for (p, done) in zip(to_edit, edited) if not done)
+
+	# New messages are sent one at a time, so that the menu keeps the order of the catalogue
+	for product in changed:
+		if product.available and (product.storefront_msg_id is None or product.product_id in missing):
+			await send_catalogue_item_message(shop, channel, product)
+			sent_new_messages = True
+
+	# The tipping message must stay at the bottom, so it is re-posted if anything was sent after it
+	tipping_updated = await update_storefront_tipping_message(shop, channel, must_repost=sent_new_messages)
+	if tipping_updated is not None:
+		if tipping_updated:
+			updated += 1
+		else:
+			skipped += 1
 
-	await update_storefront_delivery_choice_message(shop, channel)
+	return f'Done. Updated {updated} storefront messages ({skipped} unchanged).'
 
-	for product in get_all_products(shop.shop_id):
-		await update_catalogue_item_message(shop, channel, product)
+max_concurrent_storefront_edits = 5
+# Other messages (e.g. the ordering instructions) that may be mixed in with the ones we keep hashes for
+storefront_history_slack = 10
 
-	await update_storefront_tipping_message(shop, channel)
+# Unchanged messages are never edited, so a message deleted by hand would otherwise never be noticed.
+# Only the part of the channel holding the hashed messages is read, and at most one page for a normal menu.
+async def forget_deleted_storefront_messages(shop : Shop, channel):
+	msg_ids = get_storefront_msg_hash_ids(shop.shop_id)
+	if len(msg_ids) == 0:
+		return
+	oldest = discord.Object(id=min(int(msg_id) for msg_id in msg_ids) - 1)
+	history = await channel.history(limit=len(msg_ids) + storefront_history_slack, after=oldest).flatten()
+	forget_missing_storefront_msg_hashes(shop.shop_id, set(str(m.id) for m in history))
 
-	return 'Done.'
+# Hash of the content and reactions of a storefront message, to tell whether it needs to be updated
+def get_content_hash(content : str, emojis):
+	return hashlib.sha1((content + ''.join(emojis)).encode('utf-8')).hexdigest()
 
 
 # Delivery choice message: a welcome message that allows customers to choose where to get their order delivered
@@ -1515,8 +1759,12 @@ async def update_storefront_delivery_choice_message(shop : Shop, channel):
 		f'{bar_emoji}: serve at the bar\n' +
 		f'{call_emoji}: call out my current handle when the order is ready (note: you need to click this again if you switch handle)'
 		)
+	content_hash = get_content_hash(content, get_delivery_choice_emojis(max_table_number))
 	previous_message_exists = False
 	prev_msg_id = get_delivery_choice_message(shop.shop_id)
+	if prev_msg_id is not None and get_storefront_msg_hash(shop.shop_id, prev_msg_id) == content_hash:
+		# Nothing to update
+		return None
 	if prev_msg_id is not None:
 		try:
 			message = await channel.fetch_message(prev_msg_id)
@@ -1529,7 +1777,9 @@ async def update_storefront_delivery_choice_message(shop : Shop, channel):
 			pass
 
 	if not previous_message_exists:
+		# The purge removes all the other storefront messages as well
 		await channel.purge()
+		clear_storefront_msg_hashes(shop.shop_id)
 		message = await channel.send(content)
 		await channel.send(
 			f'{common.hard_space}\n' +
@@ -1540,12 +1790,16 @@ async def update_storefront_delivery_choice_message(shop : Shop, channel):
 	else:
 		await add_delivery_choice_reactions(message, max_table_number)
 		store_delivery_choice_message(shop.shop_id, str(message.id))
+		store_storefront_msg_hash(shop.shop_id, str(message.id), content_hash)
+	# Returns whether new messages were sent to the storefront
+	return not previous_message_exists
+
+def get_delivery_choice_emojis(max_tables : int):
+	return number_emojis[:(max_tables+1)] + [bar_emoji, call_emoji]
 
 async def add_delivery_choice_reactions(message, max_tables : int):
-	for e in number_emojis[:(max_tables+1)]:
+	for e in get_delivery_choice_emojis(max_tables):
 		await message.add_reaction(e)
-	await message.add_reaction(bar_emoji)
-	await message.add_reaction(call_emoji)
 
 ### The menu/catalogue: product information messages where players can order by pressing reactions
 
@@ -1564,6 +1818,24 @@ async def post_catalogue_item(user_id : str, product_name : str, shop_name : str
 
 
 async def update_catalogue_item_message(shop : Shop, channel, product : Product):
+	done = await edit_catalogue_item_message(shop, channel, product)
+	if not done:
+		await send_catalogue_item_message(shop, channel, product)
+
+def get_catalogue_item_emojis(product : Product):
+	return [product.emoji] if product.in_stock else []
+
+def catalogue_item_changed(shop : Shop, product : Product):
+	if not product.available:
+		return product.storefront_msg_id is not None
+	if product.storefront_msg_id is None:
+		return True
+	content_hash = get_content_hash(generate_catalogue_item_message(product), get_catalogue_item_emojis(product))
+	return get_storefront_msg_hash(shop.shop_id, product.storefront_msg_id) != content_hash
+
+# Deletes the message of an unavailable product, or updates the existing message of an available one.
+# Returns False if a new message must be sent instead.
+async def edit_catalogue_item_message(shop : Shop, channel, product : Product):
 	if not product.available:
 		if product.storefront_msg_id is not None:
 			delete_storefront_msg_mapping(shop.shop_id, product.storefront_msg_id)
@@ -1574,47 +1846,44 @@ async def update_catalogue_item_message(shop : Shop, channel, product : Product)
 				# Reference to a message in storefront that is no longer available
 				# Doesn't matter since the product should not be available anyway
 				pass
-		return
+			product.storefront_msg_id = None
+			store_product(shop.shop_id, product)
+		return True
 
-	# If we get here, the product is set to available, so we need to
-	# either post the message or edit the existing one to updated description
+	if product.storefront_msg_id is None:
+		return False
+	# Instead of sending a new message, update the existing one
 	content = generate_catalogue_item_message(product)
-	previous_msg = product.storefront_msg_id
-	if previous_msg is not None:
-		# Instead of sending a new message, update the existing one
-		delete_storefront_msg_mapping(shop.shop_id, product.storefront_msg_id)
-		try:
-			message = await channel.fetch_message(product.storefront_msg_id)
-			await asyncio.gather(
-				*[asyncio.create_task(c)
-				for c
-				in [message.clear_reactions(), message.edit(content=content)]]
-				)
-		except discord.errors.NotFound:
-			# Reference to a message in storefront that is no longer available
-			# Either due to reinitialize(), or due to being removed by an admin
-			previous_msg = None
-	if previous_msg is None:
-		# There is no previous message to update so we must send a new one
-		message = await channel.send(content)
-
-	if message is not None:
-		product.storefront_msg_id = str(message.id)
-		if product.in_stock:
-			await message.add_reaction(product.emoji)
-		action = StorefrontAction(StorefrontActionTypes.Order, data=product.product_id)
-		store_storefront_msg_mapping(shop.shop_id, product.storefront_msg_id, action)
-		store_product(shop.shop_id, product)
-	else:
-		raise RuntimeError(f'Error: failed to publish product, dump: {product.to_string()}')
-
+	delete_storefront_msg_mapping(shop.shop_id, product.storefront_msg_id)
+	try:
+		message = await channel.fetch_message(product.storefront_msg_id)
+		await asyncio.gather(
+			*[asyncio.create_task(c)
+			for c
+			in [message.clear_reactions(), message.edit(content=content)]]
+			)
+	except discord.errors.NotFound:
+		# Reference to a message in storefront that is no longer available
+		# Either due to reinitialize(), or due to being removed by an admin
+		return False
+	await finish_catalogue_item_message(shop, message, product, content)
+	return True
 
-async def edit_catalogue_item_message(channel, product):
+async def send_catalogue_item_message(shop : Shop, channel, product : Product):
 	content = generate_catalogue_item_message(product)
 	message = await channel.send(content)
-	if product.in_stock:
-		await message.add_reaction(product.emoji)
-	return str(message.id)
+	if message is None:
+		raise RuntimeError(f'Error: failed to publish product, dump: {product.to_string()}')
+	await finish_catalogue_item_message(shop, message, product, content)
+
+async def finish_catalogue_item_message(shop : Shop, message, product : Product, content : str):
+	product.storefront_msg_id = str(message.id)
+	for emoji in get_catalogue_item_emojis(product):
+		await message.add_reaction(emoji)
+	action = StorefrontAction(StorefrontActionTypes.Order, data=product.product_id)
+	store_storefront_msg_mapping(shop.shop_id, product.storefront_msg_id, action)
+	store_storefront_msg_hash(shop.shop_id, product.storefront_msg_id, get_content_hash(content, get_catalogue_item_emojis(product)))
+	store_product(shop.shop_id, product)
 
 def generate_catalogue_item_message(product):
 	if product.in_stock:
@@ -1629,11 +1898,23 @@ def generate_catalogue_item_message(product):
 
 # The tipping message: reactions here will transfer some money to the staff
 
-async def update_storefront_tipping_message(shop : Shop, channel):
+# Returns None if there is no tipping message, otherwise whether it had to be updated
+async def update_storefront_tipping_message(shop : Shop, channel, must_repost : bool=True):
 	prev_msg_id = get_tipping_message(shop.shop_id)
-	# The tipping message is at the bottom of the channel, so it needs to be re-posted every time to ensure the correct order
-	#if msg_id is not None: #If there is no tipping data recorded, no need to do anything.
-	#	store_tipping_message(shop.shop_id, msg_id)
+	tipping_tuples = shop.generate_tips_list()
+	content = None
+	if len(tipping_tuples) > 0:
+		content = 'Don\'t forget to tip the servers and staff! Working right now:\n'
+		for (handle_id, emoji) in tipping_tuples:
+			content += f'{emoji}: **{handle_id}**\n'
+		content += f'One reaction = **{coin} 1**!'
+		content_hash = get_content_hash(content, [emoji for (_, emoji) in tipping_tuples])
+		if (not must_repost
+			and prev_msg_id is not None
+			and get_storefront_msg_hash(shop.shop_id, prev_msg_id) == content_hash):
+			return False
+
+	# The tipping message is at the bottom of the channel, so it needs to be re-posted to ensure the correct order
 	if prev_msg_id is not None:
 		# Delete the previous message
 		delete_storefront_msg_mapping(shop.shop_id, prev_msg_id)
@@ -1643,26 +1924,20 @@ async def update_storefront_tipping_message(shop : Shop, channel):
 		except discord.errors.NotFound:
 			pass
 
-	tipping_tuples = shop.generate_tips_list()
-	if len(tipping_tuples) > 0:
-		content = 'Don\'t forget to tip the servers and staff! Working right now:\n'
-		for (handle_id, emoji) in tipping_tuples:
-			content += f'{emoji}: **{handle_id}**\n'
-		content += f'One reaction = **{coin} 1**!'
+	if content is not None:
 		message = await channel.send(content)
 		if message is not None:
 			store_tipping_message(shop.shop_id, str(message.id))
+			store_storefront_msg_hash(shop.shop_id, str(message.id), content_hash)
 			for (_, emoji) in tipping_tuples:
 				print(f'Adding reaction: {emoji}')
 				await message.add_reaction(emoji)
 		else:
 			raise RuntimeError(f'Failed to post tipping message for shop, dump: {shop.to_string()}')
+		return True
 	else:
-		# No employees with valid tipping handles -> no action
-		pass
-
-
-	
+		# No employees with valid tipping handles -> only the old message had to be removed
+		return True if prev_msg_id is not None else None
 
 
 
@@ -1744,34 +2019,35 @@ async def process_reaction_in_order_flow(channel_id : str, msg_id : str, emoji :
 		# No action, but no report required either.
 		return result
 
-	order = None
-	sem_success = await get_order_semaphore(shop.shop_id, mapping.identifier)
-	if not sem_success:
+	try:
+		async with lock_order(shop.shop_id, mapping.identifier):
+			result.report = await update_order_from_reaction(shop, mapping, emoji)
+	except locks.LockTimeout:
 		result.report = f'Error: system overloaded. Try again in a minute.'
 		return result
+
+	# The above function will only return something in the error case
+	result.success = result.report is None
+	return result
+
+async def update_order_from_reaction(shop : Shop, mapping : MsgOrderMapping, emoji : str):
+	order = None
 	print(f'Trying to mark order {mapping.identifier}, {mapping.status} as {emoji}')
 	if mapping.status == OrderStatus.Active:
 		order = fetch_active_order(shop.shop_id, mapping.identifier)
 	elif mapping.status == OrderStatus.Locked:
 		order = fetch_locked_order(shop.shop_id, mapping.identifier)
 	if order is None:
-		return_order_semaphore(shop.shop_id, mapping.identifier)
-		result.report = f'Error: tried to fetch order for {mapping.identifier} but could not find it. DB corrupt.'
-		return result
+		return f'Error: tried to fetch order for {mapping.identifier} but could not find it. DB corrupt.'
 
 	datetime_timestamp = datetime.datetime.today()
 	timestamp = PostTimestamp(datetime_timestamp.hour, datetime_timestamp.minute)
 	order.time_updated = timestamp
 
 	if mapping.status == OrderStatus.Active and emoji == emoji_locked:
-		result.report = await lock_active_order(shop, order)
+		return await lock_active_order(shop, order)
 	elif emoji == emoji_accept:
-		result.report = await deliver_order(shop, order, mapping.status)
-	return_order_semaphore(shop.shop_id, mapping.identifier)
-
-	# The above functions will only return something in the error case
-	result.success = result.report is None
-	return result
+		return await deliver_order(shop, order, mapping.status)
 
 
 
@@ -1797,10 +2073,23 @@ def generate_order_message(order : Order, status : OrderStatus):
 		content += f'> Total: {coin} {order.price_total} ({order.paid_total} paid)'
 	return content
 
+# Only removes the reactions that are no longer actionable, and adds the ones that are missing
 async def add_gui_reactions_to_order(message, status : OrderStatus):
-	await message.clear_reactions()
-	for emoji in get_actionable_emojis(status):
-		await message.add_reaction(emoji)
+	actionable_emojis = get_actionable_emojis(status)
+	if len(actionable_emojis) == 0:
+		if len(message.reactions) > 0:
+			await message.clear_reactions()
+		return
+	present_emojis = []
+	for reaction in message.reactions:
+		emoji = str(reaction.emoji)
+		if not emoji in actionable_emojis:
+			await message.clear_reaction(emoji)
+		elif reaction.me:
+			present_emojis.append(emoji)
+	for emoji in actionable_emojis:
+		if not emoji in present_emojis:
+			await message.add_reaction(emoji)
 
 
 async def order_product_from_command(user_id : str, shop_name : str, product_name : str):
@@ -1830,43 +2119,13 @@ async def order_product_for_buyer(shop_name : str, product_name : str, buyer_han
 	result : ActionResult = await order_product(shop, product, buyer_handle)
 	return result.report
 
-# Semaphores for order, for when someone tries to add to order, lock/deliver order, and/or refund order at the same time
+# Locks for orders, for when someone tries to add to order, lock/deliver order, and/or refund order at the same time
+# Use as "async with lock_order(shop_id, delivery_id):"; raises locks.LockTimeout if the shop is too busy.
 
-delivery_ids_semaphores = {}
+order_locks = locks.KeyedLocks('orders')
 
-async def get_order_semaphore(shop_id : str, delivery_id : str):
-	global delivery_ids_semaphores
-	sem_id = shop_id + delivery_id
-	sem_value = random.randrange(10000)
-	number_iterations = 0
-	while True:
-		if sem_id not in delivery_ids_semaphores:
-			delivery_ids_semaphores[sem_id] = sem_value
-			await asyncio.sleep(0.5)
-			if delivery_ids_semaphores[sem_id] == sem_value:
-				break
-		await asyncio.sleep(0.5)
-		number_iterations += 1
-		if number_iterations > 120:
-			print(f'Error: semaphore probably stuck! Resetting semaphore for {sem_id}.')
-			if delivery_id in delivery_ids_semaphores:
-				del delivery_ids_semaphores[sem_id]
-			return False
-	return True
-
-def return_order_semaphore(shop_id : str, delivery_id :str):
-	global delivery_ids_semaphores
-	sem_id = shop_id + delivery_id
-	if sem_id in delivery_ids_semaphores:
-		del delivery_ids_semaphores[sem_id]
-	else:
-		print(f'Semaphore error: tried to return semaphore for {sem_id} but it was already free!')
-
-def clear_order_semaphores_for_shop(shop_id : str):
-	global delivery_ids_semaphores
-	for sem_id in delivery_ids_semaphores:
-		if sem_id.startswith(shop_id):
-			del delivery_ids_semaphores[sem_id]
+def lock_order(shop_id : str, delivery_id : str):
+	return order_locks.hold((shop_id, delivery_id))
 
 
 async def order_product(shop : Shop, product : Product, buyer_handle : Handle):
@@ -1884,10 +2143,14 @@ async def order_product(shop : Shop, product : Product, buyer_handle : Handle):
 		delivery_id = delivery_id + " [UNPAID]"
 		must_be_pre_paid = False
 
-	sem_success = await get_order_semaphore(shop.shop_id, delivery_id)
-	if not sem_success:
-		return f'Error: {shop.name} is overloaded. Wait a minute and try again.'
+	try:
+		async with lock_order(shop.shop_id, delivery_id):
+			await pay_and_place_order(shop, product, buyer_handle, delivery_id, must_be_pre_paid, result)
+	except locks.LockTimeout:
+		result.report = f'Error: {shop.name} is overloaded. Wait a minute and try again.'
+	return result
 
+async def pay_and_place_order(shop : Shop, product : Product, buyer_handle : Handle, delivery_id : str, must_be_pre_paid : bool, result : ActionResult):
 	# TODO: use "from_reaction" somehow to ensure not all transaction failures end up in cmd line?
 	datetime_timestamp = datetime.datetime.today()
 	timestamp = PostTimestamp(datetime_timestamp.hour, datetime_timestamp.minute)
@@ -1912,8 +2175,6 @@ async def order_product(shop : Shop, product : Product, buyer_handle : Handle):
 
 		result.report = f'Successfully ordered {product.name} from {shop.name}'
 		result.success = True
-	return_order_semaphore(shop.shop_id, delivery_id)
-	return result
 
 async def place_order_in_flow(shop : Shop, purchase : Transaction, delivery_id : str, pre_paid : bool):
 	previous_order_updated = False
@@ -1922,15 +2183,16 @@ async def place_order_in_flow(shop : Shop, purchase : Transaction, delivery_id :
 		# The previous order will have been deleted from active_orders
 		time_diff = PostTimestamp.get_time_diff(order.time_created, purchase.timestamp)
 		if time_diff <= shop.order_collection_limit:
-			order = await add_to_active_order(shop, order, purchase, pre_paid)
+			order = add_to_active_order(order, purchase, pre_paid)
 			previous_order_updated = True
+			if not shop.board_mode:
+				order_message_updater.schedule((shop.shop_id, delivery_id))
 		else:
 			# Lock the previous order
 			order.time_updated = purchase.timestamp
 			await lock_active_order(shop, order)
 
 	if not previous_order_updated:
-		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
 		order_id = str(record_new_order(shop.shop_id))
 		order = Order(
 			order_id,
@@ -1939,46 +2201,82 @@ async def place_order_in_flow(shop : Shop, purchase : Transaction, delivery_id :
 			paid_total = purchase.amount if pre_paid else 0,
 			items_ordered = {purchase.data: 1},
 			time_created = purchase.timestamp,
-			undo_hooks = purchase.get_undo_hooks_list()
+			undo_hooks = purchase.get_undo_hooks_list(),
+			created = time.time()
 			)
-		post = generate_order_message(order, OrderStatus.Active)
-		message = await order_flow_channel.send(post)
-		await add_gui_reactions_to_order(message, OrderStatus.Active)
-		order.order_flow_msg_id = message.id
+		if not shop.board_mode:
+			order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
+			post = generate_order_message(order, OrderStatus.Active)
+			message = await order_flow_channel.send(post)
+			await add_gui_reactions_to_order(message, OrderStatus.Active)
+			order.order_flow_msg_id = message.id
+		schedule_order_lock(shop, order)
 	store_active_order(shop.shop_id, order)
 
 
 
-async def add_to_active_order(shop : Shop, order : Order, purchase : Transaction, pre_paid : bool):
+def add_to_active_order(order : Order, purchase : Transaction, pre_paid : bool):
 	order.add(purchase.data, purchase.amount, purchase.timestamp, pre_paid)
-	order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
-	order_flow_message = await order_flow_channel.fetch_message(order.order_flow_msg_id)
-	content = generate_order_message(order, OrderStatus.Active)
-	await order_flow_message.delete()
-	new_message = await order_flow_channel.send(content)
-	await add_gui_reactions_to_order(new_message, OrderStatus.Active)
-	# The mapping to the order message itself, for when we need to update it:
-	order.order_flow_msg_id = new_message.id
 	# The mapping to the messages in each player's respective finance channel, which
 	# we need to find when we lock or complete the order, to take away the "undo" possibility
 	for t in purchase.get_undo_hooks_list():
 		order.undo_hooks.append(t)
 	return order
 
+# Additions to an active order are shown by editing its order flow message in place (the reactions stay valid).
+# Additions to the same order that arrive close together are shown in a single edit.
+order_message_window : float = 2.0
+
+async def update_active_order_message(key):
+	(shop_id, delivery_id) = key
+	async with lock_order(shop_id, delivery_id):
+		order = get_active_order(shop_id, delivery_id)
+		if order is None:
+			# Locked, delivered or cancelled in the meantime -- the message has already been updated for that
+			return
+		shop : Shop = read_shop(shop_id)
+		if shop.board_mode:
+			return
+		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
+		content = generate_order_message(order, OrderStatus.Active)
+		if order.order_flow_msg_id is not None:
+			try:
+				await order_flow_channel.get_partial_message(int(order.order_flow_msg_id)).edit(content=content)
+				return
+			except discord.errors.NotFound:
+				pass
+		# Post a new message -- there may be an old one that we have lost track of, but this is better than nothing
+		message = await order_flow_channel.send(content)
+		await add_gui_reactions_to_order(message, OrderStatus.Active)
+		order = fetch_active_order(shop_id, delivery_id)
+		order.order_flow_msg_id = message.id
+		store_active_order(shop_id, order)
+
+order_message_updater = debounce.Debouncer('order message', order_message_window, update_active_order_message)
+
 
 async def lock_active_order(shop : Shop, order : Order):
 	await order.remove_undo_hooks()
+	if shop.board_mode:
+		store_locked_order(shop.shop_id, order)
+		return
 	content = generate_order_message(order, OrderStatus.Locked)
 
 	try:
 		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
 	except discord.errors.NotFound:
 		return f'Error: could not edit order, {shop.name} database is corrupt.'
-	try:
-		order_flow_message = await order_flow_channel.fetch_message(order.order_flow_msg_id)
+	order_flow_message = None
+	# There is no message if the order was placed while the shop was in board mode
+	if order.order_flow_msg_id is not None:
+		try:
+			order_flow_message = await order_flow_channel.fetch_message(order.order_flow_msg_id)
+		except discord.errors.NotFound:
+			pass
+	if order_flow_message is not None:
 		await order_flow_message.edit(content=content)
 		await add_gui_reactions_to_order(order_flow_message, OrderStatus.Locked)
-	except discord.errors.NotFound:
+	else:
 		# Post a new message -- there may be an old one that we have lost track of, but this is better than nothing
 		message = await order_flow_channel.send(content)
 		await add_gui_reactions_to_order(message, OrderStatus.Locked)
@@ -1990,6 +2288,9 @@ async def lock_active_order(shop : Shop, order : Order):
 async def deliver_order(shop : Shop, order : Order, status : OrderStatus):
 	if status == OrderStatus.Active:
 		await order.remove_undo_hooks()
+	if shop.board_mode or order.order_flow_msg_id is None:
+		# The order is simply taken off the board
+		return
 
 	try:
 		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
@@ -2007,6 +2308,244 @@ async def deliver_order(shop : Shop, order : Order, status : OrderStatus):
 	# (The last message is left in the discord channel, but will disappear on the next clear_orders)
 
 
+### The order board
+# In board mode, a shop's orders are not posted one message each in the order flow channel.
+# Instead, a single pinned message lists all active and locked orders. It is rebuilt from the
+# shop's cached orders whenever they change, but edited at most once per order_board_window.
+# Active orders are locked automatically when their time is up, and delivered with ".deliver".
+
+order_board_window : float = 5.0
+# Discord messages are limited to 2000 characters
+order_board_max_length = 2000
+
+def generate_order_board_line(order : Order, status : OrderStatus):
+	if status == OrderStatus.Active:
+		line = f'**#{order.order_id}** for **{order.delivery_id}** {emoji_unlocked} {order.time_created.pretty_print()}: '
+	else:
+		line = f'**#{order.order_id}** for **{order.delivery_id}** {emoji_locked} {order.time_updated.pretty_print()}: '
+	line += ', '.join(f'{amount} {item}' for (item, amount) in order.items_ordered.items())
+	return line
+
+def generate_order_board(shop : Shop):
+	cache = get_shop_cache(shop.shop_id)
+	lines = (
+		[generate_order_board_line(o, OrderStatus.Locked)
+		for o in sorted(cache.get_locked_orders().values(), key=lambda o: int(o.order_id))]
+		+ [generate_order_board_line(o, OrderStatus.Active)
+		for o in sorted(cache.get_active_orders().values(), key=lambda o: int(o.order_id))]
+		)
+	content = f'**Orders at {shop.name}**\n'
+	if len(lines) == 0:
+		return content + '> No orders right now.'
+	for i, line in enumerate(lines):
+		remaining = f'> ...and {len(lines) - i} more'
+		if len(content) + len(line) + len(remaining) + 3 > order_board_max_length:
+			return content + remaining
+		content += f'> {line}\n'
+	return content
+
+async def update_order_board(shop_id : str):
+	shop : Shop = read_shop(shop_id)
+	if shop is None or not shop.board_mode:
+		return
+	order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
+	content = generate_order_board(shop)
+	if shop.board_msg_id is not None:
+		try:
+			await order_flow_channel.get_partial_message(int(shop.board_msg_id)).edit(content=content)
+			return
+		except discord.errors.NotFound:
+			# E.g. removed by clear_orders
+			pass
+	message = await order_flow_channel.send(content)
+	await message.pin()
+	shop.board_msg_id = str(message.id)
+	store_shop(shop)
+
+order_board_updater = debounce.Debouncer('order board', order_board_window, update_order_board)
+
+def schedule_order_board_update(shop_name : str):
+	shop : Shop = read_shop(shop_name)
+	if shop is not None and shop.board_mode:
+		order_board_updater.schedule(shop.shop_id)
+
+async def set_order_board_from_command(user_id : str, value : str, shop_name : str):
+	result : FindShopResult = await find_shop_for_command(user_id, shop_name, must_be_owner=True)
+	if result.error_report is not None or result.shop is None:
+		return result.error_report
+	shop : Shop = result.shop
+	if value not in ['on', 'off']:
+		return f'Error: use \".order_board on\" or \".order_board off\".'
+
+	shop.board_mode = value == 'on'
+	if not shop.board_mode and shop.board_msg_id is not None:
+		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
+		try:
+			await order_flow_channel.get_partial_message(int(shop.board_msg_id)).delete()
+		except discord.errors.NotFound:
+			pass
+		shop.board_msg_id = None
+	store_shop(shop)
+	if shop.board_mode:
+		await order_board_updater.run(shop.shop_id)
+		return f'{shop.name} now shows its orders on a board. Use \".deliver <order number>\" when an order has been delivered.'
+	else:
+		return f'{shop.name} now shows each new order as a message of its own.'
+
+def find_order(shop_id : str, order_id : str):
+	order = get_locked_order(shop_id, order_id)
+	if order is not None:
+		return (order, OrderStatus.Locked)
+	for order in get_shop_cache(shop_id).get_active_orders().values():
+		if order.order_id == order_id:
+			return (deepcopy(order), OrderStatus.Active)
+	return (None, None)
+
+async def deliver_order_from_command(user_id : str, order_id : str, shop_name : str):
+	result : FindShopResult = await find_shop_for_command(user_id, shop_name)
+	if result.error_report is not None or result.shop is None:
+		return result.error_report
+	shop : Shop = result.shop
+	if order_id is None:
+		return f'Error: must give the order number; use \".deliver <order_number>\"'
+	order_id = order_id.lstrip('#')
+
+	(order, status) = find_order(shop.shop_id, order_id)
+	if order is None:
+		return f'Error: {shop.name} has no active or locked order #{order_id}.'
+	# Same keys as in process_reaction_in_order_flow
+	identifier = order.delivery_id if status == OrderStatus.Active else order.order_id
+	try:
+		async with lock_order(shop.shop_id, identifier):
+			(order, status) = find_order(shop.shop_id, order_id)
+			if order is None:
+				return f'Error: order #{order_id} has already been delivered or cancelled.'
+			if status == OrderStatus.Active:
+				order = fetch_active_order(shop.shop_id, order.delivery_id)
+			else:
+				order = fetch_locked_order(shop.shop_id, order.order_id)
+			datetime_timestamp = datetime.datetime.today()
+			order.time_updated = PostTimestamp(datetime_timestamp.hour, datetime_timestamp.minute)
+			report = await deliver_order(shop, order, status)
+	except locks.LockTimeout:
+		return f'Error: system overloaded. Try again in a minute.'
+	if report is not None:
+		return report
+	return f'Order #{order_id} for {order.delivery_id} has been delivered.'
+
+
+### Locking orders automatically
+# Each active order is locked as soon as its collection window has passed, i.e. when it can no longer
+# be added to (see place_order_in_flow) or refunded by the buyer (see attempt_refund).
+# The deadlines of all active orders are kept in a heap, which is rebuilt from the stored orders at startup.
+# A single task sleeps until the earliest deadline, and then locks all orders that are due, shop by shop:
+# each shop's orders are locked one after another, and its order board is then updated once.
+# If the task fails, it logs the error, rebuilds the heap and starts over.
+# Entries are never removed from the heap: an order that was locked, delivered or cancelled in the
+# meantime is simply skipped when its deadline comes.
+
+# (deadline, shop_id, delivery_id, order_id); the deadline is in seconds since the epoch
+order_deadlines = []
+# Created by init_order_lock_scheduler, inside the running event loop
+order_deadlines_changed = None
+order_lock_task = None
+order_lock_retry_delay : float = 60
+
+def get_order_lock_deadline(shop : Shop, order : Order):
+	if order.created is not None:
+		created_minute = int(order.created) // 60
+	else:
+		# Stored before 'created' existed; all we know is the time of day
+		now = datetime.datetime.today()
+		age = PostTimestamp.get_time_diff(order.time_created, PostTimestamp(now.hour, now.minute))
+		created_minute = int(time.time()) // 60 - age
+	# The order can be added to for as long as it is at most order_collection_limit minutes old
+	return (created_minute + int(shop.order_collection_limit) + 1) * 60
+
+def schedule_order_lock(shop : Shop, order : Order, deadline : float=None):
+	if deadline is None:
+		deadline = get_order_lock_deadline(shop, order)
+	heapq.heappush(order_deadlines, (deadline, shop.shop_id, order.delivery_id, order.order_id))
+	if order_deadlines_changed is not None:
+		order_deadlines_changed.set()
+
+def init_order_lock_scheduler():
+	global order_lock_task, order_deadlines_changed
+	if order_deadlines_changed is None:
+		order_deadlines_changed = asyncio.Event()
+	build_order_deadlines()
+	if order_lock_task is None:
+		order_lock_task = asyncio.create_task(run_order_lock_scheduler())
+
+startup.register('order_locks', init_order_lock_scheduler, dependencies=['shops'])
+
+def build_order_deadlines():
+	order_deadlines.clear()
+	for shop_id in get_all_shop_ids():
+		shop : Shop = read_shop(shop_id)
+		for order in list(get_shop_cache(shop_id).get_active_orders().values()):
+			schedule_order_lock(shop, order)
+
+async def run_order_lock_scheduler():
+	while True:
+		try:
+			await lock_orders_when_due()
+		except Exception as e:
+			print(f'Error: order lock scheduler failed, restarting in {order_lock_retry_delay} s: {e}')
+			await asyncio.sleep(order_lock_retry_delay)
+			# Deadlines that were taken off the heap before the failure are restored from the stored orders
+			build_order_deadlines()
+
+async def lock_orders_when_due():
+	while True:
+		order_deadlines_changed.clear()
+		now = time.time()
+		due_per_shop = {}
+		while len(order_deadlines) > 0 and order_deadlines[0][0] <= now:
+			(_, shop_id, delivery_id, order_id) = heapq.heappop(order_deadlines)
+			if not shop_id in due_per_shop:
+				due_per_shop[shop_id] = []
+			due_per_shop[shop_id].append((delivery_id, order_id))
+		if len(due_per_shop) > 0:
+			await asyncio.gather(*[lock_due_orders_for_shop(shop_id, due) for (shop_id, due) in due_per_shop.items()])
+		timeout = order_deadlines[0][0] - time.time() if len(order_deadlines) > 0 else None
+		try:
+			await asyncio.wait_for(order_deadlines_changed.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+async def lock_due_orders_for_shop(shop_id : str, due):
+	shop : Shop = read_shop(shop_id)
+	if shop is None:
+		return
+	# One shop's order flow messages are edited one at a time, as Discord limits the edits per channel anyway
+	for (delivery_id, order_id) in due:
+		try:
+			await lock_due_order(shop, delivery_id, order_id)
+		except Exception as e:
+			print(f'Error: failed to lock order {order_id} at {shop_id}: {e}')
+	if shop.board_mode:
+		await order_board_updater.flush(shop_id)
+
+async def lock_due_order(shop : Shop, delivery_id : str, order_id : str):
+	try:
+		async with lock_order(shop.shop_id, delivery_id):
+			order = get_active_order(shop.shop_id, delivery_id)
+			if order is None or order.order_id != order_id:
+				# Already locked, delivered or cancelled
+				return
+			order = fetch_active_order(shop.shop_id, delivery_id)
+			datetime_timestamp = datetime.datetime.today()
+			order.time_updated = PostTimestamp(datetime_timestamp.hour, datetime_timestamp.minute)
+			report = await lock_active_order(shop, order)
+			if report is not None:
+				print(report)
+	except locks.LockTimeout:
+		order = get_active_order(shop.shop_id, delivery_id)
+		if order is not None:
+			schedule_order_lock(shop, order, deadline=time.time() + order_lock_retry_delay)
+
+
 ### Refunds
 
 async def attempt_refund(transaction : Transaction, initiator_id : str):
@@ -2047,11 +2586,14 @@ async def attempt_refund(transaction : Transaction, initiator_id : str):
 				+'(e.g. table, address, handle), try switching back to the one you had when you ordered. 1')
 			return
 
-	sem_success = await get_order_semaphore(shop.shop_id, delivery_id)
-	if not sem_success:
+	try:
+		async with lock_order(shop.shop_id, delivery_id):
+			await refund_from_active_order(shop, transaction, delivery_id, initiated_by_shop)
+	except locks.LockTimeout:
 		transaction.report = f'Error: could not refund order as {shop.name} is overloaded. If the option remains, try again in a minute.'
-		return
 
+async def refund_from_active_order(shop : Shop, transaction : Transaction, delivery_id : str, initiated_by_shop : bool):
+	shop_id = shop.shop_id
 	order = fetch_active_order(shop_id, delivery_id)
 	if order is None:
 		if initiated_by_shop:
@@ -2061,7 +2603,6 @@ async def attempt_refund(transaction : Transaction, initiator_id : str):
 		else:
 			transaction.report = (f'Error: could not find order to refund. If you have switched your delivery option '
 				+'(e.g. table, address, handle), try switching back to the one you had when you ordered. 2')
-		return_order_semaphore(shop.shop_id, delivery_id)
 		return
 
 	product_name = transaction.data
@@ -2073,7 +2614,6 @@ async def attempt_refund(transaction : Transaction, initiator_id : str):
 		# marked the order as "locked" or "delivered". Both those options should remove the undo option from the
 		# buyer's side, though.
 		transaction.report = f'Error: could not refund. Order has been delivered, is in preparation, or this item has already been refunded.'
-		return_order_semaphore(shop.shop_id, delivery_id)
 		return
 
 	# attempt to transfer back money
@@ -2084,11 +2624,9 @@ async def attempt_refund(transaction : Transaction, initiator_id : str):
 	if not transaction.success:
 		# try_to_pay will have put in a good-enough error message
 		transaction.report = 'Error: could not refund.\n' + transaction.report
-		return_order_semaphore(shop.shop_id, delivery_id)
 		return
 
 	await execute_refund_in_order_flow(shop, transaction, order)
-	return_order_semaphore(shop.shop_id, delivery_id)
 
 
 async def execute_refund_in_order_flow(shop : Shop, refund : Transaction, order : Order):
@@ -2117,6 +2655,12 @@ async def execute_refund_in_order_flow(shop : Shop, refund : Transaction, order
 			remaining_undo_hooks.append((actor_id, msg_id))
 	order.undo_hooks = remaining_undo_hooks
 
+	if shop.board_mode or order.order_flow_msg_id is None:
+		if not order_empty:
+			order.price_total -= refund.amount
+			store_active_order(shop.shop_id, order)
+		return
+
 	try:
 		order_flow_channel = channels.get_discord_channel(shop.order_flow_channel_id)
 	except discord.errors.NotFound:
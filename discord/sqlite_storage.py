@@ -0,0 +1,117 @@
+from typing import List
+import simplejson
+import sqlite3
+import threading
+
+import storage
+
+### Module sqlite_storage.py
+# SQLite storage backend (see storage.py for the backend interface).
+# All conf trees live in one database file, using WAL mode so that the writer thread
+# never blocks reads from the event loop.
+# Each tree is kept as one row per entry: the path of the section holding it (as a JSON list),
+# the key, the value (NULL for sub-sections) and its position within the section.
+# This only changes how the trees are stored: the database is not queried while the bot runs, since every
+# tree is loaded into memory at startup (see storage.init). Lookups such as "which actor owns handle X"
+# and "all chats for handle Y" are served by in-memory indexes instead (handles.get_handle_index and
+# the handle to chats index in chats.py).
+# Append-only logs are kept in a separate table, one row per record.
+# Every batch from the writer thread is stored in a single transaction, so changes made together
+# (e.g. both sides of a transfer) are stored together.
+
+schema = [
+	'CREATE TABLE IF NOT EXISTS trees (name TEXT PRIMARY KEY)',
+	('CREATE TABLE IF NOT EXISTS entries ('
+		+ 'tree TEXT NOT NULL, section TEXT NOT NULL, key TEXT NOT NULL, value TEXT, position INTEGER NOT NULL, '
+		+ 'PRIMARY KEY (tree, section, key))'),
+	'CREATE TABLE IF NOT EXISTS log_records (id INTEGER PRIMARY KEY AUTOINCREMENT, log TEXT NOT NULL, record TEXT NOT NULL)',
+	'CREATE INDEX IF NOT EXISTS log_records_by_log ON log_records (log, id)'
+]
+
+def encode_section_path(section_path : List[str]):
+	return simplejson.dumps(section_path)
+
+
+class SqliteBackend(object):
+	def __init__(self, db_file : str):
+		self.db_file = db_file
+		# sqlite3 connections cannot be shared between threads, so each thread gets its own
+		self.local = threading.local()
+		connection = self.get_connection()
+		with connection:
+			for statement in schema:
+				connection.execute(statement)
+
+	def get_connection(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.db_file)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			self.local.connection = connection
+		return connection
+
+	def load_tree(self, name : str):
+		rows = self.get_connection().execute(
+			'SELECT section, key, value FROM entries WHERE tree = ? ORDER BY position',
+			(name,))
+		entries_per_section = {}
+		for section, key, value in rows:
+			entries_per_section.setdefault(section, []).append((key, value))
+		return self.build_section(entries_per_section, [])
+
+	def build_section(self, entries_per_section, section_path : List[str]):
+		section = {}
+		for key, value in entries_per_section.get(encode_section_path(section_path), []):
+			if value is None:
+				section[key] = self.build_section(entries_per_section, section_path + [key])
+			else:
+				section[key] = value
+		return section
+
+	def list_trees(self, conf_dir : str):
+		rows = self.get_connection().execute(
+			'SELECT name FROM trees WHERE name LIKE ? ESCAPE \'\\\'',
+			(conf_dir.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%',))
+		return [name for (name,) in rows if not '/' in name[len(conf_dir) + 1:]]
+
+	# Works on any ConfigObj section; scalars come before sub-sections, same as in the conf files
+	def snapshot(self, tree):
+		rows = []
+		self.add_section_rows(tree, [], rows)
+		return rows
+
+	def add_section_rows(self, section, section_path : List[str], rows):
+		encoded_path = encode_section_path(section_path)
+		position = 0
+		for key in section.scalars:
+			rows.append((encoded_path, key, str(section[key]), position))
+			position += 1
+		for key in section.sections:
+			rows.append((encoded_path, key, None, position))
+			position += 1
+			self.add_section_rows(section[key], section_path + [key], rows)
+
+	def store_batch(self, snapshots, records):
+		connection = self.get_connection()
+		with connection:
+			for log_name, log_records in records.items():
+				(cleared, log_records) = storage.get_records_after_last_clear(log_records)
+				if cleared:
+					connection.execute('DELETE FROM log_records WHERE log = ?', (log_name,))
+				connection.executemany(
+					'INSERT INTO log_records (log, record) VALUES (?, ?)',
+					((log_name, r) for r in log_records))
+			for name, rows in snapshots.items():
+				connection.execute('INSERT OR IGNORE INTO trees (name) VALUES (?)', (name,))
+				connection.execute('DELETE FROM entries WHERE tree = ?', (name,))
+				connection.executemany(
+					'INSERT INTO entries (tree, section, key, value, position) VALUES (?, ?, ?, ?, ?)',
+					((name,) + row for row in rows))
+
+	def read_records(self, log_name : str):
+		rows = self.get_connection().execute(
+			'SELECT id, record FROM log_records WHERE log = ? ORDER BY id',
+			(log_name,))
+		for (record_id, record) in rows:
+			yield (record_id, record)
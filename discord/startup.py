@@ -0,0 +1,76 @@
+import asyncio
+import inspect
+import time
+
+### Module startup.py
+# Runs the initialisation of all modules when the bot has connected.
+# Each module registers its init step together with the steps it depends on, e.g.
+#     startup.register('chats', lambda: init(), dependencies=['channels', 'actors'])
+# A step starts as soon as all of its dependencies are done, so independent steps run concurrently.
+# Every step runs at most once per process, even if the bot reconnects and on_ready is called again.
+# Steps are registered when their module is imported, so run() is given the modules that are expected
+# to register steps, and checks that each of them did.
+
+# name -> (function, dependencies); the function may be async
+steps = {}
+done = set()
+
+def register(name : str, function, dependencies=None):
+	steps[name] = (function, [] if dependencies is None else list(dependencies))
+
+def check_dependencies():
+	for name, (_, dependencies) in steps.items():
+		for dependency in dependencies:
+			if not dependency in steps:
+				raise RuntimeError(f'Startup step {name} depends on unknown step {dependency}.')
+	# Depth-first search for cycles
+	visiting = set()
+	visited = set()
+	def visit(name : str, path):
+		if name in visiting:
+			raise RuntimeError(f'Startup steps have a circular dependency: {" -> ".join(path + [name])}')
+		if not name in visited:
+			visiting.add(name)
+			for dependency in steps[name][1]:
+				visit(dependency, path + [name])
+			visiting.remove(name)
+			visited.add(name)
+	for name in steps:
+		visit(name, [])
+
+def check_modules(modules):
+	registered = set(function.__module__ for (function, _) in steps.values())
+	for module in modules:
+		if not module.__name__ in registered:
+			raise RuntimeError(f'Module {module.__name__} is expected to register a startup step but did not.')
+
+async def run(modules=()):
+	check_modules(modules)
+	check_dependencies()
+	start = time.monotonic()
+	tasks = {}
+	# name -> (start, duration) in seconds, relative to the start of the run
+	timings = {}
+
+	async def run_step(name : str):
+		(function, dependencies) = steps[name]
+		await asyncio.gather(*[tasks[d] for d in dependencies if d in tasks])
+		step_start = time.monotonic()
+		result = function()
+		if inspect.isawaitable(result):
+			await result
+		timings[name] = (step_start - start, time.monotonic() - step_start)
+		done.add(name)
+
+	for name in steps:
+		if not name in done:
+			tasks[name] = asyncio.create_task(run_step(name))
+	if len(tasks) == 0:
+		return
+	await asyncio.gather(*tasks.values())
+	print_report(timings, time.monotonic() - start)
+
+def print_report(timings, total : float):
+	print(f'Startup took {total:.2f} s:')
+	for name, (step_start, duration) in sorted(timings.items(), key=lambda t: t[1][0]):
+		print(f'  {name}: {duration:.2f} s (started at {step_start:.2f} s)')
@@ -0,0 +1,161 @@
+from configobj import ConfigObj
+from dotenv import load_dotenv
+import io
+import os
+
+import persistence
+import startup
+
+### Module storage.py
+# This module keeps the game state conf files in memory.
+# Every conf file is parsed at most once: the game state directories are loaded at startup
+# (see init()), and any other file is loaded the first time it is asked for.
+# After that, all reads are served from memory, and writes are handed to persistence.py.
+# Modules should always get their conf objects from get_conf() instead of creating ConfigObj directly;
+# otherwise they will read and write copies that the rest of the bot does not see.
+#
+# Where the trees are actually kept is decided by the storage backend:
+# - 'files' (default): one conf file per tree, as before.
+# - 'sqlite': a single SQLite database (see sqlite_storage.py). Use migrate_to_sqlite.py to import the conf files.
+# The backend is selected with STORAGE_BACKEND in .env; STORAGE_DB sets the database file.
+#
+# A backend must implement:
+# - load_tree(name): the input to give ConfigObj for the tree
+# - list_trees(conf_dir): the names of all trees in a directory
+# - snapshot(tree): a comparable copy of the tree's content, taken on the event loop
+# - store_batch(snapshots, records): persist a {name: snapshot} batch of trees and a {log name: [records]}
+#   batch of appended log records (called from the writer thread). A None record means the log was cleared.
+# - read_records(log_name): (offset, record) for all records stored in an append-only log, oldest first;
+#   the offset identifies the record's place in the log
+
+load_dotenv()
+backend_name = os.getenv('STORAGE_BACKEND', 'files')
+default_db_file = 'game_state.db'
+
+# Directories whose conf files are loaded at startup
+# (finances are kept in the append-only ledger instead, see ledger.py)
+preloaded_dirs = ['handles', 'players', 'actors', 'shops', 'chats']
+
+# All conf trees currently held in memory, keyed by normalized file path
+conf_trees = {}
+
+
+class FileBackend(object):
+	def load_tree(self, name : str):
+		# ConfigObj reads the file itself (or starts out empty if it does not exist yet)
+		return name
+
+	def list_trees(self, conf_dir : str):
+		if not os.path.isdir(conf_dir):
+			return []
+		return [f'{conf_dir}/{file_name}' for file_name in os.listdir(conf_dir) if file_name.endswith('.conf')]
+
+	def snapshot(self, tree):
+		outfile = io.BytesIO()
+		ConfigObj.write(tree, outfile=outfile)
+		return outfile.getvalue()
+
+	# Log records are appended before trees are written, so a tree that refers to a position
+	# in a log (e.g. a ledger snapshot) is never stored ahead of the log itself
+	def store_batch(self, snapshots, records):
+		for log_name, log_records in records.items():
+			(cleared, log_records) = get_records_after_last_clear(log_records)
+			try:
+				with open(get_log_file_name(log_name), 'wb' if cleared else 'ab') as f:
+					f.write(''.join(f'{r}\n' for r in log_records).encode('utf-8'))
+					f.flush()
+					os.fsync(f.fileno())
+			except OSError as e:
+				print(f'Error: failed to append to {log_name}: {e}')
+		for name, content in snapshots.items():
+			try:
+				write_atomically(name, content)
+			except OSError as e:
+				print(f'Error: failed to write {name}: {e}')
+
+	def read_records(self, log_name : str):
+		file_name = get_log_file_name(log_name)
+		if not os.path.exists(file_name):
+			return
+		with open(file_name, 'rb') as f:
+			offset = 0
+			for line in f:
+				yield (offset, line.decode('utf-8').rstrip('\n'))
+				offset += len(line)
+
+def get_log_file_name(log_name : str):
+	return f'{log_name}.log'
+
+# Returns whether the log was cleared in this batch, and the records to store after that
+def get_records_after_last_clear(log_records):
+	if None in log_records:
+		last_clear = len(log_records) - 1 - log_records[::-1].index(None)
+		return (True, log_records[last_clear + 1:])
+	return (False, log_records)
+
+def write_atomically(file_name : str, content : bytes):
+	temp_file_name = f'{file_name}.tmp'
+	with open(temp_file_name, 'wb') as f:
+		f.write(content)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temp_file_name, file_name)
+
+
+def create_backend(name : str):
+	if name == 'sqlite':
+		import sqlite_storage
+		return sqlite_storage.SqliteBackend(os.getenv('STORAGE_DB', default_db_file))
+	elif name == 'files':
+		return FileBackend()
+	else:
+		raise RuntimeError(f'Unknown storage backend \"{name}\"; expected \"files\" or \"sqlite\".')
+
+backend = create_backend(backend_name)
+persistence.set_backend(backend)
+
+
+class StoredConf(ConfigObj):
+	def __init__(self, file_name : str):
+		super().__init__(backend.load_tree(get_conf_key(file_name)))
+		self.filename = file_name
+		self.conf_key = get_conf_key(file_name)
+		self.stored_content = self.snapshot()
+
+	def snapshot(self):
+		return backend.snapshot(self)
+
+	# Queues the tree to be persisted (see persistence.py); unchanged trees are never written.
+	# ConfigObj calls write() recursively with a section to serialize sub-sections; those calls are passed on.
+	def write(self, outfile=None, section=None):
+		if outfile is not None or section is not None:
+			return ConfigObj.write(self, outfile=outfile, section=section)
+		persistence.schedule_write(self)
+
+
+def get_conf_key(file_name : str):
+	return os.path.normpath(file_name)
+
+def get_conf(file_name : str):
+	key = get_conf_key(file_name)
+	if key not in conf_trees:
+		conf_trees[key] = StoredConf(key)
+	return conf_trees[key]
+
+def init():
+	for conf_dir in preloaded_dirs:
+		for name in backend.list_trees(conf_dir):
+			get_conf(name)
+
+startup.register('storage', init)
+
+# Append-only logs: each record is a single line of text (e.g. JSON), and records are never changed once written.
+# Appended records are stored by the writer thread together with the conf trees written at the same time.
+def append_record(log_name : str, record : str):
+	persistence.schedule_append(log_name, record)
+
+def clear_log(log_name : str):
+	persistence.schedule_append(log_name, None)
+
+def read_records(log_name : str):
+	return backend.read_records(log_name)
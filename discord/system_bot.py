@@ -28,9 +28,20 @@ import game
 import artifacts
 import gm
 import logger
+import storage
+import persistence
+import debounce
+import ledger
+import startup
 from common import coin
 
 
+# The modules that register init steps with startup.py when they are imported
+startup_modules = (
+    storage, ledger, posting, handles, shops, players, actors, finances,
+    channels, chats, groups, artifacts, gm, game
+)
+
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 guild_name = os.getenv('GUILD_NAME')
@@ -44,7 +55,14 @@ logger.setup_command_logger()
 help_command = commands.DefaultHelpCommand(
     no_category = 'Commands'
 )
-bot = commands.Bot(
+class Bot(commands.Bot):
+    async def close(self):
+        # Debounced updates (e.g. finance records) are sent to Discord, so they must be flushed while still connected;
+        # the state they change is then stored by persistence.flush() below
+        await debounce.flush_all()
+        await super().close()
+
+bot = Bot(
     command_prefix='.',
     intents=intents,
     help_command = help_command
@@ -65,22 +83,11 @@ if __name__ == '__main__':
 async def on_ready():
     global guild
     global guild_name
-    clear_all = False
     guild = discord.utils.find(lambda g: g.name == guild_name, bot.guilds)
-    # TODO: move some of the initialisation to the cogs instead
-    await server.init(bot, guild)
-    await handles.init(clear_all)
-    await actors.init(guild, clear_all=clear_all)
-    await players.init(guild, clear_all=clear_all)
-    await channels.init()
-    finances.init_finances()
-    await chats.init(clear_all=clear_all)
-    await shops.init(guild, clear_all=clear_all)
-    await groups.init(guild, clear_all=clear_all)
-    reactions.init()
-    artifacts.init(clear_all=clear_all)
-    await gm.init(clear_all=clear_all)
-    game.init()
+    # Each module registers its own init step (see startup.py); the server step is registered here
+    # since it needs the guild
+    startup.register('server', lambda: server.init(bot, guild))
+    await startup.run(startup_modules)
     print('Initialization complete.')
     report = game.start_game()
 
@@ -104,6 +111,10 @@ async def on_message(message):
         # Never react to bot's own message to avoid loops
         return
 
+    if message.webhook_id is not None:
+        # Reposts made through webhooks (see posting.py)
+        return
+
     if channels.is_offline_channel(message.channel):
         # No bot shenanigans in the off channel
         return
@@ -210,10 +221,33 @@ async def on_raw_reaction_add(payload):
 
 @bot.event
 async def on_member_join(member):
+    server.add_member(member)
     # TODO: put the player in a special setup area, and force them to join (claim a handle) before they can continue
     await server.set_user_as_new_player(member)
     #return await players.create_player(member)
 
+@bot.event
+async def on_member_update(before, after):
+    server.update_member(before, after)
+
+@bot.event
+async def on_member_remove(member):
+    server.remove_member(member)
+
+@bot.event
+async def on_guild_role_create(role):
+    server.add_role(role)
+
+@bot.event
+async def on_guild_role_delete(role):
+    server.remove_role(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    server.update_role(before, after)
+
 
 
 bot.run(TOKEN)
+# Make sure all pending state changes reach the disk before exiting
+persistence.flush()